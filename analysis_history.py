@@ -0,0 +1,362 @@
+"""
+FertiVision powered by AI - Analysis History
+
+Lists stored analyses of every type, newest first, from `analysis_index`.
+Each filter (type, classification, patient, case, client) has a
+(field, timestamp, public_id) index and pages are addressed with a keyset
+cursor on (timestamp, public_id) instead of OFFSET, so every page costs the
+same index range scan however deep it is and however large the tables grow.
+
+Only the fields a caller asks for are loaded: the JSON document and the LLM
+text are fetched per page, by row id, when requested.
+
+Analyses moved to monthly archive partitions (archive.py) are merged in;
+partitions outside the date filters or the cursor are never opened.
+
+Usage:
+    page = query_history(conn, HistoryFilters(patient_id="P-42"), limit=50)
+    next_page = query_history(conn, filters, cursor=page['next_cursor'])
+
+© 2025 FertiVision powered by AI (made by greybrain.ai) - DeepSeek LLM Image Analysis
+"""
+
+import json
+import base64
+import sqlite3
+from dataclasses import dataclass, fields as dataclass_fields
+from typing import Dict, List, Optional, Any, Tuple, Mapping
+
+from analysis_schema import ANALYSIS_TABLES
+from blob_store import decompress
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+# Live IDs per query when discounting analyses found in both the live database and a partition
+DEDUP_CHUNK = 500
+
+# Fields served straight from analysis_index
+INDEX_FIELDS = ('analysis_id', 'analysis_type', 'record_id', 'timestamp', 'classification',
+                'patient_id', 'case_id', 'client', 'image_path', 'aliases')
+
+# Fields loaded from the analysis tables, only when asked for
+DOCUMENT_FIELDS = ('data', 'llm_analysis')
+
+HISTORY_FIELDS = INDEX_FIELDS + DOCUMENT_FIELDS
+DEFAULT_FIELDS = ('analysis_id', 'analysis_type', 'timestamp', 'classification', 'patient_id', 'case_id')
+
+# Filterable fields, also the fields analyses can be counted by
+GROUP_FIELDS = ('analysis_type', 'classification', 'patient_id', 'case_id', 'client')
+
+@dataclass
+class HistoryFilters:
+    """History filters; None means no restriction"""
+    analysis_type: Optional[str] = None
+    date_from: Optional[str] = None  # ISO date or timestamp, inclusive
+    date_to: Optional[str] = None    # ISO date or timestamp, inclusive
+    classification: Optional[str] = None
+    patient_id: Optional[str] = None
+    case_id: Optional[str] = None
+    client: Optional[str] = None
+
+def encode_cursor(timestamp: str, public_id: str) -> str:
+    raw = json.dumps([timestamp, public_id], separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor: str) -> Tuple[str, str]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        timestamp, public_id = json.loads(raw)
+        return str(timestamp), str(public_id)
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor")
+
+def _date_bound(value: str, end: bool) -> str:
+    # A bare date covers the whole day
+    if len(value) == 10:
+        return value + ("T23:59:59.999999" if end else "T00:00:00")
+    return value
+
+def check_request(filters: HistoryFilters, limit: int, fields: List[str]):
+    """Raise ValueError for an unknown analysis type or field, or a bad page size"""
+    unknown = [name for name in fields if name not in HISTORY_FIELDS]
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        raise ValueError(f"limit must be between 1 and {MAX_PAGE_SIZE}")
+    if filters.analysis_type and filters.analysis_type not in ANALYSIS_TABLES:
+        raise ValueError(f"Unknown analysis type: {filters.analysis_type}")
+
+def filter_clause(filters: HistoryFilters, cursor: Optional[str] = None) -> Tuple[str, List[Any]]:
+    """WHERE clause (qmark parameters) on analysis_index for the filters and cursor"""
+    # Aliases (API analysis IDs) point at the same analysis; list each analysis once
+    where = ['public_id = natural_id']
+    params: List[Any] = []
+    for name in GROUP_FIELDS:
+        value = getattr(filters, name)
+        if value:
+            where.append(f'{name} = ?')
+            params.append(value)
+    if filters.date_from:
+        where.append('timestamp >= ?')
+        params.append(_date_bound(filters.date_from, end=False))
+    if filters.date_to:
+        where.append('timestamp <= ?')
+        params.append(_date_bound(filters.date_to, end=True))
+    if cursor:
+        where.append('(timestamp, public_id) < (?, ?)')
+        params.extend(decode_cursor(cursor))
+    return " AND ".join(where), params
+
+def history_query(filters: HistoryFilters, cursor: Optional[str], limit: int) -> Tuple[str, List[Any]]:
+    """Index query for one page plus one row (to detect a next page)"""
+    where, params = filter_clause(filters, cursor)
+    return f'''
+        SELECT public_id, analysis_type, table_name, row_id, timestamp, classification,
+               patient_id, case_id, client, image_path
+        FROM analysis_index
+        WHERE {where}
+        ORDER BY timestamp DESC, public_id DESC
+        LIMIT ?
+    ''', params + [limit + 1]
+
+def history_record(row) -> Dict[str, Any]:
+    """Item of a history page from an analysis_index row of history_query"""
+    public_id, analysis_type, _, _, timestamp, classification, patient_id, case_id, client, image_path = row
+    return {
+        'analysis_id': public_id,
+        'analysis_type': analysis_type,
+        'record_id': public_id,
+        'timestamp': timestamp,
+        'classification': classification,
+        'patient_id': patient_id,
+        'case_id': case_id,
+        'client': client,
+        'image_path': image_path,
+    }
+
+def next_page_cursor(rows: list, limit: int) -> Tuple[list, Optional[str]]:
+    """(page rows, cursor of the next page or None) from up to limit + 1 rows"""
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, encode_cursor(rows[-1][4], rows[-1][0])
+
+def query_history(conn: sqlite3.Connection,
+                  filters: Optional[HistoryFilters] = None,
+                  cursor: Optional[str] = None,
+                  limit: int = DEFAULT_PAGE_SIZE,
+                  fields: Optional[List[str]] = None,
+                  archive=None) -> Dict[str, Any]:
+    """
+    One page of analyses, newest first
+
+    With an archive.ArchiveReader, archived analyses are listed too.
+    Returns {'items': [...], 'next_cursor': str or None}. Raises ValueError
+    for an unknown analysis type or field, a bad cursor or page size.
+    """
+    filters = filters or HistoryFilters()
+    fields = list(fields or DEFAULT_FIELDS)
+    check_request(filters, limit, fields)
+    select, params = history_query(filters, cursor, limit)
+
+    # (row, source): source is None for the live database, else an archive partition
+    collected = [(row, None) for row in conn.execute(select, params).fetchall()]
+    if archive is not None:
+        collected = _collect_archived(archive, select, params, collected, filters, cursor, limit)
+
+    page, next_cursor = next_page_cursor([row for row, _ in collected], limit)
+    items = [(source, row[2], row[3], history_record(row)) for row, source in collected[:len(page)]]
+
+    by_source: Dict[Any, list] = {}
+    for source, table, row_id, record in items:
+        by_source.setdefault(source, []).append((table, row_id, record))
+    for source, source_items in by_source.items():
+        if source is None:
+            _attach_fields(conn, source_items, fields, archived=False)
+        else:
+            with archive.connection(source) as part:
+                _attach_fields(part, source_items, fields, archived=True)
+
+    return {
+        'items': [{name: record.get(name) for name in fields} for _, _, _, record in items],
+        'next_cursor': next_cursor
+    }
+
+def _sort_key(entry):
+    row = entry[0]
+    return (row[4] or '', row[0])
+
+def _collect_archived(archive, select: str, params: List[Any], collected, filters: HistoryFilters,
+                      cursor: Optional[str], limit: int):
+    """
+    Merge matching rows of the archive partitions into the live rows
+
+    Partitions are visited newest month first and skipped when the date
+    filters or the cursor exclude their month; the scan stops once a full
+    page is collected and the next partition only holds older analyses.
+    """
+    date_from = _date_bound(filters.date_from, end=False) if filters.date_from else None
+    date_to = _date_bound(filters.date_to, end=True) if filters.date_to else None
+    after = decode_cursor(cursor)[0] if cursor else None
+
+    for partition in archive.partitions():
+        if date_from and partition.end <= date_from:
+            break
+        if len(collected) > limit:
+            collected.sort(key=_sort_key, reverse=True)
+            if (collected[limit][0][4] or '') >= partition.end:
+                break
+        if (date_to and partition.start > date_to) or (after and partition.start > after):
+            continue
+        with archive.connection(partition) as part:
+            collected.extend((row, partition) for row in part.execute(select, params).fetchall())
+
+    # An interrupted archive run can leave an analysis in both places; the live copy wins
+    seen = set()
+    merged = []
+    for entry in sorted(collected, key=_sort_key, reverse=True):
+        if entry[0][0] not in seen:
+            seen.add(entry[0][0])
+            merged.append(entry)
+    return merged[:limit + 1]
+
+def _attach_fields(conn: sqlite3.Connection, items, fields: List[str], archived: bool):
+    if 'aliases' in fields:
+        _attach_aliases(conn, items)
+    if 'data' in fields:
+        _attach_documents(conn, items, archived)
+    if 'llm_analysis' in fields:
+        _attach_llm_text(conn, items)
+
+def _by_table(items) -> Dict[str, list]:
+    grouped: Dict[str, list] = {}
+    for table, row_id, record in items:
+        grouped.setdefault(table, []).append((row_id, record))
+    return grouped
+
+def _placeholders(count: int) -> str:
+    return ", ".join("?" for _ in range(count))
+
+def _attach_aliases(conn: sqlite3.Connection, items):
+    for table, entries in _by_table(items).items():
+        by_id = {record['record_id']: record for _, record in entries}
+        for record in by_id.values():
+            record['aliases'] = []
+        for natural_id, public_id in conn.execute(f'''
+            SELECT natural_id, public_id FROM analysis_index
+            WHERE table_name = ? AND natural_id IN ({_placeholders(len(by_id))}) AND public_id != natural_id
+        ''', [table] + list(by_id)):
+            by_id[natural_id]['aliases'].append(public_id)
+
+def _attach_documents(conn: sqlite3.Connection, items, archived: bool = False):
+    for table, entries in _by_table(items).items():
+        by_row = {row_id: record for row_id, record in entries}
+        # Archived documents are compressed (see archive.py)
+        columns = 'id, data, codec' if archived else 'id, data, NULL'
+        for row_id, data, codec in conn.execute(
+            f'SELECT {columns} FROM {table} WHERE id IN ({_placeholders(len(by_row))})', list(by_row)
+        ):
+            data_json = decompress(codec, data) if codec and data is not None else data
+            by_row[row_id]['data'] = json.loads(data_json) if data_json else None
+
+def _attach_llm_text(conn: sqlite3.Connection, items):
+    tables = {name for (name,) in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name IN ('image_analyses', 'llm_blobs')"
+    )}
+    if 'image_analyses' not in tables:
+        return
+    by_key = {(record['record_id'], record['analysis_type']): record for _, _, record in items}
+    blob = 'b.codec, b.data FROM image_analyses i LEFT JOIN llm_blobs b ON b.hash = i.llm_blob' \
+        if 'llm_blobs' in tables else 'NULL, NULL FROM image_analyses i'
+    sample_ids = list({sample_id for sample_id, _ in by_key})
+    # Newest image analysis per (sample, type) comes first
+    for sample_id, analysis_type, text, codec, data in conn.execute(f'''
+        SELECT i.sample_id, i.analysis_type, i.llm_analysis, {blob}
+        WHERE i.sample_id IN ({_placeholders(len(sample_ids))})
+        ORDER BY i.id DESC
+    ''', sample_ids):
+        record = by_key.pop((sample_id, analysis_type), None)
+        if record is not None:
+            record['llm_analysis'] = text if text is not None else (decompress(codec, data) if codec else None)
+
+def aggregate_query(filters: HistoryFilters, group_by: str,
+                    public_ids: Optional[List[str]] = None) -> Tuple[str, List[Any]]:
+    """Per-group count and time range on analysis_index (qmark parameters), optionally of some IDs only"""
+    if group_by not in GROUP_FIELDS:
+        raise ValueError(f"Cannot group by {group_by}; use one of {', '.join(GROUP_FIELDS)}")
+    if filters.analysis_type and filters.analysis_type not in ANALYSIS_TABLES:
+        raise ValueError(f"Unknown analysis type: {filters.analysis_type}")
+    where, params = filter_clause(filters)
+    if public_ids is not None:
+        where += f' AND public_id IN ({_placeholders(len(public_ids))})'
+        params += public_ids
+    return f'''
+        SELECT {group_by}, COUNT(*), MIN(timestamp), MAX(timestamp)
+        FROM analysis_index WHERE {where}
+        GROUP BY {group_by}
+    ''', params
+
+def merge_groups(groups: Dict[Any, Dict[str, Any]], rows) -> Dict[Any, Dict[str, Any]]:
+    """Add rows of aggregate_query into groups (value -> group)"""
+    for value, count, first, last in rows:
+        group = groups.get(value)
+        if group is None:
+            groups[value] = {'value': value, 'count': count, 'first': first, 'last': last}
+            continue
+        group['count'] += count
+        group['first'] = min(filter(None, (group['first'], first)), default=None)
+        group['last'] = max(filter(None, (group['last'], last)), default=None)
+    return groups
+
+def sorted_groups(groups: Dict[Any, Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Largest group first"""
+    return sorted(groups.values(), key=lambda group: (-group['count'], str(group['value'])))
+
+def aggregate_history(conn: sqlite3.Connection,
+                      filters: Optional[HistoryFilters] = None,
+                      group_by: str = 'classification',
+                      archive=None) -> List[Dict[str, Any]]:
+    """
+    Number of analyses and first/last timestamp per value of group_by,
+    largest group first, over live and archived analyses
+
+    Takes the history filters; raises ValueError for an unknown field.
+    """
+    filters = filters or HistoryFilters()
+    sql, params = aggregate_query(filters, group_by)
+    groups = merge_groups({}, conn.execute(sql, params))
+    if archive is not None:
+        date_from = _date_bound(filters.date_from, end=False) if filters.date_from else None
+        date_to = _date_bound(filters.date_to, end=True) if filters.date_to else None
+        for partition in archive.partitions():
+            if (date_from and partition.end <= date_from) or (date_to and partition.start > date_to):
+                continue
+            # An interrupted archive run leaves analyses in both places (no locator yet); count them once
+            live_ids = [public_id for (public_id,) in conn.execute(
+                'SELECT public_id FROM analysis_index WHERE timestamp >= ? AND timestamp < ?',
+                (partition.start, partition.end)
+            )]
+            with archive.connection(partition) as part:
+                merge_groups(groups, part.execute(sql, params))
+                for start in range(0, len(live_ids), DEDUP_CHUNK):
+                    duplicates = aggregate_query(filters, group_by, live_ids[start:start + DEDUP_CHUNK])
+                    # Same timestamps as the live copies, so first/last are unaffected
+                    for value, count, _, _ in part.execute(*duplicates):
+                        groups[value]['count'] -= count
+    return sorted_groups(groups)
+
+def parse_history_args(args: Mapping[str, str]) -> Tuple[HistoryFilters, Optional[str], int, Optional[List[str]]]:
+    """(filters, cursor, limit, fields) from query string arguments; raises ValueError"""
+    filters = HistoryFilters(**{
+        field.name: args.get(field.name) or None
+        for field in dataclass_fields(HistoryFilters)
+    })
+    # 'type' is accepted as shorthand for analysis_type
+    filters.analysis_type = filters.analysis_type or args.get('type') or None
+    try:
+        limit = int(args.get('limit', DEFAULT_PAGE_SIZE))
+    except (TypeError, ValueError):
+        raise ValueError("limit must be an integer")
+    fields = [name.strip() for name in args['fields'].split(',') if name.strip()] if args.get('fields') else None
+    return filters, args.get('cursor') or None, limit, fields
@@ -0,0 +1,456 @@
+#!/usr/bin/env python3
+"""
+FertiVision powered by AI - Typed Analysis Schema
+
+The analysis tables keep the full record as a JSON document in `data`. This
+module adds typed copies of the fields clinics filter on (classification,
+grade, day, AFC, patient and case IDs) as real columns with secondary
+indexes, so cohort queries use an index instead of json.loads on every row.
+
+`analysis_index` maps every public ID (natural keys such as sample_id or
+scan_id, and API analysis IDs) to its analysis type, table and row, so any ID
+resolves with one primary-key lookup without knowing the analysis type. It
+also carries the listing fields (timestamp, classification, patient, case,
+client) with (field, timestamp, public_id) indexes, so the history of every
+analysis type is one keyset-paginated index scan.
+
+The JSON document stays the source of truth and read paths keep using it.
+Adding columns is a metadata-only change in SQLite; existing rows are
+backfilled in small keyset batches, each its own short transaction, so the
+application keeps reading and writing while the migration runs. Progress is
+stored in `schema_migrations` and an interrupted backfill resumes where it
+stopped. The backfill also moves plain image_analyses.llm_analysis text into
+the compressed blob store.
+
+Usage:
+    python analysis_schema.py [db_path] [--batch-size 500] [--pause 0.05]
+    python analysis_schema.py [db_path] --status
+
+© 2025 FertiVision powered by AI (made by greybrain.ai) - DeepSeek LLM Image Analysis
+"""
+
+import sys
+import json
+import time
+import sqlite3
+import argparse
+import datetime
+from enum import Enum
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Any, Callable, Tuple
+
+from blob_store import migrate_image_text
+
+SCHEMA_VERSION = 3  # v2: analysis_index, v3: history columns on analysis_index
+
+@dataclass(frozen=True)
+class TypedColumn:
+    """A field copied out of the JSON document into its own column"""
+    name: str
+    sql_type: str  # TEXT, REAL or INTEGER
+    indexed: bool = False
+
+# Natural key column of each analysis table
+ID_COLUMNS = {
+    'sperm_analyses': 'sample_id',
+    'oocyte_analyses': 'oocyte_id',
+    'embryo_analyses': 'embryo_id',
+    'follicle_analyses': 'scan_id',
+    'hysteroscopy_analyses': 'procedure_id'
+}
+
+# Analysis type of each table, as used in URLs and reports
+ANALYSIS_TABLES = {
+    'sperm': 'sperm_analyses',
+    'oocyte': 'oocyte_analyses',
+    'embryo': 'embryo_analyses',
+    'follicle': 'follicle_analyses',
+    'hysteroscopy': 'hysteroscopy_analyses'
+}
+
+ANALYSIS_TYPES = {table: analysis_type for analysis_type, table in ANALYSIS_TABLES.items()}
+
+# Listing fields of analysis_index; all but client are copied from the analysis row
+INDEX_COLUMNS = [
+    TypedColumn('classification', 'TEXT', indexed=True),
+    TypedColumn('patient_id', 'TEXT', indexed=True),
+    TypedColumn('case_id', 'TEXT', indexed=True),
+    TypedColumn('client', 'TEXT', indexed=True),
+]
+
+_COMMON_COLUMNS = [
+    TypedColumn('classification', 'TEXT', indexed=True),
+    TypedColumn('patient_id', 'TEXT', indexed=True),
+    TypedColumn('case_id', 'TEXT', indexed=True),
+]
+
+TYPED_COLUMNS: Dict[str, List[TypedColumn]] = {
+    'sperm_analyses': _COMMON_COLUMNS + [
+        TypedColumn('concentration', 'REAL'),
+        TypedColumn('progressive_motility', 'REAL'),
+        TypedColumn('normal_morphology', 'REAL'),
+    ],
+    'oocyte_analyses': _COMMON_COLUMNS + [
+        TypedColumn('maturity', 'TEXT', indexed=True),
+        TypedColumn('morphology_score', 'INTEGER'),
+        TypedColumn('viability', 'INTEGER'),
+    ],
+    'embryo_analyses': _COMMON_COLUMNS + [
+        TypedColumn('day', 'INTEGER', indexed=True),
+        TypedColumn('grade', 'TEXT', indexed=True),
+        TypedColumn('cell_count', 'INTEGER'),
+        TypedColumn('fragmentation', 'REAL'),
+        TypedColumn('transfer_quality', 'INTEGER'),
+    ],
+    'follicle_analyses': _COMMON_COLUMNS + [
+        TypedColumn('antral_follicle_count', 'INTEGER', indexed=True),
+        TypedColumn('total_follicle_count', 'INTEGER'),
+        TypedColumn('dominant_follicle_size', 'REAL'),
+    ],
+    'hysteroscopy_analyses': _COMMON_COLUMNS + [
+        TypedColumn('endometrial_thickness', 'REAL'),
+        TypedColumn('biopsy_indicated', 'INTEGER'),
+    ],
+}
+
+_CONVERTERS: Dict[str, Callable[[Any], Any]] = {
+    'TEXT': str,
+    'REAL': float,
+    'INTEGER': int,
+}
+
+def typed_values(table: str, data: Dict[str, Any]) -> Dict[str, Any]:
+    """Typed column values for a table row from its JSON document"""
+    values = {}
+    for column in TYPED_COLUMNS.get(table, []):
+        value = data.get(column.name)
+        if isinstance(value, Enum):
+            value = value.value
+        if value is not None and value != "":
+            try:
+                value = _CONVERTERS[column.sql_type](value)
+            except (TypeError, ValueError):
+                value = None
+        else:
+            value = None
+        values[column.name] = value
+    return values
+
+def typed_column_names(table: str) -> List[str]:
+    return [column.name for column in TYPED_COLUMNS.get(table, [])]
+
+@dataclass
+class AnalysisRef:
+    """Where an analysis ID points"""
+    public_id: str
+    analysis_type: str
+    table: str
+    row_id: int
+    natural_id: str
+    image_path: Optional[str] = None
+    timestamp: Optional[str] = None
+    partition: Optional[str] = None  # archive partition file, None for live rows
+
+def index_statements(table: str, id_value: str) -> List[Tuple[str, list]]:
+    """
+    Statements that point the index entry of a stored row (and any aliases
+    of it) at its current row id; run in the transaction of the insert
+    """
+    id_field = ID_COLUMNS[table]
+    return [
+        (f'''
+            INSERT INTO analysis_index
+            (public_id, analysis_type, table_name, row_id, natural_id, timestamp, classification, patient_id, case_id)
+            SELECT ?, ?, ?, id, {id_field}, timestamp, classification, patient_id, case_id
+            FROM {table} WHERE {id_field} = ?
+            ON CONFLICT(public_id) DO UPDATE SET
+                analysis_type = excluded.analysis_type,
+                table_name = excluded.table_name,
+                row_id = excluded.row_id,
+                natural_id = excluded.natural_id,
+                timestamp = excluded.timestamp,
+                classification = excluded.classification,
+                patient_id = excluded.patient_id,
+                case_id = excluded.case_id
+        ''', [id_value, ANALYSIS_TYPES[table], table, id_value]),
+        # INSERT OR REPLACE gives a replaced row a new id
+        (f'''
+            UPDATE analysis_index SET (row_id, timestamp, classification, patient_id, case_id) = (
+                SELECT id, timestamp, classification, patient_id, case_id FROM {table} WHERE {id_field} = ?
+            )
+            WHERE table_name = ? AND natural_id = ? AND public_id != natural_id
+        ''', [id_value, table, id_value]),
+    ]
+
+def image_index_statements(analysis_type: str, natural_id: str, image_path: str,
+                           alias: Optional[str] = None, client: Optional[str] = None) -> List[Tuple[str, list]]:
+    """Record the image (and API client) of an indexed analysis, optionally under an extra public ID"""
+    table = ANALYSIS_TABLES.get(analysis_type)
+    if table is None:
+        return []
+    statements = [(
+        'UPDATE analysis_index SET image_path = ?, client = COALESCE(?, client) WHERE table_name = ? AND natural_id = ?',
+        [image_path, client, table, natural_id]
+    )]
+    if alias and alias != natural_id:
+        statements.append(('''
+            INSERT OR REPLACE INTO analysis_index
+            (public_id, analysis_type, table_name, row_id, natural_id, image_path, timestamp,
+             classification, patient_id, case_id, client)
+            SELECT ?, analysis_type, table_name, row_id, natural_id, image_path, timestamp,
+                   classification, patient_id, case_id, client
+            FROM analysis_index WHERE public_id = ? AND table_name = ?
+        ''', [alias, natural_id, table]))
+    return statements
+
+def lookup_analysis(conn: sqlite3.Connection, public_id: str) -> Optional[AnalysisRef]:
+    """Resolve a public ID through the index, falling back to the natural keys of unindexed rows"""
+    row = conn.execute('''
+        SELECT public_id, analysis_type, table_name, row_id, natural_id, image_path, timestamp
+        FROM analysis_index WHERE public_id = ?
+    ''', (public_id,)).fetchone()
+    if row:
+        return AnalysisRef(*row)
+
+    # Rows written before the index existed and not yet backfilled
+    for table, id_field in ID_COLUMNS.items():
+        if not _table_exists(conn, table):
+            continue
+        found = conn.execute(f'SELECT id, timestamp FROM {table} WHERE {id_field} = ?', (public_id,)).fetchone()
+        if found:
+            return AnalysisRef(public_id, ANALYSIS_TYPES[table], table, found[0], public_id, timestamp=found[1])
+    return None
+
+def _table_exists(conn: sqlite3.Connection, table: str) -> bool:
+    return conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)
+    ).fetchone() is not None
+
+def _existing_columns(conn: sqlite3.Connection, table: str) -> List[str]:
+    return [row[1] for row in conn.execute(f'PRAGMA table_info({table})')]
+
+def ensure_schema(conn: sqlite3.Connection, tables: Optional[List[str]] = None):
+    """
+    Add missing typed columns and indexes to the analysis tables
+
+    Cheap enough to run on every startup; backfilling old rows is left to
+    backfill() so startup never scans the tables.
+    """
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            table_name TEXT PRIMARY KEY,
+            version INTEGER,
+            last_id INTEGER,
+            target_id INTEGER,
+            started_at TEXT,
+            completed_at TEXT
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS analysis_index (
+            public_id TEXT PRIMARY KEY,
+            analysis_type TEXT,
+            table_name TEXT,
+            row_id INTEGER,
+            natural_id TEXT,
+            image_path TEXT,
+            timestamp TEXT
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_analysis_index_natural ON analysis_index(table_name, natural_id)')
+    # Public IDs moved to archive partitions by archive.py
+    conn.execute('CREATE TABLE IF NOT EXISTS archive_locator (public_id TEXT PRIMARY KEY, partition TEXT) WITHOUT ROWID')
+    existing = set(_existing_columns(conn, 'analysis_index'))
+    for column in INDEX_COLUMNS:
+        if column.name not in existing:
+            conn.execute(f'ALTER TABLE analysis_index ADD COLUMN {column.name} {column.sql_type}')
+    # History listing: newest first, public_id breaks timestamp ties for the keyset cursor
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_analysis_history ON analysis_index(timestamp, public_id)')
+    for name in ['analysis_type'] + [column.name for column in INDEX_COLUMNS]:
+        conn.execute(f'CREATE INDEX IF NOT EXISTS idx_analysis_history_{name} ON analysis_index({name}, timestamp, public_id)')
+    for table in tables or list(TYPED_COLUMNS):
+        if not _table_exists(conn, table):
+            continue
+        existing = set(_existing_columns(conn, table))
+        added = False
+        for column in TYPED_COLUMNS[table]:
+            if column.name not in existing:
+                conn.execute(f'ALTER TABLE {table} ADD COLUMN {column.name} {column.sql_type}')
+                added = True
+            if column.indexed:
+                conn.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_{column.name} ON {table}({column.name})')
+        conn.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_timestamp ON {table}(timestamp)')
+
+        row = conn.execute(
+            'SELECT version FROM schema_migrations WHERE table_name = ?', (table,)
+        ).fetchone()
+        if row is None or row[0] < SCHEMA_VERSION:
+            # Rows up to the current maximum predate the typed columns
+            target_id = conn.execute(f'SELECT COALESCE(MAX(id), 0) FROM {table}').fetchone()[0]
+            conn.execute('''
+                INSERT OR REPLACE INTO schema_migrations
+                (table_name, version, last_id, target_id, started_at, completed_at)
+                VALUES (?, ?, 0, ?, ?, ?)
+            ''', (table, SCHEMA_VERSION, target_id, datetime.datetime.now().isoformat(),
+                  None if target_id else datetime.datetime.now().isoformat()))
+        elif added:
+            print(f"⚠️ {table} gained typed columns after its migration finished - run a backfill")
+
+def backfill(conn: sqlite3.Connection,
+             tables: Optional[List[str]] = None,
+             batch_size: int = 500,
+             pause: float = 0.0,
+             progress: Optional[Callable[[str, int, int], None]] = None) -> Dict[str, int]:
+    """
+    Copy fields from the JSON documents into the typed columns
+
+    Each batch is one short transaction keyed on id, so writers are blocked
+    for one batch at most. pause sleeps between batches to leave room for
+    application traffic. Returns the number of rows updated per table.
+    """
+    ensure_schema(conn, tables)
+    conn.commit()
+    updated: Dict[str, int] = {}
+
+    for table in tables or list(TYPED_COLUMNS):
+        if not _table_exists(conn, table):
+            continue
+        row = conn.execute(
+            'SELECT last_id, target_id, completed_at FROM schema_migrations WHERE table_name = ?', (table,)
+        ).fetchone()
+        if row is None or row[2] is not None:
+            updated[table] = 0
+            continue
+
+        last_id, target_id = row[0], row[1]
+        names = typed_column_names(table)
+        assignments = ", ".join(f"{name} = ?" for name in names)
+        update_sql = f'UPDATE {table} SET {assignments} WHERE id = ?'
+        count = 0
+
+        while last_id < target_id:
+            rows = conn.execute(
+                f'SELECT id, data FROM {table} WHERE id > ? AND id <= ? ORDER BY id LIMIT ?',
+                (last_id, target_id, batch_size)
+            ).fetchall()
+            if not rows:
+                break
+
+            params = []
+            for row_id, data_json in rows:
+                try:
+                    data = json.loads(data_json) if data_json else {}
+                except json.JSONDecodeError:
+                    data = {}
+                values = typed_values(table, data)
+                params.append([values[name] for name in names] + [row_id])
+
+            last_id = rows[-1][0]
+            conn.executemany(update_sql, params)
+            _index_rows(conn, table, rows[0][0], last_id)
+            conn.execute('UPDATE schema_migrations SET last_id = ? WHERE table_name = ?', (last_id, table))
+            conn.commit()
+            count += len(rows)
+            if progress:
+                progress(table, last_id, target_id)
+            if pause:
+                time.sleep(pause)
+
+        conn.execute(
+            'UPDATE schema_migrations SET last_id = ?, completed_at = ? WHERE table_name = ?',
+            (target_id, datetime.datetime.now().isoformat(), table)
+        )
+        conn.commit()
+        updated[table] = count
+
+    # Aliases written before the listing columns existed
+    conn.execute('''
+        UPDATE analysis_index AS alias
+        SET classification = entry.classification, patient_id = entry.patient_id, case_id = entry.case_id
+        FROM analysis_index AS entry
+        WHERE entry.public_id = alias.natural_id AND alias.public_id != alias.natural_id
+          AND alias.classification IS NULL
+    ''')
+    conn.commit()
+
+    if _table_exists(conn, 'image_analyses'):
+        # Images stored before the index existed
+        conn.execute('''
+            UPDATE analysis_index SET image_path = (
+                SELECT image_path FROM image_analyses
+                WHERE sample_id = analysis_index.natural_id AND analysis_type = analysis_index.analysis_type
+                ORDER BY id DESC LIMIT 1
+            ) WHERE image_path IS NULL
+        ''')
+        conn.commit()
+        if 'llm_blob' in _existing_columns(conn, 'image_analyses'):
+            # Plain LLM text from before the blob store
+            updated['image_analyses'] = migrate_image_text(conn, batch_size)
+
+    return updated
+
+def _index_rows(conn: sqlite3.Connection, table: str, first_id: int, last_id: int):
+    """Index entries for rows written before analysis_index (or its listing columns) existed"""
+    id_field = ID_COLUMNS[table]
+    conn.execute(f'''
+        INSERT INTO analysis_index
+        (public_id, analysis_type, table_name, row_id, natural_id, timestamp, classification, patient_id, case_id)
+        SELECT {id_field}, ?, ?, id, {id_field}, timestamp, classification, patient_id, case_id FROM {table}
+        WHERE id >= ? AND id <= ? AND {id_field} IS NOT NULL
+        ON CONFLICT(public_id) DO UPDATE SET
+            classification = excluded.classification,
+            patient_id = excluded.patient_id,
+            case_id = excluded.case_id
+        WHERE analysis_index.row_id = excluded.row_id
+    ''', (ANALYSIS_TYPES[table], table, first_id, last_id))
+
+def migration_status(conn: sqlite3.Connection) -> Dict[str, Dict[str, Any]]:
+    """Backfill progress per table"""
+    ensure_schema(conn)
+    conn.commit()
+    status = {}
+    for table, version, last_id, target_id, started_at, completed_at in conn.execute(
+        'SELECT table_name, version, last_id, target_id, started_at, completed_at FROM schema_migrations'
+    ):
+        status[table] = {
+            'version': version,
+            'last_id': last_id,
+            'target_id': target_id,
+            'complete': completed_at is not None,
+            'started_at': started_at,
+            'completed_at': completed_at
+        }
+    return status
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Backfill typed columns of the FertiVision analysis tables")
+    parser.add_argument('db_path', nargs='?', default="reproductive_analysis.db")
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--pause', type=float, default=0.05, help="Seconds to sleep between batches")
+    parser.add_argument('--status', action='store_true', help="Show progress without migrating")
+    args = parser.parse_args(argv)
+
+    from database import get_pool
+
+    with get_pool(args.db_path).connection() as conn:
+        if args.status:
+            for table, info in migration_status(conn).items():
+                state = "✅ complete" if info['complete'] else f"⏳ {info['last_id']}/{info['target_id']}"
+                print(f"{table}: v{info['version']} {state}")
+            return 0
+
+        print(f"🔄 Migrating {args.db_path} to schema v{SCHEMA_VERSION}")
+        start = time.time()
+        updated = backfill(
+            conn,
+            batch_size=args.batch_size,
+            pause=args.pause,
+            progress=lambda table, done, total: print(f"   {table}: {done}/{total}")
+        )
+        for table, count in updated.items():
+            print(f"✅ {table}: {count} rows backfilled")
+        print(f"🎉 Migration finished in {time.time() - start:.1f}s")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -16,7 +16,7 @@ Features:
 © 2025 FertiVision powered by AI | Made by greybrain.ai
 """
 
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, request, jsonify, send_file, Response
 from werkzeug.utils import secure_filename
 import os
 import datetime
@@ -28,9 +28,18 @@ import time
 from functools import wraps
 import sqlite3
 from enhanced_reproductive_system import EnhancedReproductiveSystem
+from analysis_history import parse_history_args
+from batch_preprocessing import batch_preprocessor
 from config import Config
 import logging
 
+# Model service is optional - metrics endpoints report it as unavailable without it
+try:
+    from model_service import service_manager
+    MODEL_SERVICE_AVAILABLE = True
+except ImportError:
+    MODEL_SERVICE_AVAILABLE = False
+
 # Configure logging for API audit trail
 logging.basicConfig(
     level=logging.INFO,
@@ -45,10 +54,18 @@ logger = logging.getLogger('FertiVision-API')
 app = Flask(__name__)
 app.config['MAX_CONTENT_LENGTH'] = 50 * 1024 * 1024  # 50MB max file size for medical images
 
+# Fork the preprocessing pool while the process is still single-threaded
+batch_preprocessor.start()
+
 # Initialize FertiVision analysis system
 classifier = EnhancedReproductiveSystem(
+    db_path=Config.DATABASE_URL or Config.DATABASE_PATH,
     upload_folder="api_uploads",
-    mock_mode=True  # Can be configured per API key
+    mock_mode=True,  # Can be configured per API key
+    write_behind=Config.DATABASE_WRITE_BEHIND,
+    follicle_mode=Config.FOLLICLE_ANALYSIS_MODE,
+    ultrasound_mm_per_pixel=Config.ULTRASOUND_MM_PER_PIXEL,
+    sperm_video_microns_per_pixel=Config.SPERM_VIDEO_MICRONS_PER_PIXEL
 )
 
 # API Configuration
@@ -241,6 +258,30 @@ def health_check():
         'service': 'FertiVision API'
     })
 
+@app.route('/metrics', methods=['GET'])
+@require_api_key
+def prometheus_metrics():
+    """Prometheus metrics for model calls, cache, endpoint health and queues"""
+    if not MODEL_SERVICE_AVAILABLE:
+        return Response("# Model service not available\n", mimetype='text/plain')
+    return Response(service_manager.render_metrics(), mimetype='text/plain; version=0.0.4')
+
+@app.route(f'{API_BASE_URL}/metrics', methods=['GET'])
+@require_api_key
+def metrics_summary():
+    """JSON summary of model latency, errors, tokens and cost"""
+    if not MODEL_SERVICE_AVAILABLE:
+        return jsonify({
+            'success': False,
+            'error': 'Model service not available',
+            'code': 'SERVICE_UNAVAILABLE'
+        }), 503
+    return jsonify({
+        'success': True,
+        'metrics': service_manager.get_metrics_summary(),
+        'timestamp': datetime.datetime.now().isoformat()
+    })
+
 @app.route('/test', methods=['GET'])
 def api_test_interface():
     """Simple API testing interface"""
@@ -427,6 +468,7 @@ def api_info():
             'hysteroscopy_analysis': f'{API_BASE_URL}/analyze/hysteroscopy',
             'batch_analysis': f'{API_BASE_URL}/analyze/batch',
             'report_generation': f'{API_BASE_URL}/report/{{analysis_id}}',
+            'analysis_history': f'{API_BASE_URL}/history',
             'pdf_export': f'{API_BASE_URL}/export/pdf/{{analysis_id}}'
         }
     })
@@ -507,17 +549,65 @@ def batch_analyze_api():
 @app.route(f'{API_BASE_URL}/report/<analysis_id>', methods=['GET'])
 @require_api_key
 def get_analysis_report(analysis_id):
-    """Get detailed analysis report"""
+    """Get detailed analysis report for any analysis ID (API analysis_id or sample/oocyte/embryo/scan/procedure ID)"""
+    ref = classifier.resolve_analysis(analysis_id)
+    if ref is None:
+        return jsonify({
+            'success': False,
+            'error': f'No analysis found for ID: {analysis_id}',
+            'code': 'ANALYSIS_NOT_FOUND'
+        }), 404
+    
+    document = classifier.fetch_document(ref.table, ref.natural_id)
+    data = json.loads(document[0]) if document else {}
+    if ref.analysis_type in ('sperm', 'oocyte', 'embryo'):
+        summary = classifier.generate_enhanced_report(ref.analysis_type, ref.natural_id)
+    else:
+        summary = f"{ref.analysis_type.title()} analysis: {data.get('classification', 'N/A')}"
+    
     return jsonify({
         'success': True,
         'analysis_id': analysis_id,
+        'analysis_type': ref.analysis_type,
+        'record_id': ref.natural_id,
+        'timestamp': ref.timestamp,
+        'image_filename': os.path.basename(ref.image_path) if ref.image_path else None,
         'report': {
-            'summary': 'Detailed medical analysis report',
-            'recommendations': ['Clinical recommendation 1', 'Clinical recommendation 2'],
-            'technical_details': {'parameter1': 'value1', 'parameter2': 'value2'}
+            'summary': summary,
+            'classification': data.get('classification'),
+            'technical_details': data
         }
     })
 
+@app.route(f'{API_BASE_URL}/history', methods=['GET'])
+@require_api_key
+def analysis_history_api():
+    """
+    List the client's past analyses, newest first
+
+    Query: type, date_from, date_to, classification, patient_id, case_id,
+    fields (comma separated), limit (max 500), cursor (next_cursor of the
+    previous page)
+    """
+    client_info = request.client_info
+    try:
+        filters, cursor, limit, fields = parse_history_args(request.args)
+        # API clients only see their own analyses
+        filters.client = client_info['client_name']
+        page = classifier.history(filters, cursor=cursor, limit=limit, fields=fields)
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'error': str(e),
+            'code': 'INVALID_QUERY'
+        }), 400
+    
+    return jsonify({
+        'success': True,
+        'count': len(page['items']),
+        **page
+    })
+
 @app.route(f'{API_BASE_URL}/export/pdf/<analysis_id>', methods=['GET'])
 @require_api_key
 def export_pdf_report(analysis_id):
@@ -591,7 +681,9 @@ def analyze_image_api(analysis_type):
         
         # Perform analysis based on type
         if analysis_type == 'sperm':
-            result = classifier.analyze_sperm_with_image(filepath)
+            result = classifier.analyze_sperm_with_image(filepath, patient_id=patient_id, case_id=case_id,
+                                                         analysis_id=analysis_id, client=client_info['client_name'],
+                                                         microns_per_pixel=request.form.get('microns_per_pixel'))
             response_data = {
                 'analysis_id': analysis_id,
                 'analysis_type': 'sperm',
@@ -606,7 +698,8 @@ def analyze_image_api(analysis_type):
             }
             
         elif analysis_type == 'oocyte':
-            result = classifier.analyze_oocyte_with_image(filepath)
+            result = classifier.analyze_oocyte_with_image(filepath, patient_id=patient_id, case_id=case_id,
+                                                          analysis_id=analysis_id, client=client_info['client_name'])
             response_data = {
                 'analysis_id': analysis_id,
                 'analysis_type': 'oocyte',
@@ -620,7 +713,8 @@ def analyze_image_api(analysis_type):
             
         elif analysis_type == 'embryo':
             day = int(request.form.get('day', 3))
-            result = classifier.analyze_embryo_with_image(filepath, day)
+            result = classifier.analyze_embryo_with_image(filepath, day, patient_id=patient_id, case_id=case_id,
+                                                          analysis_id=analysis_id, client=client_info['client_name'])
 
             # Convert enum values to strings for JSON serialization
             grade_value = getattr(result, 'grade', None)
@@ -644,9 +738,13 @@ def analyze_image_api(analysis_type):
             
         elif analysis_type in ['follicle', 'hysteroscopy']:
             if analysis_type == 'follicle':
-                result = classifier.analyze_follicle_scan_with_image(filepath)
+                result = classifier.analyze_follicle_scan_with_image(filepath, patient_id=patient_id, case_id=case_id,
+                                                                     analysis_id=analysis_id, client=client_info['client_name'],
+                                                                     mm_per_pixel=request.form.get('mm_per_pixel'),
+                                                                     narrative=request.form.get('narrative'))
             else:
-                result = classifier.analyze_hysteroscopy_with_image(filepath)
+                result = classifier.analyze_hysteroscopy_with_image(filepath, patient_id=patient_id, case_id=case_id,
+                                                                    analysis_id=analysis_id, client=client_info['client_name'])
             
             if result.get('success'):
                 analysis_result = result.get('result')
@@ -1,4 +1,4 @@
-from flask import Flask, render_template, request, jsonify, redirect, url_for, send_file, flash, session, session
+from flask import Flask, render_template, request, jsonify, redirect, url_for, send_file, flash, session, session, Response
 from werkzeug.utils import secure_filename
 import os
 import datetime
@@ -9,6 +9,9 @@ from enhanced_reproductive_system import EnhancedReproductiveSystem
 from reproductive_classification_system import OocyteMaturity
 from config import Config, MedicalDiscipline, AnalysisMode
 from pdf_export import PDFReportGenerator
+from analysis_history import parse_history_args
+from backup import BackupScheduler
+from batch_preprocessing import batch_preprocessor
 from auth import BasicAuth
 
 # Import model configuration system
@@ -62,12 +65,31 @@ except ImportError:
     # For older Flask versions
     app.json_encoder = CustomJSONEncoder
 
+# Fork the preprocessing pool while the process is still single-threaded
+batch_preprocessor.start()
+
 # Initialize enhanced system with AI capabilities
 classifier = EnhancedReproductiveSystem(
+    db_path=Config.DATABASE_URL or Config.DATABASE_PATH,
     upload_folder=app.config['UPLOAD_FOLDER'],
-    mock_mode=(Config.ANALYSIS_MODE == AnalysisMode.MOCK)
+    mock_mode=(Config.ANALYSIS_MODE == AnalysisMode.MOCK),
+    write_behind=Config.DATABASE_WRITE_BEHIND,
+    follicle_mode=Config.FOLLICLE_ANALYSIS_MODE,
+    ultrasound_mm_per_pixel=Config.ULTRASOUND_MM_PER_PIXEL,
+    sperm_video_microns_per_pixel=Config.SPERM_VIDEO_MICRONS_PER_PIXEL
 )
 
+# Periodic online backups of the analysis database (PostgreSQL is backed up server-side)
+backup_scheduler = None
+if Config.BACKUP_DATABASE and classifier.storage.backend == "sqlite":
+    backup_scheduler = BackupScheduler(
+        classifier.db_path,
+        backup_dir=Config.BACKUP_FOLDER,
+        interval_hours=Config.AUTO_BACKUP_INTERVAL,
+        retention=Config.BACKUP_RETENTION
+    )
+    backup_scheduler.start()
+
 def serialize_analysis(analysis):
     """Convert analysis object to JSON-serializable dict"""
     result = {}
@@ -287,8 +309,14 @@ def analyze_embryo():
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
+@app.route('/report/<analysis_id>', defaults={'analysis_type': None})
 @app.route('/report/<analysis_type>/<analysis_id>')
 def get_report(analysis_type, analysis_id):
+    if analysis_type is None:
+        ref = classifier.resolve_analysis(analysis_id)
+        if ref is None:
+            return jsonify({'report': f"No analysis found for ID: {analysis_id}"}), 404
+        analysis_type, analysis_id = ref.analysis_type, ref.natural_id
     report = classifier.generate_report(analysis_type, analysis_id)
     return jsonify({'report': report})
 
@@ -300,11 +328,7 @@ def get_enhanced_report(analysis_type, analysis_id):
             # Use ultrasound-specific report generation with real data
             if analysis_type == 'follicle':
                 # Get actual follicle analysis data from database
-                conn = sqlite3.connect(classifier.db_path)
-                cursor = conn.cursor()
-                cursor.execute('SELECT data, timestamp FROM follicle_analyses WHERE scan_id = ?', (analysis_id,))
-                result = cursor.fetchone()
-                conn.close()
+                result = classifier.fetch_document('follicle_analyses', analysis_id)
                 
                 if result:
                     data = json.loads(result[0])
@@ -380,11 +404,7 @@ Please ensure the analysis was completed successfully.
 """
             else:  # hysteroscopy
                 # Get actual hysteroscopy analysis data from database
-                conn = sqlite3.connect(classifier.db_path)
-                cursor = conn.cursor()
-                cursor.execute('SELECT data, timestamp FROM hysteroscopy_analyses WHERE procedure_id = ?', (analysis_id,))
-                result = cursor.fetchone()
-                conn.close()
+                result = classifier.fetch_document('hysteroscopy_analyses', analysis_id)
                 
                 if result:
                     data = json.loads(result[0])
@@ -639,15 +659,17 @@ def analyze_hysteroscopy():
         return jsonify({'success': False, 'error': str(e)})
 
 # PDF Export Routes
+@app.route('/export_pdf/<analysis_id>', defaults={'analysis_type': None})
 @app.route('/export_pdf/<analysis_type>/<analysis_id>')
 @auth.require_auth
 def export_pdf(analysis_type, analysis_id):
     """Export analysis results as PDF"""
     try:
-        # Get analysis data from database
+        # Get analysis data from database; the type is resolved from the ID when not given
         analysis_data = classifier.get_analysis_by_id(analysis_type, analysis_id)
         if not analysis_data:
             return jsonify({'success': False, 'error': 'Analysis not found'})
+        analysis_type = analysis_data['analysis_type']
         
         # Generate PDF
         pdf_path = pdf_generator.generate_report(analysis_type, analysis_data)
@@ -750,13 +772,52 @@ def system_status():
                 'medical': f"{Config.MAX_MEDICAL_SIZE}MB"
             },
             'authentication': Config.ENABLE_AUTH,
-            'pdf_export': Config.ENABLE_PDF_EXPORT
+            'pdf_export': Config.ENABLE_PDF_EXPORT,
+            'database_backup': backup_scheduler.status() if backup_scheduler else {'enabled': False}
         }
         
         return jsonify({'success': True, 'status': status})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
+# Model telemetry
+@app.route('/metrics')
+@auth.require_auth
+def metrics():
+    """Prometheus metrics for model calls, cache, endpoint health and queues"""
+    if not MODEL_CONFIG_AVAILABLE:
+        return Response("# Model service not available\n", mimetype='text/plain')
+    return Response(service_manager.render_metrics(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/metrics')
+@auth.require_auth
+def metrics_summary():
+    """JSON summary of model latency, errors, tokens and cost"""
+    if not MODEL_CONFIG_AVAILABLE:
+        return jsonify({'success': False, 'error': 'Model configuration system not available'})
+    try:
+        return jsonify({'success': True, 'metrics': service_manager.get_metrics_summary()})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+# Analysis history
+@app.route('/api/history')
+@auth.require_auth
+def analysis_history():
+    """
+    Past analyses of every type, newest first
+
+    Query: type, date_from, date_to, classification, patient_id, case_id,
+    client, fields (comma separated), limit, cursor (next_cursor of the
+    previous page)
+    """
+    try:
+        filters, cursor, limit, fields = parse_history_args(request.args)
+        page = classifier.history(filters, cursor=cursor, limit=limit, fields=fields)
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    return jsonify({'success': True, **page})
+
 # Switch Analysis Mode
 @app.route('/switch_mode/<mode>')
 @auth.require_auth
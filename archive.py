@@ -0,0 +1,365 @@
+#!/usr/bin/env python3
+"""
+FertiVision powered by AI - Analysis Archive
+
+Moves analyses older than a retention window out of the live database into
+monthly partition files (`analyses_YYYY_MM.db`), so the live tables and
+their indexes only hold recent analyses and stay cache-resident.
+
+Partitions are SQLite files with the live schema: analysis rows keep their
+row ids and typed columns, their JSON document is compressed (zstd or zlib,
+see blob_store), and their analysis_index entries, image rows and LLM text
+blobs move with them. The application opens partitions read-only; only this
+job writes them.
+
+Each batch is written to its partition and committed before it is deleted
+from the live database, so an interrupted run leaves at worst a row in
+both places and the next run finishes it. `archive_locator` in the live
+database maps each archived public ID to its partition, so archived IDs
+still resolve with one lookup.
+
+Usage:
+    python archive.py [db_path] [--days 90] [--archive-dir DIR] [--batch-size 500] [--vacuum]
+
+© 2025 FertiVision powered by AI (made by greybrain.ai) - DeepSeek LLM Image Analysis
+"""
+
+import os
+import re
+import sys
+import sqlite3
+import argparse
+import datetime
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Any, Tuple, Iterator, Callable
+
+from analysis_schema import ensure_schema, ID_COLUMNS, ANALYSIS_TYPES, AnalysisRef
+from blob_store import compress, decompress, read_blob, release_statements
+
+# Analyses older than this many days are archived
+ARCHIVE_AFTER_DAYS = 90
+
+# Rows moved per transaction
+ARCHIVE_BATCH_SIZE = 500
+
+_PARTITION_PATTERN = re.compile(r'^analyses_(\d{4})_(\d{2})\.db$')
+
+def default_archive_dir(db_path: str) -> str:
+    """Archive folder next to the database: reproductive_analysis.db -> reproductive_analysis_archive/"""
+    return os.path.splitext(db_path)[0] + "_archive"
+
+@dataclass(frozen=True)
+class Partition:
+    """One month of archived analyses"""
+    name: str
+    path: str
+    start: str  # first possible timestamp (inclusive)
+    end: str    # first timestamp of the next month (exclusive)
+
+def _partition(archive_dir: str, year: int, month: int) -> Partition:
+    next_year, next_month = (year + 1, 1) if month == 12 else (year, month + 1)
+    name = f"analyses_{year:04d}_{month:02d}.db"
+    return Partition(name, os.path.join(archive_dir, name),
+                     f"{year:04d}-{month:02d}-01T00:00:00", f"{next_year:04d}-{next_month:02d}-01T00:00:00")
+
+class ArchiveReader:
+    """Read-only access to the partitions of one database"""
+
+    def __init__(self, archive_dir: str):
+        self.archive_dir = archive_dir
+        self._connections: Dict[str, sqlite3.Connection] = {}
+        self._locks: Dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def partitions(self) -> List[Partition]:
+        """Existing partitions, newest month first"""
+        if not os.path.isdir(self.archive_dir):
+            return []
+        found = []
+        for name in os.listdir(self.archive_dir):
+            match = _PARTITION_PATTERN.match(name)
+            if match:
+                found.append(_partition(self.archive_dir, int(match.group(1)), int(match.group(2))))
+        return sorted(found, key=lambda partition: partition.start, reverse=True)
+
+    def _partition_by_name(self, name: str) -> Optional[Partition]:
+        match = _PARTITION_PATTERN.match(name)
+        if not match:
+            return None
+        partition = _partition(self.archive_dir, int(match.group(1)), int(match.group(2)))
+        return partition if os.path.exists(partition.path) else None
+
+    @contextmanager
+    def connection(self, partition: Partition) -> Iterator[sqlite3.Connection]:
+        """Read-only connection to a partition, one user at a time"""
+        with self._lock:
+            conn = self._connections.get(partition.name)
+            if conn is None:
+                conn = sqlite3.connect(f"file:{partition.path}?mode=ro", uri=True, check_same_thread=False, timeout=5)
+                self._connections[partition.name] = conn
+                self._locks[partition.name] = threading.Lock()
+            lock = self._locks[partition.name]
+        with lock:
+            yield conn
+
+    def lookup(self, live: sqlite3.Connection, public_id: str) -> Optional[AnalysisRef]:
+        """Resolve an archived public ID through archive_locator"""
+        row = live.execute('SELECT partition FROM archive_locator WHERE public_id = ?', (public_id,)).fetchone()
+        partition = self._partition_by_name(row[0]) if row else None
+        if partition is None:
+            return None
+        with self.connection(partition) as conn:
+            found = conn.execute('''
+                SELECT public_id, analysis_type, table_name, row_id, natural_id, image_path, timestamp
+                FROM analysis_index WHERE public_id = ?
+            ''', (public_id,)).fetchone()
+            if found:
+                return AnalysisRef(*found, partition=partition.name)
+            # Archived before it was indexed
+            for table, id_field in ID_COLUMNS.items():
+                if not _table_exists(conn, table):
+                    continue
+                row = conn.execute(f'SELECT id, timestamp FROM {table} WHERE {id_field} = ?', (public_id,)).fetchone()
+                if row:
+                    return AnalysisRef(public_id, ANALYSIS_TYPES[table], table, row[0], public_id,
+                                       timestamp=row[1], partition=partition.name)
+        return None
+
+    def fetch_row(self, ref: AnalysisRef) -> Optional[Dict[str, Any]]:
+        """Full archived row with its JSON document decompressed into `data`"""
+        partition = self._partition_by_name(ref.partition)
+        if partition is None:
+            return None
+        with self.connection(partition) as conn:
+            cursor = conn.execute(f'SELECT * FROM {ref.table} WHERE id = ?', (ref.row_id,))
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            record = dict(zip([description[0] for description in cursor.description], row))
+        record['data'] = decode_document(record.pop('codec', None), record.get('data'))
+        return record
+
+    def fetch_document(self, live: sqlite3.Connection, table: str, natural_id: str) -> Optional[Tuple[str, str]]:
+        """(data JSON, timestamp) of an archived analysis"""
+        ref = self.lookup(live, natural_id)
+        if ref is None or ref.table != table:
+            return None
+        record = self.fetch_row(ref)
+        return (record['data'], record['timestamp']) if record else None
+
+    def fetch_image(self, live: sqlite3.Connection, sample_id: str, analysis_type: str) -> Optional[Tuple[str, str]]:
+        """(image path, LLM text) of an archived analysis"""
+        ref = self.lookup(live, sample_id)
+        if ref is None or ref.analysis_type != analysis_type:
+            return None
+        with self.connection(self._partition_by_name(ref.partition)) as conn:
+            if not _table_exists(conn, 'image_analyses'):
+                return None
+            row = conn.execute('''
+                SELECT image_path, llm_analysis, llm_blob FROM image_analyses
+                WHERE sample_id = ? AND analysis_type = ? ORDER BY id DESC LIMIT 1
+            ''', (ref.natural_id, analysis_type)).fetchone()
+            if row is None:
+                return None
+            image_path, text, blob = row
+            if text is None and blob:
+                text = read_blob(conn, blob)
+        return image_path, text
+
+    def close(self):
+        with self._lock:
+            for conn in self._connections.values():
+                conn.close()
+            self._connections.clear()
+            self._locks.clear()
+
+def decode_document(codec: Optional[str], data: Any) -> Optional[str]:
+    """JSON text of a document stored by the archive job (or plain text)"""
+    if data is None or codec is None:
+        return data
+    return decompress(codec, data)
+
+def _table_exists(conn: sqlite3.Connection, table: str) -> bool:
+    return conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)
+    ).fetchone() is not None
+
+def _columns(conn: sqlite3.Connection, table: str) -> List[str]:
+    return [row[1] for row in conn.execute(f'PRAGMA table_info({table})')]
+
+# Tables a partition copies from the live schema
+_PARTITION_TABLES = list(ID_COLUMNS) + ['image_analyses', 'llm_blobs', 'analysis_index']
+
+def _open_partition_for_write(live: sqlite3.Connection, partition: Partition) -> sqlite3.Connection:
+    """Create or open a partition with the current live schema"""
+    os.makedirs(os.path.dirname(partition.path) or ".", exist_ok=True)
+    conn = sqlite3.connect(partition.path)
+    for table in _PARTITION_TABLES:
+        row = live.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone()
+        if row is None:
+            continue
+        if not _table_exists(conn, table):
+            conn.execute(row[0])
+        # Columns added to the live table since the partition was created
+        existing = set(_columns(conn, table))
+        for name, sql_type in [(info[1], info[2]) for info in live.execute(f'PRAGMA table_info({table})')]:
+            if name not in existing:
+                conn.execute(f'ALTER TABLE {table} ADD COLUMN {name} {sql_type}')
+        if table in ID_COLUMNS and 'codec' not in existing:
+            conn.execute(f'ALTER TABLE {table} ADD COLUMN codec TEXT')
+        for (index_sql,) in live.execute(
+            "SELECT sql FROM sqlite_master WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL", (table,)
+        ):
+            conn.execute(index_sql.replace("CREATE INDEX", "CREATE INDEX IF NOT EXISTS", 1))
+    conn.commit()
+    return conn
+
+def _insert_rows(conn: sqlite3.Connection, table: str, columns: List[str], rows: List[tuple]):
+    if rows:
+        conn.executemany(
+            f'INSERT OR REPLACE INTO {table} ({", ".join(columns)}) VALUES ({", ".join("?" for _ in columns)})',
+            rows
+        )
+
+def _placeholders(count: int) -> str:
+    return ", ".join("?" for _ in range(count))
+
+def archive_analyses(live: sqlite3.Connection,
+                     archive_dir: str,
+                     older_than_days: int = ARCHIVE_AFTER_DAYS,
+                     batch_size: int = ARCHIVE_BATCH_SIZE,
+                     now: Optional[datetime.datetime] = None,
+                     progress: Optional[Callable[[str, int], None]] = None) -> Dict[str, int]:
+    """
+    Move analyses older than older_than_days into monthly partitions
+
+    Returns the number of analyses archived per table.
+    """
+    cutoff = ((now or datetime.datetime.now()) - datetime.timedelta(days=older_than_days)).isoformat()
+    ensure_schema(live)
+    live.commit()
+    has_images = _table_exists(live, 'image_analyses')
+    archived: Dict[str, int] = {}
+
+    for table, id_field in ID_COLUMNS.items():
+        if not _table_exists(live, table):
+            continue
+        analysis_type = ANALYSIS_TYPES[table]
+        columns = _columns(live, table)
+        data_position = columns.index('data')
+        count = 0
+
+        while True:
+            rows = live.execute(
+                f'''
+                    SELECT {", ".join(columns)} FROM {table}
+                    WHERE timestamp < ? AND timestamp GLOB '[0-9][0-9][0-9][0-9]-[0-9][0-9]*'
+                    ORDER BY timestamp LIMIT ?
+                ''',
+                (cutoff, batch_size)
+            ).fetchall()
+            if not rows:
+                break
+
+            by_month: Dict[Tuple[int, int], List[tuple]] = {}
+            for row in rows:
+                timestamp = row[columns.index('timestamp')]
+                by_month.setdefault((int(timestamp[:4]), int(timestamp[5:7])), []).append(row)
+
+            locators: List[Tuple[str, str]] = []
+            image_rows: List[tuple] = []
+            for (year, month), month_rows in by_month.items():
+                partition = _partition(archive_dir, year, month)
+                natural_ids = [row[columns.index(id_field)] for row in month_rows]
+                part = _open_partition_for_write(live, partition)
+                try:
+                    # Analysis rows with their JSON document compressed
+                    encoded = []
+                    for row in month_rows:
+                        codec, payload = compress(row[data_position] or "")
+                        encoded.append(row[:data_position] + (payload,) + row[data_position + 1:] + (codec,))
+                    _insert_rows(part, table, columns + ['codec'], encoded)
+
+                    index_columns = _columns(live, 'analysis_index')
+                    entries = live.execute(f'''
+                        SELECT {", ".join(index_columns)} FROM analysis_index
+                        WHERE table_name = ? AND natural_id IN ({_placeholders(len(natural_ids))})
+                    ''', [table] + natural_ids).fetchall()
+                    _insert_rows(part, 'analysis_index', index_columns, entries)
+                    public_ids = {entry[0] for entry in entries} | set(natural_ids)
+                    locators.extend((public_id, partition.name) for public_id in public_ids)
+
+                    if has_images:
+                        image_columns = _columns(live, 'image_analyses')
+                        images = live.execute(f'''
+                            SELECT {", ".join(image_columns)} FROM image_analyses
+                            WHERE analysis_type = ? AND sample_id IN ({_placeholders(len(natural_ids))})
+                        ''', [analysis_type] + natural_ids).fetchall()
+                        _insert_rows(part, 'image_analyses', image_columns, images)
+                        blob_position = image_columns.index('llm_blob') if 'llm_blob' in image_columns else None
+                        hashes = sorted({image[blob_position] for image in images
+                                         if blob_position is not None and image[blob_position]})
+                        if hashes:
+                            blobs = live.execute(f'''
+                                SELECT hash, codec, size, data, 1 FROM llm_blobs
+                                WHERE hash IN ({_placeholders(len(hashes))})
+                            ''', hashes).fetchall()
+                            part.executemany('INSERT OR IGNORE INTO llm_blobs (hash, codec, size, data, refcount) VALUES (?, ?, ?, ?, ?)', blobs)
+                        image_rows.extend((image[0], image[blob_position] if blob_position is not None else None)
+                                          for image in images)
+                    part.commit()
+                finally:
+                    part.close()
+
+            # Partitions are committed; now drop the rows from the live database
+            row_ids = [row[columns.index('id')] for row in rows]
+            natural_ids = [row[columns.index(id_field)] for row in rows]
+            live.executemany('INSERT OR REPLACE INTO archive_locator (public_id, partition) VALUES (?, ?)', locators)
+            live.execute(f'DELETE FROM {table} WHERE id IN ({_placeholders(len(row_ids))})', row_ids)
+            live.execute(f'''
+                DELETE FROM analysis_index WHERE table_name = ? AND natural_id IN ({_placeholders(len(natural_ids))})
+            ''', [table] + natural_ids)
+            for image_id, blob in image_rows:
+                live.execute('DELETE FROM image_analyses WHERE id = ?', (image_id,))
+                if blob:
+                    for sql, params in release_statements(blob):
+                        live.execute(sql, params)
+            live.commit()
+
+            count += len(rows)
+            if progress:
+                progress(table, count)
+        archived[table] = count
+
+    return archived
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Archive old FertiVision analyses into monthly partitions")
+    parser.add_argument('db_path', nargs='?', default="reproductive_analysis.db")
+    parser.add_argument('--days', type=int, default=ARCHIVE_AFTER_DAYS, help="Archive analyses older than this")
+    parser.add_argument('--archive-dir', default=None, help="Partition folder (default: <db name>_archive)")
+    parser.add_argument('--batch-size', type=int, default=ARCHIVE_BATCH_SIZE)
+    parser.add_argument('--vacuum', action='store_true', help="Shrink the live database file afterwards")
+    args = parser.parse_args(argv)
+
+    from database import get_pool
+
+    archive_dir = args.archive_dir or default_archive_dir(args.db_path)
+    print(f"📦 Archiving analyses older than {args.days} days from {args.db_path} into {archive_dir}")
+    with get_pool(args.db_path).connection() as conn:
+        archived = archive_analyses(
+            conn, archive_dir, args.days, args.batch_size,
+            progress=lambda table, done: print(f"   {table}: {done}")
+        )
+        for table, count in archived.items():
+            print(f"✅ {table}: {count} analyses archived")
+        if args.vacuum:
+            conn.commit()
+            conn.execute('VACUUM')
+            print("🧹 Live database vacuumed")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+"""
+FertiVision powered by AI - Online Database Backup
+
+Backs up the analysis database while the application keeps serving
+requests, using the SQLite online backup API a few pages at a time with a
+short pause between steps. The backup connection holds one WAL read
+snapshot for the whole copy, so writers are never blocked and concurrent
+writes do not restart the copy; the backup is the database as of the
+moment it started.
+
+Each backup is written to a temporary file, checked with
+`PRAGMA integrity_check`, and only then renamed into place as
+`<db name>_YYYYmmdd_HHMMSS.db`; the newest `retention` backups are kept.
+
+BackupScheduler runs this every Config.AUTO_BACKUP_INTERVAL hours on a
+background thread when Config.BACKUP_DATABASE is set; status() feeds
+/system_status.
+
+Usage:
+    python backup.py [db_path] [--backup-dir backups] [--retention 7]
+
+© 2025 FertiVision powered by AI (made by greybrain.ai) - DeepSeek LLM Image Analysis
+"""
+
+import os
+import re
+import sys
+import time
+import sqlite3
+import argparse
+import datetime
+import threading
+from dataclasses import dataclass, asdict
+from typing import Dict, List, Optional, Any
+
+# Pages copied per step (4 KiB pages: 512 KiB per step)
+PAGES_PER_STEP = 128
+
+# Pause between steps so request threads get the disk and the GIL (seconds)
+STEP_PAUSE = 0.005
+
+# Backups kept by rotation
+BACKUP_RETENTION = 7
+
+# Wait after startup before the first backup is due (seconds)
+STARTUP_DELAY = 60
+
+@dataclass
+class BackupResult:
+    """Outcome of one backup run"""
+    path: Optional[str]
+    started: str
+    duration: float
+    pages: int = 0
+    size: int = 0
+    verified: bool = False
+    error: Optional[str] = None
+
+def _backup_pattern(db_path: str):
+    name = re.escape(os.path.splitext(os.path.basename(db_path))[0])
+    return re.compile(rf'^{name}_(\d{{8}}_\d{{6}})\.db$')
+
+def list_backups(db_path: str, backup_dir: str) -> List[str]:
+    """Backup files of a database, newest first"""
+    if not os.path.isdir(backup_dir):
+        return []
+    pattern = _backup_pattern(db_path)
+    names = [name for name in os.listdir(backup_dir) if pattern.match(name)]
+    return [os.path.join(backup_dir, name) for name in sorted(names, reverse=True)]
+
+def verify_backup(path: str) -> Optional[str]:
+    """None when the backup passes integrity_check, else the first problem"""
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        result = conn.execute('PRAGMA integrity_check').fetchone()[0]
+        return None if result == 'ok' else result
+    finally:
+        conn.close()
+
+def backup_database(db_path: str,
+                    backup_dir: str,
+                    pages_per_step: int = PAGES_PER_STEP,
+                    step_pause: float = STEP_PAUSE,
+                    retention: int = BACKUP_RETENTION) -> BackupResult:
+    """Copy, verify and rotate one backup; never raises for backup failures"""
+    started = datetime.datetime.now()
+    start = time.time()
+    stamp = started.strftime('%Y%m%d_%H%M%S')
+    final_path = os.path.join(backup_dir, f"{os.path.splitext(os.path.basename(db_path))[0]}_{stamp}.db")
+    temp_path = final_path + ".tmp"
+    result = BackupResult(None, started.isoformat(), 0.0)
+
+    try:
+        os.makedirs(backup_dir, exist_ok=True)
+        source = sqlite3.connect(db_path, timeout=5)
+        target = sqlite3.connect(temp_path)
+        try:
+            # One read snapshot for the whole copy: writers carry on in the WAL
+            # and the backup does not restart when they commit
+            source.execute('BEGIN')
+            source.execute('SELECT COUNT(*) FROM sqlite_master').fetchone()
+
+            def pause(status, remaining, total):
+                result.pages = total
+                if remaining:
+                    time.sleep(step_pause)
+
+            source.backup(target, pages=pages_per_step, progress=pause)
+            source.rollback()
+            # A single self-contained file
+            target.execute('PRAGMA journal_mode=DELETE')
+        finally:
+            target.close()
+            source.close()
+
+        problem = verify_backup(temp_path)
+        if problem:
+            raise sqlite3.DatabaseError(f"integrity_check failed: {problem}")
+        os.replace(temp_path, final_path)
+        result.path = final_path
+        result.size = os.path.getsize(final_path)
+        result.verified = True
+
+        for old in list_backups(db_path, backup_dir)[retention:]:
+            os.remove(old)
+    except (sqlite3.Error, OSError) as e:
+        result.error = str(e)
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+    result.duration = round(time.time() - start, 3)
+    return result
+
+class BackupScheduler:
+    """Periodic online backups on a background thread"""
+
+    def __init__(self,
+                 db_path: str,
+                 backup_dir: str = "backups",
+                 interval_hours: float = 24,
+                 retention: int = BACKUP_RETENTION,
+                 pages_per_step: int = PAGES_PER_STEP,
+                 step_pause: float = STEP_PAUSE,
+                 startup_delay: float = STARTUP_DELAY):
+        self.db_path = db_path
+        self.backup_dir = backup_dir
+        self.interval = interval_hours * 3600
+        self.retention = retention
+        self.pages_per_step = pages_per_step
+        self.step_pause = step_pause
+        self.startup_delay = startup_delay
+        self.last_result: Optional[BackupResult] = None
+        self.next_backup: Optional[float] = None
+        self._run_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self.next_backup = self._first_due()
+        self._thread = threading.Thread(target=self._run, name="fertivision-backup", daemon=True)
+        self._thread.start()
+        print(f"💾 Database backups every {self.interval / 3600:g}h into {self.backup_dir}")
+
+    def _first_due(self) -> float:
+        # An existing recent backup counts, so restarts do not trigger extra backups
+        earliest = time.time() + self.startup_delay
+        backups = list_backups(self.db_path, self.backup_dir)
+        if backups:
+            return max(earliest, os.path.getmtime(backups[0]) + self.interval)
+        return earliest
+
+    def _run(self):
+        while not self._stop.wait(max(0.0, self.next_backup - time.time())):
+            self.run_backup()
+
+    def run_backup(self) -> BackupResult:
+        """Back up now (also used by the scheduler thread)"""
+        with self._run_lock:
+            result = backup_database(self.db_path, self.backup_dir, self.pages_per_step,
+                                     self.step_pause, self.retention)
+            self.last_result = result
+            self.next_backup = time.time() + self.interval
+        if result.error:
+            print(f"❌ Database backup failed: {result.error}")
+        else:
+            print(f"💾 Database backed up to {result.path} ({result.size} bytes, {result.duration}s)")
+        return result
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def status(self) -> Dict[str, Any]:
+        backups = list_backups(self.db_path, self.backup_dir)
+        return {
+            'enabled': True,
+            'interval_hours': self.interval / 3600,
+            'retention': self.retention,
+            'backup_dir': self.backup_dir,
+            'backups': len(backups),
+            'latest_file': os.path.basename(backups[0]) if backups else None,
+            'last_backup': asdict(self.last_result) if self.last_result else None,
+            'next_backup': datetime.datetime.fromtimestamp(self.next_backup).isoformat() if self.next_backup else None
+        }
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Online backup of the FertiVision analysis database")
+    parser.add_argument('db_path', nargs='?', default="reproductive_analysis.db")
+    parser.add_argument('--backup-dir', default="backups")
+    parser.add_argument('--retention', type=int, default=BACKUP_RETENTION)
+    parser.add_argument('--pages-per-step', type=int, default=PAGES_PER_STEP)
+    args = parser.parse_args(argv)
+
+    result = backup_database(args.db_path, args.backup_dir, args.pages_per_step, retention=args.retention)
+    if result.error:
+        print(f"❌ Backup failed: {result.error}")
+        return 1
+    print(f"✅ Backed up {result.pages} pages to {result.path} in {result.duration}s (integrity_check ok)")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,220 @@
+"""
+FertiVision powered by AI - Batch Image Preprocessing
+
+Preprocesses a batch of uploads on a pool of worker processes, so batch
+uploads use every core instead of enhancing one image at a time on the
+request thread (OpenCV only releases the GIL for parts of the work).
+
+Image bytes never go through pickle: the parent copies the batch's source
+images into one shared memory block, each worker decodes its slice straight
+from that block, enhances it and writes the encoded result into a shared
+memory block of its own. Only offsets and block names cross the process
+boundary. Results come back in input order.
+
+Cached variants (see preprocess_cache) are served without touching the pool,
+identical images in a batch are processed once, and batches with a single
+image left to process run inline.
+
+Workers are forked, so nothing is re-imported in them (app.py and
+api_server.py set up the database, write-behind queue and services at import
+time, which spawn/forkserver workers would repeat). Forking is only safe
+while the process has a single thread, so the pool is started once at
+startup with start(), before any background thread, and kept for the life of
+the process. If threads are already running when a batch first needs the
+pool, or the platform cannot fork, batches are processed in-process instead.
+Set FERTIVISION_PREPROCESS_WORKERS to size the pool (default: CPU count).
+
+Usage:
+    batch_preprocessor.start()  # At startup, before any thread
+    payloads = preprocess_many(image_paths, "follicle")
+
+© 2025 FertiVision powered by AI (made by greybrain.ai) - DeepSeek LLM Image Analysis
+"""
+
+import os
+import atexit
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from typing import Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from image_payload import ImagePayload
+from preprocess_cache import PreprocessCache
+import image_preprocessing
+from image_preprocessing import ENHANCERS, DEBUG_DIR, cache_key, decode_image, encode_buffer, encode_image, deliver
+
+DEFAULT_WORKERS = int(os.getenv('FERTIVISION_PREPROCESS_WORKERS', '0')) or os.cpu_count() or 1
+
+def _init_worker():
+    # One OpenCV thread per process: the pool already provides the parallelism
+    cv2.setNumThreads(1)
+
+def _preprocess_in_worker(block_name: str, offset: int, length: int,
+                          mime_type: str, kind: str) -> Optional[Tuple[str, int, str]]:
+    """Enhance one image from the shared input block; (output block, size, MIME type) or None if undecodable"""
+    block = SharedMemory(name=block_name)
+    try:
+        source = block.buf[offset:offset + length]
+        image = decode_image(source)
+        source.release()
+        if image is None:
+            return None
+        buffer, target_type = encode_buffer(ENHANCERS[kind](image), mime_type)
+    finally:
+        block.close()
+
+    # The parent copies the result out and unlinks the block
+    output = SharedMemory(create=True, size=max(len(buffer), 1))
+    output.buf[:len(buffer)] = buffer.ravel()
+    name = output.name
+    output.close()
+    return name, len(buffer), target_type
+
+def _collect_output(name: str, size: int, mime_type: str) -> ImagePayload:
+    block = SharedMemory(name=name)
+    try:
+        return ImagePayload(bytes(block.buf[:size]), mime_type=mime_type)
+    finally:
+        block.close()
+        block.unlink()
+
+class BatchPreprocessor:
+    """Preprocesses batches of images on a process pool forked once at startup"""
+
+    def __init__(self, workers: int = DEFAULT_WORKERS,
+                 cache: Optional[PreprocessCache] = None,
+                 debug_dir: Optional[str] = DEBUG_DIR):
+        self.workers = max(1, workers)
+        self.cache = cache
+        self.debug_dir = debug_dir
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._unavailable = False  # Pool cannot be forked safely any more; process inline
+        self._lock = threading.Lock()
+
+    def start(self) -> bool:
+        """Fork the worker pool now; call at startup, before any thread is started"""
+        with self._lock:
+            return self._start()
+
+    def _start(self) -> bool:
+        if self._executor is not None:
+            return True
+        if self._unavailable or self.workers == 1:
+            return False
+        if "fork" not in multiprocessing.get_all_start_methods():
+            print("⚠️ Platform cannot fork, batch preprocessing runs in-process")
+            self._unavailable = True
+            return False
+        if threading.active_count() > 1:
+            # A forked child inherits locks held by the other threads and can deadlock
+            print("⚠️ Threads already running, batch preprocessing runs in-process "
+                  "(call batch_preprocessor.start() at startup)")
+            self._unavailable = True
+            return False
+        # Workers share the parent's tracker, which unlinks leftover blocks on exit
+        resource_tracker.ensure_running()
+        executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("fork"),
+                                       initializer=_init_worker)
+        # With fork every worker is started on the first submit, while no thread is running yet;
+        # the executor never forks again afterwards
+        executor.submit(_init_worker).result()
+        self._executor = executor
+        print(f"🏭 Preprocessing pool started with {self.workers} workers")
+        return True
+
+    def _pool(self) -> Optional[ProcessPoolExecutor]:
+        with self._lock:
+            return self._executor if self._start() else None
+
+    def preprocess_many(self, paths: List[str], analysis_type: str) -> List[ImagePayload]:
+        """Preprocessed payloads for the images at paths, in the same order"""
+        return self.preprocess_payloads([ImagePayload.from_file(path) for path in paths], analysis_type)
+
+    def preprocess_payloads(self, payloads: List[ImagePayload], analysis_type: str) -> List[ImagePayload]:
+        """Same as preprocess_many for images already in memory"""
+        if analysis_type not in ENHANCERS:
+            return list(payloads)
+        cache = self.cache or image_preprocessing.preprocess_cache
+        results: List[Optional[ImagePayload]] = [None] * len(payloads)
+        pending: Dict[str, List[int]] = {}
+        for i, payload in enumerate(payloads):
+            key = cache_key(payload, analysis_type)
+            cached = cache.get(key) if key not in pending else None
+            if cached is not None:
+                results[i] = deliver(cached, payload, analysis_type, self.debug_dir)
+            else:
+                pending.setdefault(key, []).append(i)
+
+        sources = [(key, payloads[indices[0]]) for key, indices in pending.items()]
+        processed = self._process(sources, analysis_type)
+        for key, indices in pending.items():
+            variant = processed.get(key)
+            if variant is not None:
+                cache.put(key, variant)
+            for i in indices:
+                results[i] = deliver(variant, payloads[i], analysis_type, self.debug_dir) if variant else payloads[i]
+        return results
+
+    def _process(self, sources: List[Tuple[str, ImagePayload]], kind: str) -> Dict[str, ImagePayload]:
+        """Processed variant per cache key; keys of images that could not be processed are left out"""
+        if not sources:
+            return {}
+        pool = self._pool() if len(sources) > 1 else None
+        if pool is None:
+            return self._process_inline(sources, kind)
+
+        total = sum(len(payload) for _, payload in sources)
+        block = SharedMemory(create=True, size=max(total, 1))
+        try:
+            offsets = []
+            position = 0
+            for _, payload in sources:
+                block.buf[position:position + len(payload)] = payload.data
+                offsets.append(position)
+                position += len(payload)
+
+            futures = [pool.submit(_preprocess_in_worker, block.name, offset, len(payload), payload.mime_type, kind)
+                       for (_, payload), offset in zip(sources, offsets)]
+            processed = {}
+            for (key, _), future in zip(sources, futures):
+                try:
+                    output = future.result()
+                except Exception as e:
+                    print(f"⚠️ Preprocessing failed, sending original image: {e}")
+                    continue
+                if output is not None:
+                    processed[key] = _collect_output(*output)
+            return processed
+        finally:
+            block.close()
+            block.unlink()
+
+    def _process_inline(self, sources: List[Tuple[str, ImagePayload]], kind: str) -> Dict[str, ImagePayload]:
+        processed = {}
+        for key, payload in sources:
+            try:
+                image = decode_image(payload.data)
+                if image is not None:
+                    processed[key] = encode_image(ENHANCERS[kind](image), payload.mime_type)
+            except Exception as e:
+                print(f"⚠️ Preprocessing failed, sending original image: {e}")
+        return processed
+
+    def close(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+                self._executor = None
+
+# Shared by image_analysis, ultrasound_analysis and the batch endpoint
+batch_preprocessor = BatchPreprocessor()
+atexit.register(batch_preprocessor.close)
+
+def preprocess_many(paths: List[str], analysis_type: str) -> List[ImagePayload]:
+    """Preprocess a batch of images on the shared process pool"""
+    return batch_preprocessor.preprocess_many(paths, analysis_type)
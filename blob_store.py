@@ -0,0 +1,178 @@
+"""
+FertiVision powered by AI - LLM Text Blob Store
+
+Content-addressed, compressed storage for LLM output in the analysis
+database. Each distinct text is stored once in `llm_blobs`, keyed by its
+SHA-256 and compressed with zstd when the zstandard package is installed
+(zlib otherwise); rows such as image_analyses keep only the hash. A
+reference count tracks how many rows point at a blob, so identical answers
+(mock mode, cache hits, re-analysis) cost one row however often they are
+stored, and a blob is deleted when its last reference goes.
+
+Writes are returned as statements so they commit in the same transaction
+as the row that references the blob (inline or through the write-behind
+queue).
+
+Freed pages are reused by later writes; run VACUUM to shrink the file.
+
+© 2025 FertiVision powered by AI (made by greybrain.ai) - DeepSeek LLM Image Analysis
+"""
+
+import zlib
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Any, Tuple
+
+# Optional faster/stronger codec
+try:
+    import zstandard
+    ZSTD_AVAILABLE = True
+except ImportError:
+    ZSTD_AVAILABLE = False
+
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 10
+
+# Texts shorter than this are stored uncompressed
+MIN_COMPRESS_BYTES = 128
+
+# Recently stored/read blobs kept decoded and encoded in memory
+CACHE_ENTRIES = 256
+
+Statement = Tuple[str, List[Any]]
+
+CREATE_BLOBS_SQL = '''
+    CREATE TABLE IF NOT EXISTS llm_blobs (
+        hash TEXT PRIMARY KEY,
+        codec TEXT,
+        size INTEGER,
+        data BLOB,
+        refcount INTEGER
+    )
+'''
+
+class _LRU:
+    """Small thread-safe LRU of hash -> value"""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._items: "OrderedDict[str, Any]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            value = self._items.get(key)
+            if value is not None:
+                self._items.move_to_end(key)
+            return value
+
+    def put(self, key: str, value: Any):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_entries:
+                self._items.popitem(last=False)
+
+_encoded = _LRU(CACHE_ENTRIES)
+_decoded = _LRU(CACHE_ENTRIES)
+
+def ensure_blob_table(conn: sqlite3.Connection):
+    conn.execute(CREATE_BLOBS_SQL)
+
+def blob_key(text: str) -> str:
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def compress(text: str) -> Tuple[str, bytes]:
+    """(codec, payload) for a text"""
+    raw = text.encode('utf-8')
+    if len(raw) < MIN_COMPRESS_BYTES:
+        return "raw", raw
+    if ZSTD_AVAILABLE:
+        return "zstd", zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(raw)
+    return "zlib", zlib.compress(raw, ZLIB_LEVEL)
+
+def decompress(codec: str, payload: bytes) -> str:
+    if codec == "raw":
+        return bytes(payload).decode('utf-8')
+    if codec == "zlib":
+        return zlib.decompress(payload).decode('utf-8')
+    if codec == "zstd":
+        if not ZSTD_AVAILABLE:
+            raise RuntimeError("Blob is zstd-compressed but the zstandard package is not installed")
+        return zstandard.ZstdDecompressor().decompress(payload).decode('utf-8')
+    raise ValueError(f"Unknown blob codec: {codec}")
+
+def put_statements(text: str) -> Tuple[str, List[Statement]]:
+    """
+    Hash of a text and the statements that store it (or add a reference)
+
+    Compression runs once per distinct text while it stays in the cache.
+    """
+    key = blob_key(text)
+    encoded = _encoded.get(key)
+    if encoded is None:
+        encoded = compress(text)
+        _encoded.put(key, encoded)
+        _decoded.put(key, text)
+    codec, payload = encoded
+    return key, [(
+        '''
+        INSERT INTO llm_blobs (hash, codec, size, data, refcount) VALUES (?, ?, ?, ?, 1)
+        ON CONFLICT(hash) DO UPDATE SET refcount = refcount + 1
+        ''',
+        [key, codec, len(text.encode('utf-8')), payload]
+    )]
+
+def release_statements(key: str) -> List[Statement]:
+    """Statements dropping one reference; the blob goes with its last reference"""
+    return [
+        ('UPDATE llm_blobs SET refcount = refcount - 1 WHERE hash = ?', [key]),
+        ('DELETE FROM llm_blobs WHERE hash = ? AND refcount <= 0', [key]),
+    ]
+
+def read_blob(conn: sqlite3.Connection, key: str) -> Optional[str]:
+    """Decompressed text of a blob, None when it does not exist"""
+    text = _decoded.get(key)
+    if text is not None:
+        return text
+    row = conn.execute('SELECT codec, data FROM llm_blobs WHERE hash = ?', (key,)).fetchone()
+    if row is None:
+        return None
+    text = decompress(row[0], row[1])
+    _decoded.put(key, text)
+    return text
+
+def blob_stats(conn: sqlite3.Connection) -> Dict[str, int]:
+    """Distinct blobs, references, original and stored bytes"""
+    blobs, references, original, stored = conn.execute(
+        'SELECT COUNT(*), COALESCE(SUM(refcount), 0), COALESCE(SUM(size), 0), COALESCE(SUM(LENGTH(data)), 0) FROM llm_blobs'
+    ).fetchone()
+    return {'blobs': blobs, 'references': references, 'original_bytes': original, 'stored_bytes': stored}
+
+def migrate_image_text(conn: sqlite3.Connection, batch_size: int = 500) -> int:
+    """
+    Move plain llm_analysis text of existing image_analyses rows into the
+    blob store, one committed keyset batch at a time; returns rows moved
+    """
+    ensure_blob_table(conn)
+    moved = 0
+    last_id = 0
+    while True:
+        rows = conn.execute('''
+            SELECT id, llm_analysis FROM image_analyses
+            WHERE id > ? AND llm_analysis IS NOT NULL AND llm_blob IS NULL
+            ORDER BY id LIMIT ?
+        ''', (last_id, batch_size)).fetchall()
+        if not rows:
+            break
+        for row_id, text in rows:
+            key, statements = put_statements(text)
+            for sql, params in statements:
+                conn.execute(sql, params)
+            conn.execute('UPDATE image_analyses SET llm_blob = ?, llm_analysis = NULL WHERE id = ?', (key, row_id))
+        conn.commit()
+        last_id = rows[-1][0]
+        moved += len(rows)
+    return moved
@@ -0,0 +1,203 @@
+"""
+FertiVision powered by AI - Provider Circuit Breaker
+
+Tracks the health of every model endpoint, keyed on (provider, api_url). An
+endpoint whose recent calls mostly fail or run slow is opened and skipped by
+the fallback chain until it recovers, instead of costing every request a
+connection error or timeout.
+
+States:
+- CLOSED: calls flow normally, outcomes feed a rolling window
+- OPEN: calls are skipped; background probes watch for recovery
+- HALF_OPEN: a single trial call decides between CLOSED and OPEN
+
+© 2025 FertiVision powered by AI (made by greybrain.ai) - DeepSeek LLM Image Analysis
+"""
+
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+from enum import Enum
+from typing import Dict, Optional, Any, Tuple, Iterator
+from urllib.parse import urlparse
+
+from model_config import ModelProvider, ModelConfig
+
+class CircuitState(Enum):
+    """Circuit breaker states"""
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+class CircuitBreaker:
+    """Rolling error-rate and latency breaker for one endpoint"""
+
+    def __init__(self,
+                 key: Tuple[str, str],
+                 window_size: int = 20,
+                 min_calls: int = 3,
+                 failure_rate_threshold: float = 0.5,
+                 open_duration: float = 30.0):
+        self.key = key
+        self.window_size = window_size
+        self.min_calls = min_calls
+        self.failure_rate_threshold = failure_rate_threshold
+        self.open_duration = open_duration
+        self.state = CircuitState.CLOSED
+        self.opened_at: Optional[float] = None
+        self.last_error: Optional[str] = None
+        self.probing = False
+        self._window: deque = deque(maxlen=window_size)  # (ok, slow, latency)
+        self._trial_in_flight = False
+        self._trial_started = 0.0
+        self._lock = threading.Lock()
+
+    def allow_request(self) -> bool:
+        """Whether a call may be sent to this endpoint now"""
+        with self._lock:
+            if self.state == CircuitState.OPEN:
+                if time.time() - self.opened_at < self.open_duration:
+                    return False
+                self.state = CircuitState.HALF_OPEN
+                self._trial_in_flight = False
+
+            if self.state == CircuitState.HALF_OPEN:
+                # Backstop: a trial whose caller vanished without admit() cleanup expires after open_duration
+                if self._trial_in_flight and time.time() - self._trial_started < self.open_duration:
+                    return False
+                self._trial_in_flight = True
+                self._trial_started = time.time()
+
+            return True
+
+    def record_success(self, latency: float, slow: bool = False) -> CircuitState:
+        with self._lock:
+            self._window.append((True, slow, latency))
+            if self.state == CircuitState.HALF_OPEN:
+                print(f"✅ Circuit closed: {self.key[0]} at {self.key[1]}")
+                self.state = CircuitState.CLOSED
+                self._window.clear()
+                self._window.append((True, slow, latency))
+                self._trial_in_flight = False
+            elif self.state == CircuitState.CLOSED:
+                self._check_window()
+            return self.state
+
+    def record_failure(self, latency: float, error: Optional[str] = None) -> CircuitState:
+        with self._lock:
+            self._window.append((False, False, latency))
+            self.last_error = error
+            if self.state == CircuitState.HALF_OPEN:
+                self._open()
+            elif self.state == CircuitState.CLOSED:
+                self._check_window()
+            return self.state
+
+    def release_trial(self):
+        """The trial call ended without reaching the endpoint - let the next call try instead"""
+        with self._lock:
+            if self.state == CircuitState.HALF_OPEN:
+                self._trial_in_flight = False
+
+    def mark_recovered(self):
+        """A probe reached the endpoint - let the next call through as a trial"""
+        with self._lock:
+            if self.state == CircuitState.OPEN:
+                self.state = CircuitState.HALF_OPEN
+                self._trial_in_flight = False
+
+    def _check_window(self):
+        if len(self._window) < self.min_calls:
+            return
+        if self._bad_rate() >= self.failure_rate_threshold:
+            self._open()
+
+    def _bad_rate(self) -> float:
+        if not self._window:
+            return 0.0
+        bad = sum(1 for ok, slow, _ in self._window if not ok or slow)
+        return bad / len(self._window)
+
+    def _open(self):
+        print(f"🔌 Circuit opened: {self.key[0]} at {self.key[1]} ({self.last_error or 'slow responses'})")
+        self.state = CircuitState.OPEN
+        self.opened_at = time.time()
+        self._trial_in_flight = False
+
+    def health_score(self) -> float:
+        """0.0 (unusable) to 1.0 (healthy)"""
+        with self._lock:
+            if self.state == CircuitState.OPEN:
+                return 0.0
+            score = 1.0 - self._bad_rate()
+            return score * 0.5 if self.state == CircuitState.HALF_OPEN else score
+
+    def snapshot(self) -> Dict[str, Any]:
+        score = self.health_score()
+        with self._lock:
+            latencies = [latency for ok, _, latency in self._window if ok]
+            return {
+                'provider': self.key[0],
+                'api_url': self.key[1],
+                'state': self.state.value,
+                'health_score': round(score, 3),
+                'failure_rate': round(sum(1 for ok, _, _ in self._window if not ok) / len(self._window), 3) if self._window else 0.0,
+                'avg_latency': round(sum(latencies) / len(latencies), 3) if latencies else None,
+                'calls_in_window': len(self._window),
+                'last_error': self.last_error
+            }
+
+class CircuitBreakerRegistry:
+    """One breaker per (provider, api_url)"""
+
+    def __init__(self, **breaker_settings):
+        self.breaker_settings = breaker_settings
+        self._breakers: Dict[Tuple[str, str], CircuitBreaker] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key_for(model_config: ModelConfig) -> Tuple[str, str]:
+        return (model_config.provider.value, model_config.api_url)
+
+    def get(self, model_config: ModelConfig) -> CircuitBreaker:
+        key = self.key_for(model_config)
+        breaker = self._breakers.get(key)
+        if breaker is None:
+            with self._lock:
+                breaker = self._breakers.setdefault(key, CircuitBreaker(key, **self.breaker_settings))
+        return breaker
+
+    def allow_request(self, model_config: ModelConfig) -> bool:
+        return self.get(model_config).allow_request()
+
+    @contextmanager
+    def admit(self, model_config: ModelConfig) -> Iterator[bool]:
+        """
+        Whether a call may go to the endpoint, for the duration of the call
+
+        A half-open trial that ends without recording a success or failure
+        (cancelled, rejected by the scheduler, failed before sending) gives
+        its slot back on exit instead of blocking the endpoint until it
+        expires.
+        """
+        breaker = self.get(model_config)
+        allowed = breaker.allow_request()
+        trial = allowed and breaker.state == CircuitState.HALF_OPEN
+        try:
+            yield allowed
+        finally:
+            if trial:
+                breaker.release_trial()
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        """Health of every endpoint seen so far"""
+        return {f"{key[0]}|{key[1]}": breaker.snapshot() for key, breaker in list(self._breakers.items())}
+
+def probe_url(model_config: ModelConfig) -> str:
+    """Cheap URL for checking that an endpoint is reachable again"""
+    parsed = urlparse(model_config.api_url)
+    base = f"{parsed.scheme}://{parsed.netloc}"
+    if model_config.provider == ModelProvider.OLLAMA_LOCAL:
+        return f"{base}/api/tags"
+    return f"{base}/"
@@ -0,0 +1,151 @@
+"""
+FertiVision powered by AI - SQLite Connection Pool
+
+Shared, long-lived connections to the analysis database. Opening a connection
+per query costs a file open, schema parse and lock setup each time, and the
+default rollback journal serializes readers behind every writer. The pool
+keeps connections open in WAL mode so readers never block the writer, tunes
+synchronous/busy_timeout, and lets sqlite3 reuse its prepared statements.
+
+Usage:
+    with get_pool(db_path).connection() as conn:
+        conn.execute(...)
+
+The block commits when it exits normally and rolls back on an exception.
+
+© 2025 FertiVision powered by AI (made by greybrain.ai) - DeepSeek LLM Image Analysis
+"""
+
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Dict, List, Iterator, Optional, Tuple
+
+# Idle connections kept per database file
+MAX_IDLE_CONNECTIONS = 8
+
+# Wait this long for a competing writer before raising "database is locked"
+BUSY_TIMEOUT_MS = 5000
+
+# Prepared statements cached per connection
+CACHED_STATEMENTS = 256
+
+# NORMAL is durable across application crashes in WAL mode; only a power loss
+# can drop the last transactions
+SYNCHRONOUS = "NORMAL"
+
+class ConnectionPool:
+    """Reusable WAL-mode connections to one SQLite file"""
+
+    def __init__(self,
+                 db_path: str,
+                 max_idle: int = MAX_IDLE_CONNECTIONS,
+                 busy_timeout_ms: int = BUSY_TIMEOUT_MS,
+                 cached_statements: int = CACHED_STATEMENTS,
+                 synchronous: str = SYNCHRONOUS):
+        self.db_path = db_path
+        self.max_idle = max_idle
+        self.busy_timeout_ms = busy_timeout_ms
+        self.cached_statements = cached_statements
+        self.synchronous = synchronous
+        self._idle: List[sqlite3.Connection] = []
+        self._file_id: Optional[Tuple[int, int]] = None
+        self._lock = threading.Lock()
+        self._stats = {'opened': 0, 'reused': 0}
+
+    def _current_file_id(self) -> Optional[Tuple[int, int]]:
+        try:
+            stat = os.stat(self.db_path)
+        except OSError:
+            return None
+        return (stat.st_dev, stat.st_ino)
+
+    def _open(self) -> sqlite3.Connection:
+        directory = os.path.dirname(self.db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=self.busy_timeout_ms / 1000.0,
+            check_same_thread=False,
+            cached_statements=self.cached_statements
+        )
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute(f'PRAGMA synchronous={self.synchronous}')
+        conn.execute(f'PRAGMA busy_timeout={int(self.busy_timeout_ms)}')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        return conn
+
+    def acquire(self) -> sqlite3.Connection:
+        """Check out an idle connection or open a new one"""
+        file_id = self._current_file_id()
+        with self._lock:
+            if file_id != self._file_id:
+                # The file was deleted or replaced - idle connections point at the old one
+                self._close_idle()
+            if self._idle:
+                self._stats['reused'] += 1
+                return self._idle.pop()
+        conn = self._open()
+        with self._lock:
+            self._stats['opened'] += 1
+            self._file_id = self._current_file_id()
+        return conn
+
+    def release(self, conn: sqlite3.Connection):
+        """Return a connection to the pool"""
+        if conn.in_transaction:
+            conn.rollback()
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        """Pooled connection; commits on success, rolls back on error"""
+        conn = self.acquire()
+        try:
+            yield conn
+            if conn.in_transaction:
+                conn.commit()
+        except Exception:
+            if conn.in_transaction:
+                conn.rollback()
+            raise
+        finally:
+            self.release(conn)
+
+    def _close_idle(self):
+        for conn in self._idle:
+            conn.close()
+        self._idle.clear()
+
+    def close(self):
+        """Close idle connections; checked-out ones close when released past max_idle"""
+        with self._lock:
+            self._close_idle()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {**self._stats, 'idle': len(self._idle)}
+
+_pools: Dict[str, ConnectionPool] = {}
+_pools_lock = threading.Lock()
+
+def get_pool(db_path: str) -> ConnectionPool:
+    """Pool shared by every module that opens this database file"""
+    key = os.path.abspath(db_path)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = ConnectionPool(db_path)
+        return pool
+
+def close_pools():
+    """Close idle connections of every pool (tests, shutdown)"""
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.close()
@@ -1,13 +1,17 @@
 import os
-import sqlite3
 import datetime
 import json
-from typing import Dict
+import tempfile
+import cv2
+from typing import Dict, Optional
 from werkzeug.utils import secure_filename
 from reproductive_classification_system import ReproductiveClassificationSystem, OocyteMaturity
+from analysis_schema import ANALYSIS_TABLES
+from storage import AnalysisRepository, StoredImage
 from image_analysis import ImageAnalyzer
 import re
 from ultrasound_analysis import UltrasoundAnalyzer, FollicleAnalysis, HysteroscopyAnalysis, FollicleStage, HysteroscopyFinding
+from sperm_motility import analyze_motility_video, is_video, CHAMBER_DEPTH_UM
 from enum import Enum
 
 class CustomJSONEncoder(json.JSONEncoder):
@@ -19,57 +23,34 @@ class CustomJSONEncoder(json.JSONEncoder):
         return super().default(obj)
 
 class EnhancedReproductiveSystem(ReproductiveClassificationSystem):
-    def __init__(self, db_path: str = "reproductive_analysis.db", upload_folder: str = "uploads", mock_mode: bool = True):
-        super().__init__(db_path)
+    def __init__(self, db_path: str = "reproductive_analysis.db", upload_folder: str = "uploads", mock_mode: bool = True,
+                 write_behind: bool = False, archive_dir: Optional[str] = None,
+                 storage: Optional[AnalysisRepository] = None,
+                 follicle_mode: str = "llm", ultrasound_mm_per_pixel: Optional[float] = None,
+                 sperm_video_microns_per_pixel: Optional[float] = None):
+        # Image and ultrasound tables are created with the others by the storage
+        super().__init__(db_path, write_behind=write_behind, archive_dir=archive_dir, storage=storage)
         self.upload_folder = upload_folder
         self.image_analyzer = ImageAnalyzer(mock_mode=mock_mode)
-        self.ultrasound_analyzer = UltrasoundAnalyzer(mock_mode=mock_mode)
+        self.ultrasound_analyzer = UltrasoundAnalyzer(mock_mode=mock_mode, follicle_mode=follicle_mode,
+                                                      mm_per_pixel=ultrasound_mm_per_pixel)
         self.mock_mode = mock_mode
+        self.sperm_video_microns_per_pixel = sperm_video_microns_per_pixel
         self.allowed_extensions = {'png', 'jpg', 'jpeg', 'tiff', 'bmp', 'dcm', 'nii', 'mp4', 'avi', 'mov'}  # Extended format support
         # Create upload directory
         os.makedirs(upload_folder, exist_ok=True)
-        # Add image analysis table to database
-        self._init_image_tables()
-    def _init_image_tables(self):
-        """Initialize tables for image analysis storage"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        # Existing tables...
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS image_analyses (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                sample_id TEXT,
-                analysis_type TEXT,
-                image_path TEXT,
-                llm_analysis TEXT,
-                processed_data TEXT,
-                timestamp TEXT
-            )
-        ''')
-        # Add ultrasound analysis tables
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS follicle_analyses (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                scan_id TEXT UNIQUE,
-                data TEXT,
-                timestamp TEXT
-            )
-        ''')
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS hysteroscopy_analyses (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                procedure_id TEXT UNIQUE,
-                data TEXT,
-                timestamp TEXT
-            )
-        ''')
-        conn.commit()
-        conn.close()
     def allowed_file(self, filename):
         """Check if file extension is allowed"""
         return '.' in filename and \
                filename.rsplit('.', 1)[1].lower() in self.allowed_extensions
     def analyze_sperm_with_image(self, image_path: str, **kwargs) -> dict:
+        if is_video(image_path):
+            return self.analyze_sperm_video(image_path, **kwargs)
+        # Calibration only applies to videos
+        kwargs.pop('microns_per_pixel', None)
+        kwargs.pop('chamber_depth', None)
+        alias = kwargs.pop('analysis_id', None)
+        client = kwargs.pop('client', None)
         image_result = self.image_analyzer.analyze_sperm_image(image_path)
         if image_result["success"]:
             llm_analysis = image_result["analysis"]
@@ -81,7 +62,9 @@ class EnhancedReproductiveSystem(ReproductiveClassificationSystem):
                 "sperm",
                 image_path,
                 llm_analysis,
-                merged_params
+                merged_params,
+                alias=alias,
+                client=client
             )
             classification_result.image_analysis = llm_analysis
             classification_result.image_path = image_path
@@ -89,6 +72,8 @@ class EnhancedReproductiveSystem(ReproductiveClassificationSystem):
         else:
             raise Exception(f"Image analysis failed: {image_result['error']}")
     def analyze_oocyte_with_image(self, image_path: str, **kwargs) -> dict:
+        alias = kwargs.pop('analysis_id', None)
+        client = kwargs.pop('client', None)
         image_result = self.image_analyzer.analyze_oocyte_image(image_path)
         if image_result["success"]:
             llm_analysis = image_result["analysis"]
@@ -100,7 +85,9 @@ class EnhancedReproductiveSystem(ReproductiveClassificationSystem):
                 "oocyte",
                 image_path,
                 llm_analysis,
-                merged_params
+                merged_params,
+                alias=alias,
+                client=client
             )
             classification_result.image_analysis = llm_analysis
             classification_result.image_path = image_path
@@ -108,6 +95,8 @@ class EnhancedReproductiveSystem(ReproductiveClassificationSystem):
         else:
             raise Exception(f"Image analysis failed: {image_result['error']}")
     def analyze_embryo_with_image(self, image_path: str, day: int, **kwargs) -> dict:
+        alias = kwargs.pop('analysis_id', None)
+        client = kwargs.pop('client', None)
         image_result = self.image_analyzer.analyze_embryo_image(image_path, day)
         if image_result["success"]:
             llm_analysis = image_result["analysis"]
@@ -120,13 +109,64 @@ class EnhancedReproductiveSystem(ReproductiveClassificationSystem):
                 "embryo",
                 image_path,
                 llm_analysis,
-                merged_params
+                merged_params,
+                alias=alias,
+                client=client
             )
             classification_result.image_analysis = llm_analysis
             classification_result.image_path = image_path
             return classification_result
         else:
             raise Exception(f"Image analysis failed: {image_result['error']}")
+    def analyze_sperm_video(self, video_path: str, **kwargs):
+        """Motility and concentration measured from a video (see sperm_motility), then WHO classification"""
+        alias = kwargs.pop('analysis_id', None)
+        client = kwargs.pop('client', None)
+        # Form values arrive as strings
+        microns_per_pixel = kwargs.pop('microns_per_pixel', None)
+        microns_per_pixel = float(microns_per_pixel) if microns_per_pixel else self.sperm_video_microns_per_pixel
+        chamber_depth = kwargs.pop('chamber_depth', None)
+        chamber_depth = float(chamber_depth) if chamber_depth else CHAMBER_DEPTH_UM
+        for key in ('concentration', 'progressive_motility', 'normal_morphology', 'volume', 'vitality', 'ph'):
+            if isinstance(kwargs.get(key), str):
+                kwargs[key] = float(kwargs[key]) if kwargs[key] else None
+        kwargs = {key: value for key, value in kwargs.items() if value is not None}
+
+        motility = analyze_motility_video(video_path, microns_per_pixel, chamber_depth_um=chamber_depth,
+                                          keep_still='normal_morphology' not in kwargs)
+        report = motility.summary()
+        params = motility.classification_params()
+        if 'normal_morphology' not in kwargs:
+            # Morphology is not measurable from motility footage; the image model reads the first frame
+            handle, still_path = tempfile.mkstemp(suffix=".png")
+            os.close(handle)
+            try:
+                cv2.imwrite(still_path, motility.still)
+                image_result = self.image_analyzer.analyze_sperm_image(still_path)
+            finally:
+                os.remove(still_path)
+            if not image_result["success"]:
+                raise Exception(f"Morphology analysis failed: {image_result['error']}")
+            morphology = self._extract_sperm_parameters(image_result["analysis"]).get('normal_morphology')
+            if morphology is None:
+                raise Exception("Morphology analysis failed: no normal morphology in the report")
+            params['normal_morphology'] = morphology
+            report += f"\n\nMORPHOLOGY (first frame):\n{image_result['analysis']}"
+
+        merged_params = {**params, **kwargs}
+        classification_result = self.classify_sperm(**merged_params)
+        self._store_image_analysis(
+            classification_result.sample_id,
+            "sperm",
+            video_path,
+            report,
+            merged_params,
+            alias=alias,
+            client=client
+        )
+        classification_result.image_analysis = report
+        classification_result.image_path = video_path
+        return classification_result
     def _extract_sperm_parameters(self, llm_analysis: str) -> dict:
         params = {}
         lines = llm_analysis.split('\n')
@@ -187,26 +227,18 @@ class EnhancedReproductiveSystem(ReproductiveClassificationSystem):
             if te_match:
                 params['trophectoderm'] = te_match.group(1)
         return params
-    def _store_image_analysis(self, sample_id: str, analysis_type: str, image_path: str, llm_analysis: str, processed_data: dict):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT INTO image_analyses 
-            (sample_id, analysis_type, image_path, llm_analysis, processed_data, timestamp)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', (sample_id, analysis_type, image_path, llm_analysis, json.dumps(processed_data, cls=CustomJSONEncoder), datetime.datetime.now().isoformat()))
-        conn.commit()
-        conn.close()
+    def _store_image_analysis(self, sample_id: str, analysis_type: str, image_path: str, llm_analysis: str, processed_data: dict,
+                              alias: str = None, client: str = None):
+        """
+        Store the image assessment; alias registers an extra public ID (API
+        analysis_id) for the analysis, client records the API client for history
+        """
+        self.storage.store_image(StoredImage(sample_id, analysis_type, image_path, llm_analysis,
+                                             json.dumps(processed_data, cls=CustomJSONEncoder),
+                                             datetime.datetime.now().isoformat(), alias, client))
     def generate_enhanced_report(self, analysis_type: str, analysis_id: str) -> str:
         standard_report = self.generate_report(analysis_type, analysis_id)
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT image_path, llm_analysis FROM image_analyses 
-            WHERE sample_id = ? AND analysis_type = ?
-        ''', (analysis_id, analysis_type))
-        image_result = cursor.fetchone()
-        conn.close()
+        image_result = self.storage.fetch_image(analysis_id, analysis_type)
         if image_result:
             image_path, llm_analysis = image_result
             enhanced_report = standard_report + f"""
@@ -229,11 +261,15 @@ DETAILED IMAGE ASSESSMENT:
     def analyze_follicle_scan_with_image(self, image_path: str, **kwargs) -> dict:
         """Analyze follicle scan using LLM vision and ultrasound analysis"""
         try:
-            # Use ultrasound analyzer for follicle analysis
-            analysis_result = self.ultrasound_analyzer.analyze_follicle_scan(image_path)
+            # Use ultrasound analyzer for follicle analysis (form values arrive as strings)
+            mm_per_pixel = float(kwargs['mm_per_pixel']) if kwargs.get('mm_per_pixel') else None
+            narrative = str(kwargs.get('narrative', '')).lower() in ('1', 'true', 'yes', 'on')
+            analysis_result = self.ultrasound_analyzer.analyze_follicle_scan(image_path, mm_per_pixel=mm_per_pixel,
+                                                                             narrative=narrative)
             
             # Store the analysis
-            self._store_follicle_analysis(analysis_result.scan_id, analysis_result)
+            self._store_follicle_analysis(analysis_result.scan_id, analysis_result,
+                                          kwargs.get('patient_id'), kwargs.get('case_id'))
             
             # Also store in image analysis table for consistency
             self._store_image_analysis(
@@ -246,7 +282,9 @@ DETAILED IMAGE ASSESSMENT:
                     'antral_follicle_count': analysis_result.antral_follicle_count,
                     'dominant_follicle_size': analysis_result.dominant_follicle_size,
                     'classification': analysis_result.classification
-                }
+                },
+                alias=kwargs.get('analysis_id'),
+                client=kwargs.get('client')
             )
             
             return {
@@ -271,7 +309,8 @@ DETAILED IMAGE ASSESSMENT:
             analysis_result = self.ultrasound_analyzer.analyze_hysteroscopy_image(image_path)
             
             # Store the analysis
-            self._store_hysteroscopy_analysis(analysis_result.procedure_id, analysis_result)
+            self._store_hysteroscopy_analysis(analysis_result.procedure_id, analysis_result,
+                                              kwargs.get('patient_id'), kwargs.get('case_id'))
             
             # Also store in image analysis table for consistency
             findings_text = ", ".join([f.value for f in analysis_result.pathological_findings]) if analysis_result.pathological_findings else "Normal"
@@ -285,7 +324,9 @@ DETAILED IMAGE ASSESSMENT:
                     'pathological_findings': [f.value for f in analysis_result.pathological_findings] if analysis_result.pathological_findings else [],
                     'uterine_cavity': analysis_result.uterine_cavity,
                     'classification': analysis_result.classification
-                }
+                },
+                alias=kwargs.get('analysis_id'),
+                client=kwargs.get('client')
             )
             
             return {
@@ -303,11 +344,9 @@ DETAILED IMAGE ASSESSMENT:
                 'analysis_type': 'hysteroscopy'
             }
 
-    def _store_follicle_analysis(self, scan_id: str, analysis: FollicleAnalysis):
+    def _store_follicle_analysis(self, scan_id: str, analysis: FollicleAnalysis,
+                                 patient_id: str = None, case_id: str = None):
         """Store follicle analysis in database"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
         analysis_data = {
             'total_follicle_count': analysis.total_follicle_count,
             'antral_follicle_count': analysis.antral_follicle_count,
@@ -317,21 +356,17 @@ DETAILED IMAGE ASSESSMENT:
             'ovarian_volume': analysis.ovarian_volume,
             'ivf_prognosis': analysis.ivf_prognosis
         }
+        if patient_id:
+            analysis_data['patient_id'] = patient_id
+        if case_id:
+            analysis_data['case_id'] = case_id
         
-        cursor.execute('''
-            INSERT OR REPLACE INTO follicle_analyses 
-            (scan_id, data, timestamp)
-            VALUES (?, ?, ?)
-        ''', (scan_id, json.dumps(analysis_data), datetime.datetime.now().isoformat()))
-        
-        conn.commit()
-        conn.close()
+        self._insert_analysis('follicle_analyses', scan_id, analysis_data,
+                              json.dumps(analysis_data), datetime.datetime.now().isoformat())
 
-    def _store_hysteroscopy_analysis(self, procedure_id: str, analysis: HysteroscopyAnalysis):
+    def _store_hysteroscopy_analysis(self, procedure_id: str, analysis: HysteroscopyAnalysis,
+                                     patient_id: str = None, case_id: str = None):
         """Store hysteroscopy analysis in database"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
         analysis_data = {
             'endometrial_thickness': analysis.endometrial_thickness,
             'pathological_findings': [f.value for f in analysis.pathological_findings] if analysis.pathological_findings else [],
@@ -341,15 +376,13 @@ DETAILED IMAGE ASSESSMENT:
             'treatment_recommendation': analysis.treatment_recommendation,
             'biopsy_indicated': analysis.biopsy_indicated
         }
+        if patient_id:
+            analysis_data['patient_id'] = patient_id
+        if case_id:
+            analysis_data['case_id'] = case_id
         
-        cursor.execute('''
-            INSERT OR REPLACE INTO hysteroscopy_analyses 
-            (procedure_id, data, timestamp)
-            VALUES (?, ?, ?)
-        ''', (procedure_id, json.dumps(analysis_data), datetime.datetime.now().isoformat()))
-        
-        conn.commit()
-        conn.close()
+        self._insert_analysis('hysteroscopy_analyses', procedure_id, analysis_data,
+                              json.dumps(analysis_data), datetime.datetime.now().isoformat())
 
     def set_mock_mode(self, mock_mode: bool):
         """Switch between mock and real AI analysis"""
@@ -358,28 +391,23 @@ DETAILED IMAGE ASSESSMENT:
         self.ultrasound_analyzer.mock_mode = mock_mode
     
     def get_analysis_by_id(self, analysis_type: str, analysis_id: str):
-        """Get analysis data by ID for PDF export"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        table_map = {
-            'sperm': 'sperm_analyses',
-            'oocyte': 'oocyte_analyses', 
-            'embryo': 'embryo_analyses',
-            'follicle': 'follicle_analyses',
-            'hysteroscopy': 'hysteroscopy_analyses'
-        }
+        """Get analysis data by any public ID for PDF export; analysis_type may be None"""
+        if analysis_type and analysis_type not in ANALYSIS_TABLES:
+            return None
         
-        table = table_map.get(analysis_type)
-        if not table:
+        ref = self.resolve_analysis(analysis_id)
+        if ref is None or (analysis_type and ref.analysis_type != analysis_type):
             return None
-            
-        cursor.execute(f'SELECT * FROM {table} WHERE id = ? OR sample_id = ?', (analysis_id, analysis_id))
-        result = cursor.fetchone()
-        conn.close()
         
-        if result:
-            # Convert to dict with column names
-            columns = [description[0] for description in cursor.description]
-            return dict(zip(columns, result))
+        record = self.storage.fetch_row(ref)
+        if record:
+            # Lift the JSON document fields to the top level
+            data = json.loads(record['data']) if record.get('data') else {}
+            return {
+                **data,
+                **{key: value for key, value in record.items() if value is not None},
+                'analysis_id': analysis_id,
+                'analysis_type': ref.analysis_type,
+                'image_path': ref.image_path
+            }
         return None
@@ -0,0 +1,244 @@
+"""
+FertiVision powered by AI - Classical Follicle Detection
+
+Measures follicles on an ovarian ultrasound frame with OpenCV alone, in tens
+of milliseconds on CPU, so routine monitoring scans do not need a vision
+model call.
+
+Pipeline:
+- Speckle reduction (median + Gaussian blur) on the grayscale frame
+- Field of view: convex hull of the scan sector, eroded so the black
+  background around the sector is never mistaken for a follicle
+- Anechoic candidates: pixels well below the tissue level of the sector
+- One ellipse per candidate; candidates that are not round enough, do not
+  fill their ellipse or barely differ from the surrounding tissue are
+  rejected
+- Mean of the two ellipse axes, converted to millimetres from the scan's
+  calibration
+
+Calibration comes from the caller (mm_per_pixel), DICOM metadata
+(SequenceOfUltrasoundRegions or PixelSpacing, when pydicom is installed) or
+Config.ULTRASOUND_MM_PER_PIXEL. Without it sizes cannot be measured and the
+detection reports zero confidence.
+
+The confidence combines how much of the dark area was accepted as follicles
+with how clean the accepted follicles are; UltrasoundAnalyzer falls back to
+the vision model below MIN_CONFIDENCE.
+
+Usage:
+    detection = detect_follicles(ImagePayload.from_file(path), mm_per_pixel=0.1)
+    detection.follicle_sizes, detection.antral_follicle_count
+
+© 2025 FertiVision powered by AI (made by greybrain.ai) - DeepSeek LLM Image Analysis
+"""
+
+import io
+import time
+from dataclasses import dataclass, field
+from typing import List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from image_payload import ImagePayload
+from image_preprocessing import decode_image
+
+# pydicom is optional - without it DICOM scans go to the vision model
+try:
+    import pydicom
+    PYDICOM_AVAILABLE = True
+except ImportError:
+    PYDICOM_AVAILABLE = False
+
+# Measured follicle range (mm), same as the report parser; larger cavities are cysts
+MIN_FOLLICLE_MM = 2.0
+MAX_FOLLICLE_MM = 30.0
+
+# Antral follicle count range (mm)
+ANTRAL_RANGE_MM = (2.0, 10.0)
+
+# Shape and echo limits for a candidate to count as a follicle
+MIN_SOLIDITY = 0.85
+MIN_ELLIPSE_FILL = 0.85  # Contour area / fitted ellipse area; merged follicles fill theirs poorly
+MAX_AXIS_RATIO = 2.0
+MIN_CONTRAST = 0.35
+
+# Below this the vision model is asked instead
+MIN_CONFIDENCE = 0.6
+
+@dataclass
+class FollicleMeasurement:
+    """One follicle found on the frame"""
+    diameter_mm: float  # Mean of the two ellipse axes
+    major_mm: float
+    minor_mm: float
+    center: Tuple[int, int]  # Pixels
+    contrast: float  # 1 - follicle mean / surrounding tissue mean
+    solidity: float
+
+@dataclass
+class FollicleDetection:
+    """Follicles of one scan and how far the measurement can be trusted"""
+    follicles: List[FollicleMeasurement]
+    mm_per_pixel: Optional[float]
+    calibration_source: str  # caller/dicom/config/none
+    confidence: float  # 0-1
+    rejected_candidates: int = 0
+    processing_time: float = 0.0
+    notes: List[str] = field(default_factory=list)
+
+    @property
+    def follicle_sizes(self) -> List[float]:
+        """Diameters in mm, largest first"""
+        return sorted((f.diameter_mm for f in self.follicles), reverse=True)
+
+    @property
+    def total_follicle_count(self) -> int:
+        return len(self.follicles)
+
+    @property
+    def antral_follicle_count(self) -> int:
+        low, high = ANTRAL_RANGE_MM
+        return sum(1 for size in self.follicle_sizes if low <= size <= high)
+
+    @property
+    def dominant_follicle_size(self) -> float:
+        sizes = self.follicle_sizes
+        return sizes[0] if sizes else 0.0
+
+def read_dicom(data: bytes) -> Tuple[Optional[np.ndarray], Optional[float]]:
+    """Grayscale frame and mm per pixel of a DICOM ultrasound, (None, None) without pydicom"""
+    if not PYDICOM_AVAILABLE:
+        return None, None
+    try:
+        dataset = pydicom.dcmread(io.BytesIO(data))
+        pixels = dataset.pixel_array
+        if pixels.ndim == 4 or (pixels.ndim == 3 and pixels.shape[-1] not in (3, 4)):
+            pixels = pixels[0]  # First frame of a cine loop
+        if pixels.ndim == 3:
+            pixels = cv2.cvtColor(pixels.astype(np.uint8), cv2.COLOR_RGB2GRAY)
+        frame = cv2.normalize(pixels.astype(np.float32), None, 0, 255, cv2.NORM_MINMAX).astype(np.uint8)
+    except Exception as e:
+        print(f"⚠️ Could not read DICOM frame: {e}")
+        return None, None
+
+    mm_per_pixel = None
+    regions = getattr(dataset, "SequenceOfUltrasoundRegions", None)
+    if regions:
+        region = regions[0]
+        # Units code 3 = cm
+        if getattr(region, "PhysicalUnitsXDirection", None) == 3 and getattr(region, "PhysicalDeltaX", None):
+            mm_per_pixel = float(region.PhysicalDeltaX) * 10
+    if mm_per_pixel is None and getattr(dataset, "PixelSpacing", None):
+        mm_per_pixel = float(dataset.PixelSpacing[1])
+    return frame, mm_per_pixel
+
+def _field_of_view(gray: np.ndarray) -> np.ndarray:
+    """Mask of the scan sector, shrunk away from its border"""
+    lit = (cv2.GaussianBlur(gray, (15, 15), 0) > 12).astype(np.uint8)
+    contours, _ = cv2.findContours(lit, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    mask = np.zeros_like(gray)
+    if contours:
+        cv2.drawContours(mask, [cv2.convexHull(max(contours, key=cv2.contourArea))], -1, 255, cv2.FILLED)
+    else:
+        mask[:] = 255
+    margin = max(3, int(min(gray.shape) * 0.02)) | 1
+    return cv2.erode(mask, cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (margin, margin)))
+
+def detect_follicles_in_frame(gray: np.ndarray, mm_per_pixel: Optional[float],
+                              calibration_source: str = "caller") -> FollicleDetection:
+    """Follicles on a grayscale ultrasound frame"""
+    start = time.time()
+    notes = []
+    smooth = cv2.GaussianBlur(cv2.medianBlur(gray, 5), (5, 5), 0)
+    fov = _field_of_view(gray)
+    inside = smooth[fov > 0]
+    if inside.size == 0:
+        return FollicleDetection([], mm_per_pixel, calibration_source, 0.0,
+                                 processing_time=time.time() - start, notes=["No scan sector found"])
+
+    # Anechoic: well below the tissue level (Otsu alone splits the tissue when follicles are few)
+    otsu, _ = cv2.threshold(inside.reshape(-1, 1), 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    threshold = min(otsu, 0.6 * float(np.median(inside)))
+    dark = ((smooth < threshold) & (fov > 0)).astype(np.uint8) * 255
+    dark = cv2.morphologyEx(dark, cv2.MORPH_OPEN, cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5, 5)))
+    contours, _ = cv2.findContours(dark, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
+
+    scale = mm_per_pixel or 0.0
+    min_area = max(20.0, np.pi * (MIN_FOLLICLE_MM / 2 / scale) ** 2 * 0.5) if scale else 20.0
+    ring_kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (9, 9))
+    follicles, scores = [], []
+    accepted_area = rejected_area = 0.0
+    rejected = 0
+    for contour in contours:
+        area = cv2.contourArea(contour)
+        if area < min_area or len(contour) < 5:
+            continue
+        (cx, cy), axes, _ = cv2.fitEllipse(contour)
+        major, minor = max(axes), min(axes)
+        solidity = area / max(cv2.contourArea(cv2.convexHull(contour)), 1.0)
+        fill = area / max(np.pi * major * minor / 4, 1.0)
+
+        # Echo contrast against a ring of surrounding tissue
+        x, y, w, h = cv2.boundingRect(contour)
+        pad = 8
+        x0, y0 = max(x - pad, 0), max(y - pad, 0)
+        x1, y1 = min(x + w + pad, gray.shape[1]), min(y + h + pad, gray.shape[0])
+        region = np.zeros((y1 - y0, x1 - x0), dtype=np.uint8)
+        cv2.drawContours(region, [contour - [x0, y0]], -1, 255, cv2.FILLED)
+        ring = cv2.dilate(region, ring_kernel) - region
+        patch = smooth[y0:y1, x0:x1]
+        ring_mean = float(patch[ring > 0].mean()) if ring.any() else 0.0
+        contrast = 1.0 - float(patch[region > 0].mean()) / ring_mean if ring_mean else 0.0
+
+        diameter = (major + minor) / 2 * scale
+        if (solidity < MIN_SOLIDITY or fill < MIN_ELLIPSE_FILL or major > MAX_AXIS_RATIO * minor or contrast < MIN_CONTRAST
+                or (scale and diameter > MAX_FOLLICLE_MM)):
+            rejected += 1
+            rejected_area += area
+            continue
+        if scale and diameter < MIN_FOLLICLE_MM:
+            continue
+        accepted_area += area
+        scores.append((min(1.0, contrast / 0.6) + solidity) / 2)
+        follicles.append(FollicleMeasurement(
+            diameter_mm=round(diameter, 1),
+            major_mm=round(major * scale, 1),
+            minor_mm=round(minor * scale, 1),
+            center=(int(cx), int(cy)),
+            contrast=round(contrast, 3),
+            solidity=round(solidity, 3)
+        ))
+
+    if not scale:
+        confidence = 0.0
+        notes.append("No calibration - follicle sizes cannot be measured")
+    elif not follicles:
+        confidence = 0.0
+        notes.append("No follicles found")
+    else:
+        accepted_share = accepted_area / (accepted_area + rejected_area)
+        confidence = round(accepted_share * float(np.mean(scores)), 3)
+    if rejected:
+        notes.append(f"{rejected} dark regions rejected (merged follicles, cysts or shadowing)")
+
+    return FollicleDetection(follicles, mm_per_pixel, calibration_source, confidence,
+                             rejected_candidates=rejected,
+                             processing_time=round(time.time() - start, 4), notes=notes)
+
+def detect_follicles(payload: ImagePayload, mm_per_pixel: Optional[float] = None,
+                     default_mm_per_pixel: Optional[float] = None) -> FollicleDetection:
+    """Follicles on an uploaded scan; calibration from the caller, then DICOM metadata, then the default"""
+    source = "caller" if mm_per_pixel else "none"
+    if payload.mime_type == "application/dicom":
+        gray, dicom_scale = read_dicom(payload.data)
+        if not mm_per_pixel and dicom_scale:
+            mm_per_pixel, source = dicom_scale, "dicom"
+    else:
+        image = decode_image(payload.data)
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image is not None else None
+    if not mm_per_pixel and default_mm_per_pixel:
+        mm_per_pixel, source = default_mm_per_pixel, "config"
+    if gray is None:
+        return FollicleDetection([], mm_per_pixel, source, 0.0, notes=["Image could not be decoded"])
+    return detect_follicles_in_frame(gray, mm_per_pixel, source)
@@ -7,6 +7,10 @@ import io
 from typing import Dict, List, Optional, Tuple
 import cv2
 import numpy as np
+from image_payload import ImagePayload
+from image_preprocessing import preprocess_file
+from batch_preprocessing import preprocess_many
+from request_scheduler import scheduler_registry, SchedulerError
 
 class ImageAnalyzer:
     def __init__(self, deepseek_api_key: str = None, deepseek_url: str = "http://localhost:11434/api/generate", mock_mode: bool = False):
@@ -22,38 +26,12 @@ class ImageAnalyzer:
         """Convert image to base64 for LLM processing"""
         with open(image_path, "rb") as image_file:
             return base64.b64encode(image_file.read()).decode('utf-8')
-    def preprocess_image(self, image_path: str, analysis_type: str) -> str:
-        """Preprocess microscopy images for better analysis"""
-        try:
-            # Load image
-            image = cv2.imread(image_path)
-            if image is None:
-                return image_path  # Return original if can't process
-            if analysis_type == "sperm":
-                # Enhance contrast for sperm analysis
-                lab = cv2.cvtColor(image, cv2.COLOR_BGR2LAB)
-                l, a, b = cv2.split(lab)
-                clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8,8))
-                l = clahe.apply(l)
-                enhanced = cv2.merge([l, a, b])
-                enhanced = cv2.cvtColor(enhanced, cv2.COLOR_LAB2BGR)
-            elif analysis_type == "oocyte":
-                # Enhance for oocyte structure visibility
-                gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-                enhanced = cv2.equalizeHist(gray)
-                enhanced = cv2.cvtColor(enhanced, cv2.COLOR_GRAY2BGR)
-            elif analysis_type == "embryo":
-                # Enhance for cell boundary detection
-                enhanced = cv2.bilateralFilter(image, 9, 75, 75)
-            else:
-                enhanced = image
-            # Save preprocessed image
-            processed_path = image_path.replace('.', '_processed.')
-            cv2.imwrite(processed_path, enhanced)
-            return processed_path
-        except Exception as e:
-            print(f"Error preprocessing image: {e}")
-            return image_path  # Return original path if processing fails
+    def preprocess_image(self, image_path: str, analysis_type: str) -> ImagePayload:
+        """Preprocess microscopy images for better analysis, in memory (see image_preprocessing)"""
+        return preprocess_file(image_path, analysis_type)
+    def preprocess_many(self, image_paths: List[str], analysis_type: str) -> List[ImagePayload]:
+        """Preprocess a batch of microscopy images on all cores, in input order (see batch_preprocessing)"""
+        return preprocess_many(image_paths, analysis_type)
     def analyze_sperm_image(self, image_path: str) -> Dict:
         """Analyze sperm microscopy image using DeepSeek LLM"""
         try:
@@ -92,8 +70,7 @@ DETAILED OBSERVATIONS:
 """
                 }
             
-            processed_image = self.preprocess_image(image_path, "sperm")
-            base64_image = self.encode_image_to_base64(processed_image)
+            image = self.preprocess_image(image_path, "sperm")
             prompt = """
             You are an expert andrologist with subspecialty training in male reproductive medicine analyzing a sperm microscopy image for educational purposes. Please provide a comprehensive technical assessment following WHO 2021 laboratory manual guidelines.
 
@@ -128,7 +105,7 @@ DETAILED OBSERVATIONS:
 
             Please provide specific numerical estimates and clinical correlations based on current evidence-based standards.
             """
-            return self._query_deepseek(prompt, base64_image)
+            return self._query_deepseek(prompt, image)
         except Exception as e:
             return {
                 "success": False,
@@ -174,8 +151,7 @@ DETAILED OBSERVATIONS:
 """
                 }
             
-            processed_image = self.preprocess_image(image_path, "oocyte")
-            base64_image = self.encode_image_to_base64(processed_image)
+            image = self.preprocess_image(image_path, "oocyte")
             prompt = """
             You are an expert embryologist analyzing an oocyte microscopy image. Please analyze this image following ESHRE guidelines:
 
@@ -200,7 +176,7 @@ DETAILED OBSERVATIONS:
             
             Base your assessment on standard ESHRE oocyte grading criteria.
             """
-            return self._query_deepseek(prompt, base64_image)
+            return self._query_deepseek(prompt, image)
         except Exception as e:
             return {
                 "success": False,
@@ -277,8 +253,7 @@ DETAILED OBSERVATIONS:
 """
                     }
             
-            processed_image = self.preprocess_image(image_path, "embryo")
-            base64_image = self.encode_image_to_base64(processed_image)
+            image = self.preprocess_image(image_path, "embryo")
             if day <= 3:
                 prompt = f"""
                 You are an expert embryologist analyzing a Day {day} embryo microscopy image. Please analyze following ASRM/ESHRE guidelines:
@@ -337,29 +312,31 @@ DETAILED OBSERVATIONS:
 
                 Please provide precise morphological assessments and evidence-based clinical correlations.
                 """
-            return self._query_deepseek(prompt, base64_image)
+            return self._query_deepseek(prompt, image)
         except Exception as e:
             return {
                 "success": False,
                 "error": f"Image analysis failed: {str(e)}",
                 "analysis": ""
             }
-    def _query_deepseek(self, prompt: str, base64_image: str) -> Dict:
+    def _query_deepseek(self, prompt: str, image: ImagePayload) -> Dict:
         """Query Vision LLM with image and prompt"""
         try:
             # For Ollama local installation - use vision-capable model
             payload = {
                 "model": "llava:7b",  # Changed to llava for better vision support
                 "prompt": prompt,
-                "images": [base64_image],
+                "images": [image.base64],
                 "stream": False
             }
-            response = requests.post(
-                self.deepseek_url,
-                json=payload,
-                headers={"Content-Type": "application/json"},
-                timeout=90  # Increased timeout for LLaVA vision analysis
-            )
+            # Local LLaVA is CPU-bound - wait for a free slot instead of overloading it
+            with scheduler_registry.get_or_create(self.deepseek_url).slot():
+                response = requests.post(
+                    self.deepseek_url,
+                    json=payload,
+                    headers={"Content-Type": "application/json"},
+                    timeout=90  # Increased timeout for LLaVA vision analysis
+                )
             if response.status_code == 200:
                 result = response.json()
                 return {
@@ -373,6 +350,12 @@ DETAILED OBSERVATIONS:
                     "error": f"API Error: {response.status_code}",
                     "analysis": ""
                 }
+        except SchedulerError as e:
+            return {
+                "success": False,
+                "error": f"Vision LLM busy: {e}",
+                "analysis": ""
+            }
         except requests.exceptions.ConnectionError:
             return {
                 "success": False,
@@ -0,0 +1,245 @@
+"""
+FertiVision powered by AI - Image Payload
+
+Holds an image's bytes once for the whole analysis pipeline. The base64 text,
+SHA-256 digest and MIME type are computed on first use and reused by every
+provider call in the fallback chain, so a large TIFF/DICOM upload is read and
+encoded a single time.
+
+Payloads can be transcoded to a provider's image profile (longest edge, format,
+quality). Vision encoders downscale large images anyway, so sending a 4K TIFF
+only costs upload time and image tokens.
+
+© 2025 FertiVision powered by AI (made by greybrain.ai) - DeepSeek LLM Image Analysis
+"""
+
+import io
+import os
+import base64
+import hashlib
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+# PIL is optional - without it images are sent unchanged
+try:
+    from PIL import Image
+    PIL_AVAILABLE = True
+except ImportError:
+    PIL_AVAILABLE = False
+
+# Transcoded payloads kept across requests, keyed on (source hash, profile)
+TRANSCODE_CACHE_BYTES = 128 * 1024 * 1024
+
+# Magic numbers for the formats accepted by the upload forms
+_SIGNATURES = [
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+    (b"BM", "image/bmp"),
+    (b"II*\x00", "image/tiff"),
+    (b"MM\x00*", "image/tiff"),
+]
+
+_EXTENSION_TYPES = {
+    '.jpg': "image/jpeg",
+    '.jpeg': "image/jpeg",
+    '.png': "image/png",
+    '.gif': "image/gif",
+    '.bmp': "image/bmp",
+    '.tif': "image/tiff",
+    '.tiff': "image/tiff",
+    '.webp': "image/webp",
+    '.dcm': "application/dicom",
+}
+
+def detect_mime_type(data: bytes, filename: Optional[str] = None) -> str:
+    """Guess the MIME type from magic bytes, then the file extension"""
+    for signature, mime_type in _SIGNATURES:
+        if data.startswith(signature):
+            return mime_type
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    if data[128:132] == b"DICM":
+        return "application/dicom"
+    if filename:
+        return _EXTENSION_TYPES.get(os.path.splitext(filename)[1].lower(), "image/jpeg")
+    return "image/jpeg"
+
+@dataclass(frozen=True)
+class ImageProfile:
+    """Image shape a provider should receive"""
+    max_edge: int = 0  # Longest edge in pixels, 0 = keep size
+    format: str = "jpeg"  # jpeg, png or original
+    quality: int = 90  # JPEG quality
+
+_FORMAT_TYPES = {"jpeg": "image/jpeg", "png": "image/png"}
+
+class _TranscodeCache:
+    """Byte-bounded LRU of transcoded payloads"""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[Tuple[str, ImageProfile], ImagePayload]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            payload = self._entries.get(key)
+            if payload is not None:
+                self._entries.move_to_end(key)
+            return payload
+
+    def put(self, key, payload: "ImagePayload"):
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = payload
+            self._bytes += len(payload)
+            while self._bytes > self.max_bytes and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+transcode_cache = _TranscodeCache(TRANSCODE_CACHE_BYTES)
+
+def _to_8bit(image: "Image.Image") -> "Image.Image":
+    """Scale 16-bit and float images (common for microscopy TIFFs) into 8-bit range"""
+    if image.mode in ("I;16", "I;16B", "I;16L", "I", "F"):
+        array = np.asarray(image, dtype=np.float32)
+        low, high = float(array.min()), float(array.max())
+        scale = 255.0 / (high - low) if high > low else 1.0
+        return Image.fromarray(((array - low) * scale).astype(np.uint8), mode="L")
+    return image
+
+class ImagePayload:
+    """Image bytes with lazily computed base64, digest and MIME type"""
+
+    def __init__(self, data: bytes, mime_type: Optional[str] = None, source_path: Optional[str] = None):
+        self.data = data
+        self.source_path = source_path
+        self._mime_type = mime_type
+        self._base64: Optional[str] = None
+        self._sha256: Optional[str] = None
+        self._variants: Dict[ImageProfile, "ImagePayload"] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_file(cls, path: str, mime_type: Optional[str] = None) -> "ImagePayload":
+        with open(path, "rb") as f:
+            return cls(f.read(), mime_type=mime_type, source_path=path)
+
+    @classmethod
+    def from_base64(cls, encoded: str, mime_type: Optional[str] = None) -> "ImagePayload":
+        payload = cls(base64.b64decode(encoded), mime_type=mime_type)
+        payload._base64 = encoded
+        return payload
+
+    @property
+    def base64(self) -> str:
+        """Base64 text, encoded once and shared by every provider call"""
+        if self._base64 is None:
+            with self._lock:
+                if self._base64 is None:
+                    self._base64 = base64.b64encode(self.data).decode('utf-8')
+        return self._base64
+
+    @property
+    def sha256(self) -> str:
+        if self._sha256 is None:
+            self._sha256 = hashlib.sha256(self.data).hexdigest()
+        return self._sha256
+
+    @property
+    def mime_type(self) -> str:
+        if self._mime_type is None:
+            self._mime_type = detect_mime_type(self.data, self.source_path)
+        return self._mime_type
+
+    def transcode(self, profile: ImageProfile) -> "ImagePayload":
+        """
+        Payload matching the profile, computed once per profile and image hash
+
+        Returns self when the image already fits, PIL is unavailable or the
+        image cannot be decoded (e.g. DICOM) - the provider gets the original.
+        """
+        if profile.format == "original" and not profile.max_edge:
+            return self
+        variant = self._variants.get(profile)
+        if variant is not None:
+            return variant
+
+        with self._lock:
+            variant = self._variants.get(profile)
+            if variant is None:
+                key = (self.sha256, profile)
+                variant = transcode_cache.get(key)
+                if variant is None:
+                    variant = self._transcode(profile)
+                    if variant is not self:
+                        transcode_cache.put(key, variant)
+                self._variants[profile] = variant
+        return variant
+
+    def _transcode(self, profile: ImageProfile) -> "ImagePayload":
+        if not PIL_AVAILABLE:
+            return self
+        try:
+            image = Image.open(io.BytesIO(self.data))
+            image.seek(0)  # First page of multi-page TIFFs
+        except Exception:
+            return self
+
+        too_large = profile.max_edge > 0 and max(image.size) > profile.max_edge
+        target_format = profile.format
+        if target_format == "original":
+            if not too_large:
+                return self
+            # Providers accept few formats - resized TIFF/BMP sources become PNG
+            target_format = self.mime_type.split("/")[-1]
+            if target_format not in _FORMAT_TYPES:
+                target_format = "png"
+        target_type = _FORMAT_TYPES.get(target_format)
+        if target_type is None or (not too_large and target_type == self.mime_type):
+            return self
+
+        try:
+            image = _to_8bit(image)
+            if too_large:
+                image.thumbnail((profile.max_edge, profile.max_edge), Image.LANCZOS)
+
+            output = io.BytesIO()
+            if target_format == "jpeg":
+                if image.mode not in ("RGB", "L"):
+                    image = image.convert("RGB")
+                image.save(output, format="JPEG", quality=profile.quality, optimize=True)
+            else:
+                if image.mode not in ("RGB", "RGBA", "L", "LA", "P"):
+                    image = image.convert("RGB")
+                image.save(output, format="PNG", optimize=True)
+        except Exception as e:
+            print(f"⚠️ Image transcode failed, sending original: {e}")
+            return self
+
+        data = output.getvalue()
+        if len(data) >= len(self.data) and not too_large:
+            return self
+        return ImagePayload(data, mime_type=target_type, source_path=self.source_path)
+
+    def data_url(self) -> str:
+        return f"data:{self.mime_type};base64,{self.base64}"
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def __repr__(self) -> str:
+        return f"ImagePayload({len(self.data)} bytes, {self.mime_type})"
@@ -0,0 +1,162 @@
+"""
+FertiVision powered by AI - In-Memory Image Preprocessing
+
+Contrast enhancement applied to microscopy and ultrasound images before they
+go to the vision model. The upload is decoded once from its bytes, enhanced
+as a NumPy array and encoded straight into a buffer with cv2.imencode; the
+result is an ImagePayload, so nothing is written to or read back from disk
+and uploads/ only holds the uploads themselves.
+
+Results are cached by source hash, kind and PREPROCESS_VERSION (see
+preprocess_cache), so an image that was already analyzed is not enhanced
+again.
+
+Set FERTIVISION_PREPROCESS_DEBUG_DIR (or pass debug_dir) to also save each
+processed image there for inspection.
+
+Batches of uploads go through batch_preprocessing.preprocess_many, which
+fans the same work out to a process pool.
+
+Usage:
+    payload = preprocess_file(image_path, "sperm")
+
+© 2025 FertiVision powered by AI (made by greybrain.ai) - DeepSeek LLM Image Analysis
+"""
+
+import os
+from typing import Callable, Dict, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from image_payload import ImagePayload
+from preprocess_cache import PreprocessCache, preprocess_cache
+
+# Bump when an enhancement or its parameters change; cached variants of older versions are ignored
+PREPROCESS_VERSION = 1
+
+# Debug option: folder that receives a copy of every processed image
+DEBUG_DIR = os.getenv('FERTIVISION_PREPROCESS_DEBUG_DIR') or None
+
+# Encoder extension per source type; other formats (GIF, DICOM, ...) become PNG
+_ENCODINGS = {
+    "image/jpeg": (".jpg", "image/jpeg"),
+    "image/png": (".png", "image/png"),
+    "image/bmp": (".bmp", "image/bmp"),
+    "image/tiff": (".tiff", "image/tiff"),
+    "image/webp": (".webp", "image/webp"),
+}
+
+def _clahe_luminance(image: np.ndarray, clip_limit: float) -> np.ndarray:
+    """CLAHE on the L channel of LAB, colours kept"""
+    lab = cv2.cvtColor(image, cv2.COLOR_BGR2LAB)
+    l, a, b = cv2.split(lab)
+    l = cv2.createCLAHE(clipLimit=clip_limit, tileGridSize=(8, 8)).apply(l)
+    return cv2.cvtColor(cv2.merge([l, a, b]), cv2.COLOR_LAB2BGR)
+
+def _enhance_sperm(image: np.ndarray) -> np.ndarray:
+    # Contrast for sperm heads and tails
+    return _clahe_luminance(image, 2.0)
+
+def _enhance_oocyte(image: np.ndarray) -> np.ndarray:
+    # Oocyte structure visibility
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    return cv2.cvtColor(cv2.equalizeHist(gray), cv2.COLOR_GRAY2BGR)
+
+def _enhance_embryo(image: np.ndarray) -> np.ndarray:
+    # Edge-preserving smoothing for cell boundaries
+    return cv2.bilateralFilter(image, 9, 75, 75)
+
+def _enhance_follicle(image: np.ndarray) -> np.ndarray:
+    # Follicle contrast in grayscale ultrasound
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    enhanced = cv2.createCLAHE(clipLimit=3.0, tileGridSize=(8, 8)).apply(gray)
+    return cv2.cvtColor(enhanced, cv2.COLOR_GRAY2BGR)
+
+def _enhance_hysteroscopy(image: np.ndarray) -> np.ndarray:
+    # Endometrial structure visibility
+    return _clahe_luminance(image, 2.0)
+
+ENHANCERS: Dict[str, Callable[[np.ndarray], np.ndarray]] = {
+    "sperm": _enhance_sperm,
+    "oocyte": _enhance_oocyte,
+    "embryo": _enhance_embryo,
+    "follicle": _enhance_follicle,
+    "hysteroscopy": _enhance_hysteroscopy,
+}
+
+def decode_image(data: bytes) -> Optional[np.ndarray]:
+    """BGR array of encoded image bytes, None when OpenCV cannot decode them"""
+    if not data:
+        return None
+    return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+def encode_buffer(image: np.ndarray, mime_type: str) -> Tuple[np.ndarray, str]:
+    """Encoded bytes (uint8 array) and MIME type, in the source format when OpenCV can write it"""
+    extension, target_type = _ENCODINGS.get(mime_type, (".png", "image/png"))
+    ok, buffer = cv2.imencode(extension, image)
+    if not ok:
+        ok, buffer = cv2.imencode(".png", image)
+        target_type = "image/png"
+        if not ok:
+            raise ValueError("Could not encode processed image")
+    return buffer, target_type
+
+def encode_image(image: np.ndarray, mime_type: str) -> ImagePayload:
+    """Encode an array in the source format (PNG when OpenCV cannot write it)"""
+    buffer, target_type = encode_buffer(image, mime_type)
+    return ImagePayload(buffer.tobytes(), mime_type=target_type)
+
+def cache_key(payload: ImagePayload, kind: str) -> str:
+    """Preprocess cache key of an image for one analysis kind"""
+    return PreprocessCache.make_key(payload.sha256, kind, PREPROCESS_VERSION)
+
+def deliver(processed: ImagePayload, payload: ImagePayload, kind: str,
+            debug_dir: Optional[str] = DEBUG_DIR) -> ImagePayload:
+    """Processed image as handed to the analyzers, tagged with the upload's path"""
+    if debug_dir:
+        _write_debug_copy(processed, kind, debug_dir, payload.source_path)
+    # Cached entries are shared between uploads with the same content; the bytes are not copied
+    return ImagePayload(processed.data, mime_type=processed.mime_type, source_path=payload.source_path)
+
+def preprocess_payload(payload: ImagePayload, kind: str, debug_dir: Optional[str] = DEBUG_DIR,
+                       cache: Optional[PreprocessCache] = None) -> ImagePayload:
+    """
+    Enhanced copy of an image for the given analysis kind, cached
+
+    Returns the payload unchanged for unknown kinds, images OpenCV cannot
+    decode (e.g. DICOM) or when processing fails.
+    """
+    enhance = ENHANCERS.get(kind)
+    if enhance is None:
+        return payload
+    cache = cache or preprocess_cache
+    key = cache_key(payload, kind)
+    processed = cache.get(key)
+    if processed is None:
+        try:
+            image = decode_image(payload.data)
+            if image is None:
+                return payload
+            processed = encode_image(enhance(image), payload.mime_type)
+        except Exception as e:
+            print(f"⚠️ Preprocessing failed, sending original image: {e}")
+            return payload
+        cache.put(key, processed)
+
+    return deliver(processed, payload, kind, debug_dir)
+
+def preprocess_file(image_path: str, kind: str, debug_dir: Optional[str] = DEBUG_DIR,
+                    cache: Optional[PreprocessCache] = None) -> ImagePayload:
+    """Read an upload once and preprocess it in memory"""
+    return preprocess_payload(ImagePayload.from_file(image_path), kind, debug_dir, cache)
+
+def _write_debug_copy(payload: ImagePayload, kind: str, debug_dir: str, source_path: Optional[str]):
+    try:
+        os.makedirs(debug_dir, exist_ok=True)
+        base = os.path.splitext(os.path.basename(source_path or "image"))[0]
+        extension = _ENCODINGS.get(payload.mime_type, (".png",))[0]
+        with open(os.path.join(debug_dir, f"{base}_{kind}_processed{extension}"), "wb") as f:
+            f.write(payload.data)
+    except OSError as e:
+        print(f"⚠️ Could not write preprocessing debug image: {e}")
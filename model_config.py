@@ -54,6 +54,16 @@ class AnalysisType(Enum):
     OOCYTE_ANALYSIS = "oocyte_analysis"
     HYSTEROSCOPY_ANALYSIS = "hysteroscopy_analysis"
 
+# Largest image edge each provider's vision encoder makes use of
+PROVIDER_IMAGE_MAX_EDGE = {
+    ModelProvider.OLLAMA_LOCAL: 1344,
+    ModelProvider.OPENAI: 2048,
+    ModelProvider.ANTHROPIC: 1568,
+    ModelProvider.GOOGLE: 3072,
+    ModelProvider.OPENROUTER: 2048,
+    ModelProvider.GROQ: 2048,
+}
+
 @dataclass
 class ModelConfig:
     """Configuration for a specific model"""
@@ -67,6 +77,12 @@ class ModelConfig:
     enabled: bool = True
     cost_per_1k_tokens: float = 0.0
     notes: str = ""
+    max_in_flight: int = 0  # Concurrent requests to the endpoint (0 = provider default, unbounded for cloud APIs)
+    max_queue: int = 16  # Requests allowed to wait for a slot before callers get a queue-full error
+    queue_timeout: float = 60.0  # Seconds a request may wait for a slot
+    image_max_edge: int = 0  # Longest image edge sent to the provider (0 = provider default, -1 = never resize)
+    image_format: str = "jpeg"  # jpeg, png or original
+    image_quality: int = 90  # JPEG quality for transcoded images
 
 @dataclass
 class AnalysisConfig:
@@ -77,6 +93,9 @@ class AnalysisConfig:
     use_fallback: bool = True
     quality_threshold: float = 0.8
     max_retries: int = 2
+    hedge_requests: bool = False  # Race the next fallback when the current call is slow
+    hedge_percentile: float = 95.0  # Latency percentile of the running model that triggers a hedge
+    hedge_delay: float = 15.0  # Seconds to wait before hedging until enough latency samples exist
 
 class FertiVisionModelManager:
     """Manages model configurations for FertiVision"""
@@ -322,7 +341,10 @@ class FertiVisionModelManager:
                         fallback_models=fallback_models,
                         use_fallback=config_data.get('use_fallback', True),
                         quality_threshold=config_data.get('quality_threshold', 0.8),
-                        max_retries=config_data.get('max_retries', 2)
+                        max_retries=config_data.get('max_retries', 2),
+                        hedge_requests=config_data.get('hedge_requests', False),
+                        hedge_percentile=config_data.get('hedge_percentile', 95.0),
+                        hedge_delay=config_data.get('hedge_delay', 15.0)
                     )
                     
                     self.configurations[analysis_type] = analysis_config
@@ -349,7 +371,10 @@ class FertiVisionModelManager:
                     'fallback_models': [asdict(model) for model in config.fallback_models],
                     'use_fallback': config.use_fallback,
                     'quality_threshold': config.quality_threshold,
-                    'max_retries': config.max_retries
+                    'max_retries': config.max_retries,
+                    'hedge_requests': config.hedge_requests,
+                    'hedge_percentile': config.hedge_percentile,
+                    'hedge_delay': config.hedge_delay
                 }
                 
                 # Convert enums to strings
@@ -4,19 +4,65 @@ FertiVision powered by AI - Model Service Manager
 This module handles API calls to different model providers with automatic fallback
 and quality assessment.
 
+Provider calls run on a shared asyncio event loop with pooled HTTP connections,
+so a single process can keep many analyses in flight at once. The synchronous
+API is a thin wrapper over the async one.
+
+Requests are built and parsed by the provider adapters in provider_adapters.py.
+Every endpoint host gets its own keep-alive connection pool sized to the
+host's configured concurrency.
+
 © 2025 FertiVision powered by AI (made by greybrain.ai) - DeepSeek LLM Image Analysis
 """
 
 import requests
-import base64
+from requests.adapters import HTTPAdapter
 import json
 import time
-from typing import Dict, Optional, List, Any, Tuple
-from dataclasses import dataclass
+import re
+import queue
+import asyncio
+import atexit
+import threading
+from collections import deque
+from contextlib import nullcontext
+from typing import Dict, Optional, List, Any, Tuple, Callable, Iterator, AsyncIterator
+from dataclasses import dataclass, field
 from model_config import (
-    ModelProvider, AnalysisType, ModelConfig, AnalysisConfig, 
-    model_manager
+    ModelProvider, AnalysisType, ModelConfig, AnalysisConfig,
+    PROVIDER_IMAGE_MAX_EDGE, model_manager
+)
+from response_cache import ResponseCache
+from circuit_breaker import CircuitBreakerRegistry, CircuitState, probe_url
+from image_payload import ImagePayload, ImageProfile
+from telemetry import Telemetry, telemetry as default_telemetry
+from request_scheduler import (
+    SchedulerRegistry, EndpointScheduler, SchedulerError,
+    DEFAULT_OLLAMA_IN_FLIGHT, scheduler_registry, endpoint_key
 )
+from provider_adapters import (
+    ProviderAdapter, ProviderRequest, ProviderResponseError, get_adapter
+)
+
+# aiohttp is optional - without it async calls run the requests transport in a thread pool
+try:
+    import aiohttp
+    AIOHTTP_AVAILABLE = True
+except ImportError:
+    AIOHTTP_AVAILABLE = False
+
+USER_AGENT = 'FertiVision-powered-by-AI/1.0'
+
+# Connections kept per host for endpoints without a max_in_flight limit
+DEFAULT_HOST_POOL_SIZE = 32
+
+# Recent latencies kept per model for hedge delay percentiles
+LATENCY_HISTORY_SIZE = 200
+MIN_LATENCY_SAMPLES = 20
+
+# Background health probes for endpoints with an open circuit
+PROBE_INTERVAL = 5.0
+PROBE_TIMEOUT = 3.0
 
 @dataclass
 class ModelResponse:
@@ -30,23 +76,199 @@ class ModelResponse:
     cost: float = 0.0
     error: Optional[str] = None
     quality_score: Optional[float] = None
+    attempts: List[Dict[str, Any]] = field(default_factory=list)  # Every call made for this analysis
+    cached: bool = False  # Served from the response cache
+    stopped_early: bool = False  # Streaming stopped once the required fields were captured
+    partial_response: Optional[str] = None  # Text streamed before the stream failed
+
+@dataclass
+class StreamChunk:
+    """Incremental piece of a streamed model response"""
+    text: str
+    done: bool = False
+    response: Optional[ModelResponse] = None  # Final response, set on the last chunk
+
+class AsyncProviderEngine:
+    """Background event loop with a pooled HTTP client for provider calls"""
+
+    def __init__(self, max_connections: int = 100, max_connections_per_host: int = DEFAULT_HOST_POOL_SIZE):
+        self.max_connections = max_connections
+        self.max_connections_per_host = max_connections_per_host
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._sessions: Dict[str, Tuple[Any, int]] = {}  # host -> (session, pool size)
+        self._retired: List[Any] = []
+        self._lock = threading.Lock()
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        """Event loop running in the engine thread (started on first use)"""
+        with self._lock:
+            if self._loop is None or self._loop.is_closed():
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(
+                    target=self._loop.run_forever,
+                    name="fertivision-provider-engine",
+                    daemon=True
+                )
+                self._thread.start()
+            return self._loop
+
+    def in_engine_thread(self) -> bool:
+        """Check whether the caller is running on the engine loop"""
+        return self._thread is not None and threading.current_thread() is self._thread
+
+    def run(self, coro, timeout: Optional[float] = None):
+        """Run a coroutine on the engine loop and block until it completes"""
+        if self.in_engine_thread():
+            coro.close()
+            raise RuntimeError("Blocking call from the provider engine loop; await the async API instead")
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        return future.result(timeout)
+
+    async def get_session(self, url: str, pool_size: int = 0):
+        """
+        aiohttp session for the URL's host (pool_size 0 = keep current); must be awaited on the engine loop
+
+        Each host has its own connector, so a slow provider holding all of its
+        connections never starves calls to another one. The pool grows when a
+        model asks for more connections than the host has.
+        """
+        key = endpoint_key(url)
+        session, current = self._sessions.get(key, (None, 0))
+        size = min(pool_size or current or self.max_connections_per_host, self.max_connections)
+        if session is None or session.closed or current < size:
+            if session is not None and not session.closed:
+                # Requests in flight finish on the old pool; it is closed with the engine
+                self._retired.append(session)
+            connector = aiohttp.TCPConnector(
+                limit=size,
+                limit_per_host=size,
+                keepalive_timeout=60
+            )
+            session = aiohttp.ClientSession(
+                connector=connector,
+                headers={'User-Agent': USER_AGENT}
+            )
+            self._sessions[key] = (session, size)
+        return session
+
+    def pool_sizes(self) -> Dict[str, int]:
+        """Connection limit per host"""
+        return {key: size for key, (_, size) in list(self._sessions.items())}
+
+    async def _close_session(self):
+        sessions = [session for session, _ in self._sessions.values()] + self._retired
+        self._sessions = {}
+        self._retired = []
+        for session in sessions:
+            if not session.closed:
+                await session.close()
+
+    def close(self):
+        """Close pooled connections and stop the engine loop"""
+        with self._lock:
+            loop, thread = self._loop, self._thread
+            self._loop = None
+            self._thread = None
+        if loop is None or loop.is_closed():
+            return
+        try:
+            asyncio.run_coroutine_threadsafe(self._close_session(), loop).result(5)
+        except Exception:
+            pass
+        loop.call_soon_threadsafe(loop.stop)
+        if thread is not None:
+            thread.join(5)
+        loop.close()
+
+class HostSessionPool:
+    """Blocking requests sessions, one keep-alive pool per endpoint host"""
+
+    def __init__(self):
+        self._sessions: Dict[str, Tuple[requests.Session, int]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, url: str, pool_size: int = 0) -> requests.Session:
+        """
+        Session for the URL's host with room for pool_size connections (0 = keep current)
+
+        requests keeps 10 connections per host by default and discards the
+        rest ("Connection pool is full"), so threads calling a provider beyond
+        that reconnect on every request.
+        """
+        key = endpoint_key(url)
+        with self._lock:
+            session, current = self._sessions.get(key, (None, 0))
+            if session is None:
+                session = requests.Session()
+                session.headers.update({
+                    'User-Agent': USER_AGENT
+                })
+            size = pool_size or current or DEFAULT_HOST_POOL_SIZE
+            if current < size:
+                session.mount(f"{key}/", HTTPAdapter(pool_connections=1, pool_maxsize=size))
+                self._sessions[key] = (session, size)
+            return session
+
+    def pool_sizes(self) -> Dict[str, int]:
+        """Connection pool size per host"""
+        with self._lock:
+            return {key: size for key, (_, size) in self._sessions.items()}
+
+    def close(self):
+        with self._lock:
+            for session, _ in self._sessions.values():
+                session.close()
+            self._sessions.clear()
 
 class ModelServiceManager:
     """Manages API calls to different model providers"""
-    
-    def __init__(self):
-        self.session = requests.Session()
-        self.session.headers.update({
-            'User-Agent': 'FertiVision-powered-by-AI/1.0'
-        })
-    
-    def analyze_with_model(self, 
+
+    def __init__(self,
+                 response_cache: Optional[ResponseCache] = None,
+                 schedulers: Optional[SchedulerRegistry] = None,
+                 telemetry: Optional[Telemetry] = None):
+        self.host_sessions = HostSessionPool()
+        self.engine = AsyncProviderEngine()
+        self.response_cache = response_cache if response_cache is not None else ResponseCache()
+        self.circuit_breakers = CircuitBreakerRegistry()
+        self.schedulers = schedulers if schedulers is not None else scheduler_registry
+        self.probe_interval = PROBE_INTERVAL
+        self.telemetry = telemetry if telemetry is not None else default_telemetry
+        self.telemetry.register_collector(self._collect_metrics)
+        self._latency_history: Dict[Tuple[str, str, str], deque] = {}
+
+    def analyze_with_model(self,
                           analysis_type: AnalysisType,
                           prompt: str,
                           image_path: Optional[str] = None,
+                          image: Optional[ImagePayload] = None,
                           **kwargs) -> ModelResponse:
         """
         Analyze using configured model with automatic fallback
+
+        Blocking wrapper around analyze_with_model_async.
+        """
+        return self.engine.run(
+            self.analyze_with_model_async(analysis_type, prompt, image_path, image=image, **kwargs)
+        )
+
+    async def analyze_with_model_async(self,
+                                       analysis_type: AnalysisType,
+                                       prompt: str,
+                                       image_path: Optional[str] = None,
+                                       image: Optional[ImagePayload] = None,
+                                       hedge: Optional[bool] = None,
+                                       use_cache: bool = True,
+                                       **kwargs) -> ModelResponse:
+        """
+        Analyze using configured model with automatic fallback, without blocking
+
+        Pass the image as an ImagePayload (preferred - it is encoded once for the
+        whole fallback chain) or as image_path, which is read once here.
+        hedge overrides the configured hedge_requests setting for this call.
+        use_cache=False skips the response cache lookup and forces a fresh model call.
         """
         config = model_manager.get_config(analysis_type)
         if not config:
@@ -58,916 +280,977 @@ class ModelServiceManager:
                 processing_time=0.0,
                 error=f"No configuration found for {analysis_type.value}"
             )
-        
+
+        if image is None and image_path:
+            try:
+                loop = asyncio.get_running_loop()
+                image = await loop.run_in_executor(None, ImagePayload.from_file, image_path)
+            except OSError as e:
+                return self._error_response(config.primary_model, 0.0, f"Failed to read image: {e}")
+
+        cache_keys: Dict[Tuple[str, str], str] = {}
+        if self.response_cache.enabled:
+            cache_keys = await self._cache_keys(config, prompt, image)
+            if use_cache:
+                cached = self._cache_lookup(cache_keys)
+                if cached:
+                    self._record_telemetry(analysis_type, cached)
+                    return cached
+
+        use_hedging = config.hedge_requests if hedge is None else hedge
+        if use_hedging:
+            response = await self._analyze_hedged(config, analysis_type, prompt, image, **kwargs)
+            self._cache_store(cache_keys, response, config)
+            self._record_telemetry(analysis_type, response)
+            return response
+
+        attempts = []
+
         # Try primary model first
-        response = self._call_model(config.primary_model, prompt, image_path, **kwargs)
-        
+        response = await self._timed_call(config.primary_model, prompt, image, attempts, **kwargs)
+
         # Check if we need to use fallback
         if not response.success and config.use_fallback:
             print(f"⚠️ Primary model failed, trying fallback models...")
-            
+
             for fallback_model in config.fallback_models:
                 if not fallback_model.enabled:
                     continue
-                    
+
                 print(f"🔄 Trying fallback: {fallback_model.provider.value}")
-                response = self._call_model(fallback_model, prompt, image_path, **kwargs)
-                
+                response = await self._timed_call(fallback_model, prompt, image, attempts, **kwargs)
+
                 if response.success:
                     print(f"✅ Fallback successful: {fallback_model.provider.value}")
                     break
-        
+
         # Assess quality if successful
         if response.success and config.quality_threshold > 0:
             quality_score = self._assess_response_quality(response.response, analysis_type)
             response.quality_score = quality_score
-            
+
             if quality_score < config.quality_threshold:
                 print(f"⚠️ Response quality below threshold: {quality_score:.2f} < {config.quality_threshold}")
-        
+
+        response.attempts = attempts
+        self._cache_store(cache_keys, response, config)
+        self._record_telemetry(analysis_type, response)
         return response
-    
-    def _call_model(self, 
-                   model_config: ModelConfig,
-                   prompt: str,
-                   image_path: Optional[str] = None,
-                   **kwargs) -> ModelResponse:
-        """Call a specific model"""
-        
-        if not model_config.enabled:
-            return ModelResponse(
-                success=False,
-                response="",
-                provider=model_config.provider,
-                model_name=model_config.model_name,
-                processing_time=0.0,
-                error="Model is disabled"
+
+    def _record_telemetry(self, analysis_type: AnalysisType, response: ModelResponse):
+        """Feed every attempt of an analysis into the telemetry counters"""
+        if response.cached:
+            self.telemetry.record_cache_hit(analysis_type.value, response.provider.value, response.model_name)
+            return
+        self.telemetry.record_attempts(analysis_type.value, response.attempts)
+        if response.success:
+            self.telemetry.record_quality(
+                analysis_type.value, response.provider.value, response.model_name, response.quality_score
             )
-        
-        start_time = time.time()
-        
-        try:
-            if model_config.provider == ModelProvider.OLLAMA_LOCAL:
-                return self._call_ollama(model_config, prompt, image_path, **kwargs)
-            elif model_config.provider == ModelProvider.OPENAI:
-                return self._call_openai(model_config, prompt, image_path, **kwargs)
-            elif model_config.provider == ModelProvider.ANTHROPIC:
-                return self._call_anthropic(model_config, prompt, image_path, **kwargs)
-            elif model_config.provider == ModelProvider.GOOGLE:
-                return self._call_google(model_config, prompt, image_path, **kwargs)
-            elif model_config.provider == ModelProvider.OPENROUTER:
-                return self._call_openrouter(model_config, prompt, image_path, **kwargs)
-            elif model_config.provider == ModelProvider.GROQ:
-                return self._call_groq(model_config, prompt, image_path, **kwargs)
-            elif model_config.provider == ModelProvider.TOGETHER_AI:
-                return self._call_together(model_config, prompt, image_path, **kwargs)
-            elif model_config.provider == ModelProvider.DEEPSEEK:
-                return self._call_deepseek_api(model_config, prompt, image_path, **kwargs)
-            else:
-                return ModelResponse(
-                    success=False,
-                    response="",
-                    provider=model_config.provider,
-                    model_name=model_config.model_name,
-                    processing_time=time.time() - start_time,
-                    error=f"Provider {model_config.provider.value} not implemented"
-                )
-                
-        except Exception as e:
-            return ModelResponse(
-                success=False,
-                response="",
-                provider=model_config.provider,
-                model_name=model_config.model_name,
-                processing_time=time.time() - start_time,
-                error=str(e)
+
+    def _collect_metrics(self) -> List[Tuple[str, str, str, List[Tuple[Dict[str, str], float]]]]:
+        """Cache, circuit breaker and scheduler gauges for /metrics"""
+        cache = self.response_cache.stats()
+        families = [
+            ("fertivision_response_cache_lookups_total", "Response cache lookups by result", "counter", [
+                ({'result': 'memory_hit'}, cache['memory_hits']),
+                ({'result': 'disk_hit'}, cache['disk_hits']),
+                ({'result': 'miss'}, cache['misses'])
+            ]),
+            ("fertivision_response_cache_disk_bytes", "Size of the persistent response cache", "gauge", [
+                ({}, cache['disk_bytes'])
+            ])
+        ]
+
+        health = self.circuit_breakers.snapshot().values()
+        families.append(("fertivision_endpoint_health_score", "Endpoint health (0 = circuit open, 1 = healthy)", "gauge", [
+            ({'provider': h['provider'], 'endpoint': h['api_url'], 'state': h['state']}, h['health_score'])
+            for h in health
+        ]))
+
+        schedulers = self.schedulers.metrics().values()
+        families.append(("fertivision_endpoint_queue_depth", "Requests waiting for an endpoint slot", "gauge", [
+            ({'endpoint': m['endpoint']}, m['queue_depth']) for m in schedulers
+        ]))
+        families.append(("fertivision_endpoint_in_flight", "Requests running against an endpoint", "gauge", [
+            ({'endpoint': m['endpoint']}, m['in_flight']) for m in schedulers
+        ]))
+        families.append(("fertivision_endpoint_queue_wait_seconds_avg", "Average wait for an endpoint slot", "gauge", [
+            ({'endpoint': m['endpoint']}, m['avg_wait']) for m in schedulers
+        ]))
+        families.append(("fertivision_endpoint_rejected_total", "Requests rejected by a full queue", "counter", [
+            ({'endpoint': m['endpoint']}, m['rejected']) for m in schedulers
+        ]))
+        return families
+
+    def get_metrics_summary(self) -> Dict[str, Any]:
+        """JSON metrics: per-model telemetry plus cache, endpoint health and queues"""
+        summary = self.telemetry.summary()
+        summary['response_cache'] = self.response_cache.stats()
+        summary['endpoints'] = self.get_provider_health()
+        summary['queues'] = self.get_scheduler_metrics()
+        return summary
+
+    def render_metrics(self) -> str:
+        """Prometheus text for /metrics"""
+        return self.telemetry.render_prometheus()
+
+    def _candidate_models(self, config: AnalysisConfig) -> List[ModelConfig]:
+        """Primary model followed by the enabled fallbacks"""
+        candidates = [config.primary_model]
+        if config.use_fallback:
+            candidates += [model for model in config.fallback_models if model.enabled]
+        return candidates
+
+    async def _cache_keys(self,
+                          config: AnalysisConfig,
+                          prompt: str,
+                          image: Optional[ImagePayload]) -> Dict[Tuple[str, str], str]:
+        """Response cache key for every model in the chain"""
+        image_hash = None
+        if image is not None:
+            loop = asyncio.get_running_loop()
+            image_hash = await loop.run_in_executor(None, lambda: image.sha256)
+
+        return {
+            (model.provider.value, model.model_name): ResponseCache.make_key(
+                image_hash, prompt, model.provider.value, model.model_name, model.temperature
             )
-    
-    def _call_ollama(self, 
-                    model_config: ModelConfig,
-                    prompt: str,
-                    image_path: Optional[str] = None,
-                    **kwargs) -> ModelResponse:
-        """Call Ollama local API"""
-        start_time = time.time()
-        
-        payload = {
-            "model": model_config.model_name,
-            "prompt": prompt,
-            "stream": False,
-            "options": {
-                "temperature": model_config.temperature
-            }
+            for model in self._candidate_models(config)
         }
-        
-        # Add image if provided
-        if image_path:
-            try:
-                with open(image_path, "rb") as f:
-                    image_data = base64.b64encode(f.read()).decode('utf-8')
-                payload["images"] = [image_data]
-            except Exception as e:
-                return ModelResponse(
-                    success=False,
-                    response="",
-                    provider=model_config.provider,
-                    model_name=model_config.model_name,
-                    processing_time=time.time() - start_time,
-                    error=f"Failed to encode image: {e}"
-                )
-        
-        try:
-            response = self.session.post(
-                model_config.api_url,
-                json=payload,
-                timeout=model_config.timeout
-            )
-            
-            processing_time = time.time() - start_time
-            
-            if response.status_code == 200:
-                result = response.json()
-                return ModelResponse(
-                    success=True,
-                    response=result.get("response", ""),
-                    provider=model_config.provider,
-                    model_name=model_config.model_name,
-                    processing_time=processing_time,
-                    cost=0.0  # Local models are free
-                )
-            else:
-                return ModelResponse(
-                    success=False,
-                    response="",
-                    provider=model_config.provider,
-                    model_name=model_config.model_name,
-                    processing_time=processing_time,
-                    error=f"HTTP {response.status_code}: {response.text}"
-                )
-                
-        except requests.exceptions.Timeout:
-            return ModelResponse(
-                success=False,
-                response="",
-                provider=model_config.provider,
-                model_name=model_config.model_name,
-                processing_time=time.time() - start_time,
-                error="Request timeout"
-            )
-        except Exception as e:
-            return ModelResponse(
-                success=False,
-                response="",
-                provider=model_config.provider,
-                model_name=model_config.model_name,
-                processing_time=time.time() - start_time,
-                error=str(e)
-            )
-    
-    def _call_openai(self, 
-                    model_config: ModelConfig,
-                    prompt: str,
-                    image_path: Optional[str] = None,
-                    **kwargs) -> ModelResponse:
-        """Call OpenAI API"""
+
+    def _cache_lookup(self, cache_keys: Dict[Tuple[str, str], str]) -> Optional[ModelResponse]:
+        """Return the cached answer of the first model in the chain that has one"""
         start_time = time.time()
-        
-        if not model_config.api_key:
-            return ModelResponse(
-                success=False,
-                response="",
-                provider=model_config.provider,
-                model_name=model_config.model_name,
-                processing_time=time.time() - start_time,
-                error="OpenAI API key not provided"
-            )
-        
-        headers = {
-            "Authorization": f"Bearer {model_config.api_key}",
-            "Content-Type": "application/json"
-        }
-        
-        # Prepare messages
-        messages = []
-        
-        if image_path and "vision" in model_config.model_name:
-            # Vision model
-            try:
-                with open(image_path, "rb") as f:
-                    image_data = base64.b64encode(f.read()).decode('utf-8')
-                
-                messages.append({
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": prompt},
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/jpeg;base64,{image_data}"
-                            }
-                        }
-                    ]
-                })
-            except Exception as e:
-                return ModelResponse(
-                    success=False,
-                    response="",
-                    provider=model_config.provider,
-                    model_name=model_config.model_name,
-                    processing_time=time.time() - start_time,
-                    error=f"Failed to encode image: {e}"
-                )
-        else:
-            # Text-only model
-            messages.append({
-                "role": "user",
-                "content": prompt
-            })
-        
-        payload = {
-            "model": model_config.model_name,
-            "messages": messages,
-            "temperature": model_config.temperature
-        }
-        
-        if model_config.max_tokens:
-            payload["max_tokens"] = model_config.max_tokens
-        
-        try:
-            response = self.session.post(
-                model_config.api_url,
-                headers=headers,
-                json=payload,
-                timeout=model_config.timeout
-            )
-            
-            processing_time = time.time() - start_time
-            
-            if response.status_code == 200:
-                result = response.json()
-                content = result["choices"][0]["message"]["content"]
-                
-                # Calculate cost
-                usage = result.get("usage", {})
-                total_tokens = usage.get("total_tokens", 0)
-                cost = (total_tokens / 1000) * model_config.cost_per_1k_tokens
-                
-                return ModelResponse(
-                    success=True,
-                    response=content,
-                    provider=model_config.provider,
-                    model_name=model_config.model_name,
-                    processing_time=processing_time,
-                    token_count=total_tokens,
-                    cost=cost
-                )
-            else:
-                error_data = response.json() if response.headers.get('content-type') == 'application/json' else response.text
-                return ModelResponse(
-                    success=False,
-                    response="",
-                    provider=model_config.provider,
-                    model_name=model_config.model_name,
-                    processing_time=processing_time,
-                    error=f"HTTP {response.status_code}: {error_data}"
-                )
-                
-        except Exception as e:
+        for (provider, model_name), key in cache_keys.items():
+            entry = self.response_cache.get(key)
+            if entry is None:
+                continue
+            print(f"⚡ Response cache hit: {provider} - {model_name}")
             return ModelResponse(
-                success=False,
-                response="",
-                provider=model_config.provider,
-                model_name=model_config.model_name,
+                success=True,
+                response=entry['response'],
+                provider=ModelProvider(provider),
+                model_name=model_name,
                 processing_time=time.time() - start_time,
-                error=str(e)
+                token_count=entry.get('token_count'),
+                quality_score=entry.get('quality_score'),
+                cached=True
             )
+        return None
+
+    def _cache_store(self,
+                     cache_keys: Dict[Tuple[str, str], str],
+                     response: ModelResponse,
+                     config: AnalysisConfig):
+        """Cache successful responses that passed the quality check"""
+        if not response.success or response.cached:
+            return
+        if config.quality_threshold > 0 and (response.quality_score or 0.0) < config.quality_threshold:
+            return
+        key = cache_keys.get((response.provider.value, response.model_name))
+        if key is None:
+            return
+        self.response_cache.put(key, {
+            'response': response.response,
+            'token_count': response.token_count,
+            'cost': response.cost,
+            'quality_score': response.quality_score
+        })
 
-    def _call_anthropic(self,
-                       model_config: ModelConfig,
-                       prompt: str,
-                       image_path: Optional[str] = None,
-                       **kwargs) -> ModelResponse:
-        """Call Anthropic Claude API"""
-        start_time = time.time()
+    async def _analyze_hedged(self,
+                              config: AnalysisConfig,
+                              analysis_type: AnalysisType,
+                              prompt: str,
+                              image: Optional[ImagePayload] = None,
+                              **kwargs) -> ModelResponse:
+        """
+        Race the fallback chain: when the running call is slower than its latency
+        percentile, start the next model in parallel and keep the first response
+        that passes the quality check. Losing calls are cancelled.
+        """
+        candidates = self._candidate_models(config)
 
-        if not model_config.api_key:
-            return ModelResponse(
-                success=False,
-                response="",
-                provider=model_config.provider,
-                model_name=model_config.model_name,
-                processing_time=time.time() - start_time,
-                error="Anthropic API key not provided"
-            )
+        attempts: List[Dict[str, Any]] = []
+        pending: Dict[asyncio.Task, Tuple[ModelConfig, float]] = {}
+        best: Optional[ModelResponse] = None
+        last_failure: Optional[ModelResponse] = None
+        next_index = 0
 
-        headers = {
-            "x-api-key": model_config.api_key,
-            "Content-Type": "application/json",
-            "anthropic-version": "2023-06-01"
-        }
+        def launch_next():
+            nonlocal next_index
+            model = candidates[next_index]
+            next_index += 1
+            if next_index > 1:
+                print(f"🏁 Hedging with: {model.provider.value} - {model.model_name}")
+            task = asyncio.ensure_future(self._timed_call(model, prompt, image, attempts, **kwargs))
+            pending[task] = (model, time.time())
 
-        # Note: Claude doesn't support vision yet, so we'll use text-only
-        payload = {
-            "model": model_config.model_name,
-            "max_tokens": model_config.max_tokens or 4000,
-            "temperature": model_config.temperature,
-            "messages": [
-                {
-                    "role": "user",
-                    "content": prompt
-                }
-            ]
-        }
+        launch_next()
 
         try:
-            response = self.session.post(
-                model_config.api_url,
-                headers=headers,
-                json=payload,
-                timeout=model_config.timeout
-            )
+            while pending:
+                can_hedge = next_index < len(candidates)
+                timeout = None
+                if can_hedge:
+                    newest_model, newest_start = max(pending.values(), key=lambda item: item[1])
+                    timeout = max(0.0, self.get_hedge_delay(newest_model, config) - (time.time() - newest_start))
+
+                done, _ = await asyncio.wait(pending.keys(), timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+                if not done:
+                    # Running calls are slower than expected - hedge with the next model
+                    launch_next()
+                    continue
 
-            processing_time = time.time() - start_time
+                for task in done:
+                    pending.pop(task)
+                    response = task.result()
+
+                    if not response.success:
+                        last_failure = response
+                        continue
+
+                    response.quality_score = self._assess_response_quality(response.response, analysis_type)
+                    if config.quality_threshold <= 0 or response.quality_score >= config.quality_threshold:
+                        response.attempts = attempts
+                        return response
+
+                    print(f"⚠️ Response quality below threshold: {response.quality_score:.2f} < {config.quality_threshold}")
+                    if best is None or response.quality_score > best.quality_score:
+                        best = response
+
+                # A failed or low-quality answer should not wait for the hedge delay
+                if not pending and next_index < len(candidates):
+                    launch_next()
+        finally:
+            for task, (model, started) in pending.items():
+                task.cancel()
+                attempts.append(self._attempt_record(model, time.time() - started, cancelled=True))
+            if pending:
+                await asyncio.gather(*pending.keys(), return_exceptions=True)
+
+        response = best or last_failure
+        response.attempts = attempts
+        return response
 
-            if response.status_code == 200:
-                result = response.json()
-                content = result["content"][0]["text"]
-
-                # Calculate cost
-                usage = result.get("usage", {})
-                total_tokens = usage.get("input_tokens", 0) + usage.get("output_tokens", 0)
-                cost = (total_tokens / 1000) * model_config.cost_per_1k_tokens
-
-                return ModelResponse(
-                    success=True,
-                    response=content,
-                    provider=model_config.provider,
-                    model_name=model_config.model_name,
-                    processing_time=processing_time,
-                    token_count=total_tokens,
-                    cost=cost
-                )
-            else:
-                return ModelResponse(
-                    success=False,
-                    response="",
-                    provider=model_config.provider,
-                    model_name=model_config.model_name,
-                    processing_time=processing_time,
-                    error=f"HTTP {response.status_code}: {response.text}"
+    async def _timed_call(self,
+                          model_config: ModelConfig,
+                          prompt: str,
+                          image: Optional[ImagePayload],
+                          attempts: List[Dict[str, Any]],
+                          **kwargs) -> ModelResponse:
+        """Call a model and record the attempt's latency and cost"""
+        # Disabled models answer without touching the endpoint or its breaker
+        admission = self.circuit_breakers.admit(model_config) if model_config.enabled else nullcontext(True)
+        with admission as allowed:
+            if not allowed:
+                # Known-bad endpoint - go straight to the next model in the chain
+                response = self._error_response(
+                    model_config, 0.0,
+                    f"Circuit open for {model_config.provider.value} at {model_config.api_url}"
                 )
+                attempts.append(self._attempt_record(model_config, 0.0, response=response))
+                return response
 
-        except Exception as e:
-            return ModelResponse(
-                success=False,
-                response="",
-                provider=model_config.provider,
-                model_name=model_config.model_name,
-                processing_time=time.time() - start_time,
-                error=str(e)
-            )
+            response = await self._call_model_async(model_config, prompt, image, **kwargs)
+        attempts.append(self._attempt_record(model_config, response.processing_time, response=response))
+        if response.success:
+            self._record_latency(model_config, response.processing_time)
+        return response
 
-    def _call_google(self,
-                    model_config: ModelConfig,
-                    prompt: str,
-                    image_path: Optional[str] = None,
-                    **kwargs) -> ModelResponse:
-        """Call Google Gemini API"""
-        start_time = time.time()
+    def _attempt_record(self,
+                        model_config: ModelConfig,
+                        latency: float,
+                        response: Optional[ModelResponse] = None,
+                        cancelled: bool = False) -> Dict[str, Any]:
+        return {
+            'provider': model_config.provider.value,
+            'model_name': model_config.model_name,
+            'latency': latency,
+            'cost': response.cost if response else 0.0,
+            'token_count': response.token_count if response else None,
+            'success': bool(response and response.success),
+            'cancelled': cancelled,
+            'error': response.error if response else None
+        }
 
-        if not model_config.api_key:
-            return ModelResponse(
-                success=False,
-                response="",
-                provider=model_config.provider,
-                model_name=model_config.model_name,
-                processing_time=time.time() - start_time,
-                error="Google API key not provided"
-            )
+    def _latency_key(self, model_config: ModelConfig) -> Tuple[str, str, str]:
+        return (model_config.provider.value, model_config.model_name, model_config.api_url)
+
+    def _record_latency(self, model_config: ModelConfig, latency: float):
+        key = self._latency_key(model_config)
+        history = self._latency_history.get(key)
+        if history is None:
+            history = self._latency_history.setdefault(key, deque(maxlen=LATENCY_HISTORY_SIZE))
+        history.append(latency)
+
+    def get_hedge_delay(self, model_config: ModelConfig, config: AnalysisConfig) -> float:
+        """Seconds to wait on a model before hedging, from its latency percentile"""
+        history = self._latency_history.get(self._latency_key(model_config))
+        if not history or len(history) < MIN_LATENCY_SAMPLES:
+            return config.hedge_delay
+        samples = sorted(history)
+        rank = min(len(samples) - 1, max(0, int(round(config.hedge_percentile / 100.0 * len(samples))) - 1))
+        return samples[rank]
+
+    # ------------------------------------------------------------------
+    # Streaming
+    # ------------------------------------------------------------------
+
+    def stream_with_model(self,
+                          analysis_type: AnalysisType,
+                          prompt: str,
+                          image_path: Optional[str] = None,
+                          image: Optional[ImagePayload] = None,
+                          **kwargs) -> Iterator[StreamChunk]:
+        """
+        Stream an analysis as it is generated
 
-        # Prepare content
-        contents = [{"parts": [{"text": prompt}]}]
+        Blocking iterator over stream_with_model_async. Closing the iterator
+        early cancels the model call.
+        """
+        if self.engine.in_engine_thread():
+            raise RuntimeError("Blocking call from the provider engine loop; use stream_with_model_async instead")
+
+        chunks: "queue.Queue" = queue.Queue()
+        finished = object()
 
-        # Add image if provided and model supports vision
-        if image_path and "vision" in model_config.model_name:
+        async def pump():
             try:
-                with open(image_path, "rb") as f:
-                    image_data = base64.b64encode(f.read()).decode('utf-8')
-
-                contents[0]["parts"].append({
-                    "inline_data": {
-                        "mime_type": "image/jpeg",
-                        "data": image_data
-                    }
-                })
+                async for chunk in self.stream_with_model_async(analysis_type, prompt, image_path, image=image, **kwargs):
+                    chunks.put(chunk)
             except Exception as e:
-                return ModelResponse(
-                    success=False,
-                    response="",
-                    provider=model_config.provider,
-                    model_name=model_config.model_name,
-                    processing_time=time.time() - start_time,
-                    error=f"Failed to encode image: {e}"
-                )
-
-        payload = {
-            "contents": contents,
-            "generationConfig": {
-                "temperature": model_config.temperature,
-                "maxOutputTokens": model_config.max_tokens or 2048
-            }
-        }
-
-        url = f"{model_config.api_url}?key={model_config.api_key}"
+                chunks.put(e)
+            finally:
+                chunks.put(finished)
 
+        future = asyncio.run_coroutine_threadsafe(pump(), self.engine.loop)
         try:
-            response = self.session.post(
-                url,
-                json=payload,
-                timeout=model_config.timeout
-            )
-
-            processing_time = time.time() - start_time
-
-            if response.status_code == 200:
-                result = response.json()
-
-                if "candidates" in result and result["candidates"]:
-                    content = result["candidates"][0]["content"]["parts"][0]["text"]
-
-                    # Estimate tokens (Google doesn't provide usage in response)
-                    estimated_tokens = len(content.split()) * 1.3  # Rough estimate
-                    cost = (estimated_tokens / 1000) * model_config.cost_per_1k_tokens
-
-                    return ModelResponse(
-                        success=True,
-                        response=content,
-                        provider=model_config.provider,
-                        model_name=model_config.model_name,
-                        processing_time=processing_time,
-                        token_count=int(estimated_tokens),
-                        cost=cost
-                    )
-                else:
-                    return ModelResponse(
-                        success=False,
-                        response="",
-                        provider=model_config.provider,
-                        model_name=model_config.model_name,
-                        processing_time=processing_time,
-                        error="No candidates in response"
-                    )
-            else:
-                return ModelResponse(
-                    success=False,
-                    response="",
-                    provider=model_config.provider,
-                    model_name=model_config.model_name,
-                    processing_time=processing_time,
-                    error=f"HTTP {response.status_code}: {response.text}"
-                )
+            while True:
+                item = chunks.get()
+                if item is finished:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            future.cancel()
+
+    async def stream_with_model_async(self,
+                                      analysis_type: AnalysisType,
+                                      prompt: str,
+                                      image_path: Optional[str] = None,
+                                      image: Optional[ImagePayload] = None,
+                                      stop_when: Optional[Callable[[str], bool]] = None,
+                                      use_cache: bool = True,
+                                      **kwargs) -> AsyncIterator[StreamChunk]:
+        """
+        Stream an analysis chunk by chunk, with fallback until the first token
 
-        except Exception as e:
-            return ModelResponse(
+        stop_when is called with the text generated so far; once it returns True
+        the connection is closed so the model stops generating. The last chunk
+        has done=True and carries the complete ModelResponse.
+        """
+        config = model_manager.get_config(analysis_type)
+        if not config:
+            yield StreamChunk("", done=True, response=ModelResponse(
                 success=False,
                 response="",
-                provider=model_config.provider,
-                model_name=model_config.model_name,
-                processing_time=time.time() - start_time,
-                error=str(e)
-            )
-
-    def _assess_response_quality(self, response: str, analysis_type: AnalysisType) -> float:
-        """Assess the quality of a model response"""
-        if not response or len(response.strip()) < 10:
-            return 0.0
+                provider=ModelProvider.LOCAL_API,
+                model_name="unknown",
+                processing_time=0.0,
+                error=f"No configuration found for {analysis_type.value}"
+            ))
+            return
 
-        quality_score = 0.5  # Base score
+        if image is None and image_path:
+            try:
+                loop = asyncio.get_running_loop()
+                image = await loop.run_in_executor(None, ImagePayload.from_file, image_path)
+            except OSError as e:
+                yield StreamChunk("", done=True, response=self._error_response(
+                    config.primary_model, 0.0, f"Failed to read image: {e}"
+                ))
+                return
+
+        cache_keys: Dict[Tuple[str, str], str] = {}
+        if self.response_cache.enabled:
+            cache_keys = await self._cache_keys(config, prompt, image)
+            if use_cache:
+                cached = self._cache_lookup(cache_keys)
+                if cached:
+                    self._record_telemetry(analysis_type, cached)
+                    yield StreamChunk(cached.response, done=True, response=cached)
+                    return
+
+        attempts: List[Dict[str, Any]] = []
+        response: Optional[ModelResponse] = None
+
+        for model_config in self._candidate_models(config):
+            if not model_config.enabled:
+                continue
+            streamed_text = False
+            with self.circuit_breakers.admit(model_config) as allowed:
+                if not allowed:
+                    response = self._error_response(
+                        model_config, 0.0,
+                        f"Circuit open for {model_config.provider.value} at {model_config.api_url}"
+                    )
+                    attempts.append(self._attempt_record(model_config, 0.0, response=response))
+                    continue
 
-        # Check for medical keywords based on analysis type
-        medical_keywords = {
-            AnalysisType.FOLLICLE_ANALYSIS: ["follicle", "afc", "ovarian", "antral", "dominant"],
-            AnalysisType.SPERM_ANALYSIS: ["sperm", "motility", "morphology", "concentration", "who"],
-            AnalysisType.EMBRYO_ANALYSIS: ["embryo", "blastocyst", "gardner", "icm", "trophectoderm"],
-            AnalysisType.OOCYTE_ANALYSIS: ["oocyte", "metaphase", "polar body", "zona pellucida"],
-            AnalysisType.HYSTEROSCOPY_ANALYSIS: ["endometrial", "uterine", "cavity", "hysteroscopy"]
-        }
+                async for chunk in self._stream_model_async(model_config, prompt, image, stop_when, kwargs.get('priority', 0)):
+                    if not chunk.done:
+                        streamed_text = True
+                        yield chunk
+                        continue
+                    response = chunk.response
 
-        keywords = medical_keywords.get(analysis_type, [])
-        response_lower = response.lower()
+            attempts.append(self._attempt_record(model_config, response.processing_time, response=response))
+            if response.success:
+                self._record_latency(model_config, response.processing_time)
+            if response.success or streamed_text:
+                break
+            print(f"⚠️ Streaming from {model_config.provider.value} failed, trying next model...")
 
-        # Award points for relevant keywords
-        keyword_score = sum(0.1 for keyword in keywords if keyword in response_lower)
-        quality_score += min(keyword_score, 0.3)  # Max 0.3 from keywords
+        if response is None:
+            response = self._error_response(config.primary_model, 0.0, "No enabled models")
 
-        # Check for numerical values (important for medical analysis)
-        import re
-        numbers = re.findall(r'\d+\.?\d*', response)
-        if numbers:
-            quality_score += 0.1
-
-        # Check for structured format
-        if any(marker in response for marker in ["1.", "2.", "•", "-", ":"]):
-            quality_score += 0.1
-
-        return min(quality_score, 1.0)
+        if response.success and config.quality_threshold > 0:
+            response.quality_score = self._assess_response_quality(response.response, analysis_type)
+
+        response.attempts = attempts
+        if not response.stopped_early and not response.error:
+            self._cache_store(cache_keys, response, config)
+        self._record_telemetry(analysis_type, response)
+        yield StreamChunk("", done=True, response=response)
+
+    def _stream_adapter(self, model_config: ModelConfig) -> Optional[ProviderAdapter]:
+        """Adapter of the model's provider if it can stream"""
+        adapter = get_adapter(model_config.provider)
+        if adapter is None or adapter.stream_format is None:
+            return None
+        return adapter
+
+    async def _stream_model_async(self,
+                                  model_config: ModelConfig,
+                                  prompt: str,
+                                  image: Optional[ImagePayload],
+                                  stop_when: Optional[Callable[[str], bool]],
+                                  priority: int = 0) -> AsyncIterator[StreamChunk]:
+        """Stream one model; providers without streaming support answer in a single chunk"""
+        adapter = self._stream_adapter(model_config)
+        if adapter is None or not AIOHTTP_AVAILABLE:
+            response = await self._call_model_async(model_config, prompt, image, priority=priority)
+            if response.success:
+                yield StreamChunk(response.response)
+            yield StreamChunk("", done=True, response=response)
+            return
+
+        scheduler = self._scheduler_for(model_config)
+        try:
+            if scheduler is not None:
+                await scheduler.acquire_async(priority)
+        except SchedulerError as e:
+            yield StreamChunk("", done=True, response=self._error_response(model_config, 0.0, str(e)))
+            return
 
-    def _call_openrouter(self,
-                        model_config: ModelConfig,
-                        prompt: str,
-                        image_path: Optional[str] = None,
-                        **kwargs) -> ModelResponse:
-        """Call OpenRouter API (OpenAI-compatible)"""
+        try:
+            async for chunk in self._stream_model_http(model_config, prompt, image, stop_when, adapter):
+                yield chunk
+        finally:
+            if scheduler is not None:
+                scheduler.release()
+
+    async def _stream_model_http(self,
+                                 model_config: ModelConfig,
+                                 prompt: str,
+                                 image: Optional[ImagePayload],
+                                 stop_when: Optional[Callable[[str], bool]],
+                                 adapter: ProviderAdapter) -> AsyncIterator[StreamChunk]:
+        loop = asyncio.get_running_loop()
         start_time = time.time()
+        wire_format = adapter.stream_format
+        try:
+            request = await loop.run_in_executor(None, self._build_request, adapter, model_config, prompt, image)
+        except ValueError as e:
+            yield StreamChunk("", done=True, response=self._error_response(model_config, time.time() - start_time, str(e)))
+            return
 
-        if not model_config.api_key:
-            return ModelResponse(
-                success=False,
-                response="",
-                provider=model_config.provider,
-                model_name=model_config.model_name,
-                processing_time=time.time() - start_time,
-                error="OpenRouter API key not provided"
-            )
-
-        headers = {
-            "Authorization": f"Bearer {model_config.api_key}",
-            "Content-Type": "application/json",
-            "HTTP-Referer": "https://fertivision.ai",
-            "X-Title": "FertiVision powered by AI"
-        }
+        adapter.prepare_stream(request.payload)
 
-        # Prepare messages (OpenAI-compatible format)
-        messages = []
+        parts: List[str] = []
+        token_count: Optional[int] = None
+        stopped_early = False
+        error: Optional[str] = None
 
-        if image_path and "vision" in model_config.model_name:
+        try:
+            session = await self.engine.get_session(request.url, self._pool_size(model_config))
+            async with session.post(
+                request.url,
+                headers=request.headers,
+                json=request.payload,
+                timeout=aiohttp.ClientTimeout(total=model_config.timeout)
+            ) as http_response:
+                if http_response.status != 200:
+                    text = await http_response.text()
+                    yield StreamChunk("", done=True, response=self._endpoint_error(
+                        model_config, time.time() - start_time,
+                        f"HTTP {http_response.status}: {text}",
+                        endpoint_down=self._is_endpoint_failure(http_response.status)
+                    ))
+                    return
+
+                async for raw_line in http_response.content:
+                    text, finished, tokens = self._parse_stream_line(wire_format, raw_line)
+                    if tokens is not None:
+                        token_count = tokens
+                    if text:
+                        parts.append(text)
+                        yield StreamChunk(text)
+                        if stop_when is not None and stop_when("".join(parts)):
+                            stopped_early = True
+                            # Dropping the connection makes the server stop generating
+                            http_response.close()
+                            break
+                    if finished:
+                        break
+
+        except asyncio.TimeoutError:
+            error = "Request timeout"
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            error = str(e)
+
+        processing_time = time.time() - start_time
+        if error:
+            # A stream cut off midway is a failed call, even if some text already went out
+            response = self._endpoint_error(model_config, processing_time, error)
+            if parts:
+                response.partial_response = "".join(parts)
+            yield StreamChunk("", done=True, response=response)
+            return
+
+        self._record_endpoint_success(model_config, processing_time)
+        cost = (token_count / 1000) * model_config.cost_per_1k_tokens if token_count else 0.0
+        yield StreamChunk("", done=True, response=ModelResponse(
+            success=True,
+            response="".join(parts),
+            provider=model_config.provider,
+            model_name=model_config.model_name,
+            processing_time=processing_time,
+            token_count=token_count,
+            cost=cost,
+            stopped_early=stopped_early
+        ))
+
+    @staticmethod
+    def _parse_stream_line(wire_format: str, raw_line: bytes) -> Tuple[str, bool, Optional[int]]:
+        """Decode one NDJSON (Ollama) or SSE (OpenAI-compatible) line into (text, finished, token_count)"""
+        line = raw_line.decode('utf-8', errors='ignore').strip()
+        if not line:
+            return "", False, None
+
+        if wire_format == "ndjson":
             try:
-                with open(image_path, "rb") as f:
-                    image_data = base64.b64encode(f.read()).decode('utf-8')
-
-                messages.append({
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": prompt},
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/jpeg;base64,{image_data}"
-                            }
-                        }
-                    ]
-                })
-            except Exception as e:
-                return ModelResponse(
-                    success=False,
-                    response="",
-                    provider=model_config.provider,
-                    model_name=model_config.model_name,
-                    processing_time=time.time() - start_time,
-                    error=f"Failed to encode image: {e}"
-                )
-        else:
-            messages.append({
-                "role": "user",
-                "content": prompt
-            })
-
-        payload = {
-            "model": model_config.model_name,
-            "messages": messages,
-            "temperature": model_config.temperature
-        }
+                event = json.loads(line)
+            except json.JSONDecodeError:
+                return "", False, None
+            tokens = None
+            if event.get("done"):
+                tokens = event.get("prompt_eval_count", 0) + event.get("eval_count", 0)
+            return event.get("response", ""), bool(event.get("done")), tokens
+
+        if not line.startswith("data:"):
+            return "", False, None
+        data = line[5:].strip()
+        if data == "[DONE]":
+            return "", True, None
+        try:
+            event = json.loads(data)
+        except json.JSONDecodeError:
+            return "", False, None
+        tokens = (event.get("usage") or {}).get("total_tokens")
+        choices = event.get("choices") or []
+        text = ""
+        if choices:
+            text = (choices[0].get("delta") or {}).get("content") or ""
+        return text, False, tokens
+
+    def _call_model(self,
+                   model_config: ModelConfig,
+                   prompt: str,
+                   image_path: Optional[str] = None,
+                   image: Optional[ImagePayload] = None,
+                   **kwargs) -> ModelResponse:
+        """Call a specific model"""
 
-        if model_config.max_tokens:
-            payload["max_tokens"] = model_config.max_tokens
+        if not model_config.enabled:
+            return self._disabled_response(model_config)
 
+        start_time = time.time()
+        scheduler = self._scheduler_for(model_config)
         try:
-            response = self.session.post(
-                model_config.api_url,
-                headers=headers,
-                json=payload,
-                timeout=model_config.timeout
-            )
+            if scheduler is not None:
+                scheduler.acquire(kwargs.pop('priority', 0))
+        except SchedulerError as e:
+            return self._error_response(model_config, time.time() - start_time, str(e))
 
-            processing_time = time.time() - start_time
+        try:
+            if image is None and image_path:
+                image = ImagePayload.from_file(image_path)
 
-            if response.status_code == 200:
-                result = response.json()
-                content = result["choices"][0]["message"]["content"]
-
-                # Calculate cost
-                usage = result.get("usage", {})
-                total_tokens = usage.get("total_tokens", 0)
-                cost = (total_tokens / 1000) * model_config.cost_per_1k_tokens
-
-                return ModelResponse(
-                    success=True,
-                    response=content,
-                    provider=model_config.provider,
-                    model_name=model_config.model_name,
-                    processing_time=processing_time,
-                    token_count=total_tokens,
-                    cost=cost
-                )
-            else:
-                return ModelResponse(
-                    success=False,
-                    response="",
-                    provider=model_config.provider,
-                    model_name=model_config.model_name,
-                    processing_time=processing_time,
-                    error=f"HTTP {response.status_code}: {response.text}"
-                )
+            adapter = get_adapter(model_config.provider)
+            if adapter is None:
+                return self._not_implemented_response(model_config, time.time() - start_time)
+            return self._execute(model_config, adapter, prompt, image)
 
         except Exception as e:
-            return ModelResponse(
-                success=False,
-                response="",
-                provider=model_config.provider,
-                model_name=model_config.model_name,
-                processing_time=time.time() - start_time,
-                error=str(e)
-            )
-
-    def _call_groq(self,
-                  model_config: ModelConfig,
-                  prompt: str,
-                  image_path: Optional[str] = None,
-                  **kwargs) -> ModelResponse:
-        """Call Groq API (OpenAI-compatible, ultra-fast)"""
-        start_time = time.time()
+            return self._error_response(model_config, time.time() - start_time, str(e))
+        finally:
+            if scheduler is not None:
+                scheduler.release()
+
+    async def _call_model_async(self,
+                                model_config: ModelConfig,
+                                prompt: str,
+                                image: Optional[ImagePayload] = None,
+                                **kwargs) -> ModelResponse:
+        """Call a specific model on the event loop"""
 
-        if not model_config.api_key:
-            return ModelResponse(
-                success=False,
-                response="",
-                provider=model_config.provider,
-                model_name=model_config.model_name,
-                processing_time=time.time() - start_time,
-                error="Groq API key not provided"
-            )
+        if not model_config.enabled:
+            return self._disabled_response(model_config)
 
-        headers = {
-            "Authorization": f"Bearer {model_config.api_key}",
-            "Content-Type": "application/json"
-        }
+        start_time = time.time()
+        scheduler = self._scheduler_for(model_config)
+        try:
+            if scheduler is not None:
+                await scheduler.acquire_async(kwargs.pop('priority', 0))
+        except SchedulerError as e:
+            return self._error_response(model_config, time.time() - start_time, str(e))
 
-        # Prepare messages
-        messages = []
+        try:
+            adapter = get_adapter(model_config.provider)
+            if adapter is None:
+                return self._not_implemented_response(model_config, time.time() - start_time)
+            return await self._execute_async(model_config, adapter, prompt, image)
 
-        if image_path and "llava" in model_config.model_name:
-            try:
-                with open(image_path, "rb") as f:
-                    image_data = base64.b64encode(f.read()).decode('utf-8')
-
-                messages.append({
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": prompt},
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/jpeg;base64,{image_data}"
-                            }
-                        }
-                    ]
-                })
-            except Exception as e:
-                return ModelResponse(
-                    success=False,
-                    response="",
-                    provider=model_config.provider,
-                    model_name=model_config.model_name,
-                    processing_time=time.time() - start_time,
-                    error=f"Failed to encode image: {e}"
-                )
-        else:
-            messages.append({
-                "role": "user",
-                "content": prompt
-            })
-
-        payload = {
-            "model": model_config.model_name,
-            "messages": messages,
-            "temperature": model_config.temperature
-        }
+        except Exception as e:
+            return self._error_response(model_config, time.time() - start_time, str(e))
+        finally:
+            if scheduler is not None:
+                scheduler.release()
+
+    def _in_flight_limit(self, model_config: ModelConfig) -> int:
+        """Configured concurrency for the endpoint, 0 = unbounded; local Ollama is bounded by default"""
+        limit = model_config.max_in_flight
+        if not limit and model_config.provider == ModelProvider.OLLAMA_LOCAL:
+            limit = DEFAULT_OLLAMA_IN_FLIGHT
+        return max(limit or 0, 0)
+
+    def _pool_size(self, model_config: ModelConfig) -> int:
+        """Connections to keep open to the endpoint's host"""
+        return self._in_flight_limit(model_config) or DEFAULT_HOST_POOL_SIZE
+
+    def _scheduler_for(self, model_config: ModelConfig) -> Optional[EndpointScheduler]:
+        """Admission control for the model's endpoint"""
+        limit = self._in_flight_limit(model_config)
+        if not limit:
+            return None
+        return self.schedulers.get(
+            model_config.api_url, limit,
+            max_queue=model_config.max_queue,
+            queue_timeout=model_config.queue_timeout,
+            model=f"{model_config.provider.value}:{model_config.model_name}"
+        )
+
+    def get_scheduler_metrics(self) -> Dict[str, Dict[str, Any]]:
+        """Queue depth, in-flight count and wait times per endpoint"""
+        return self.schedulers.metrics()
+
+    # ------------------------------------------------------------------
+    # Transport
+    # ------------------------------------------------------------------
+
+    def _build_request(self,
+                       adapter: ProviderAdapter,
+                       model_config: ModelConfig,
+                       prompt: str,
+                       image: Optional[ImagePayload]) -> ProviderRequest:
+        """Fit the image to the provider's profile, then build the request"""
+        if image is not None:
+            image = image.transcode(self._image_profile(model_config))
+        return adapter.build_request(model_config, prompt, image)
+
+    def _image_profile(self, model_config: ModelConfig) -> ImageProfile:
+        max_edge = model_config.image_max_edge
+        if max_edge == 0:
+            max_edge = PROVIDER_IMAGE_MAX_EDGE.get(model_config.provider, 0)
+        return ImageProfile(
+            max_edge=max(max_edge, 0),
+            format=model_config.image_format,
+            quality=model_config.image_quality
+        )
+
+    def _execute(self,
+                 model_config: ModelConfig,
+                 adapter: ProviderAdapter,
+                 prompt: str,
+                 image: Optional[ImagePayload] = None) -> ModelResponse:
+        """Build, send and parse a provider request with the host's blocking session"""
+        start_time = time.time()
 
-        if model_config.max_tokens:
-            payload["max_tokens"] = model_config.max_tokens
+        try:
+            request = self._build_request(adapter, model_config, prompt, image)
+        except ValueError as e:
+            return self._error_response(model_config, time.time() - start_time, str(e))
 
         try:
-            response = self.session.post(
-                model_config.api_url,
-                headers=headers,
-                json=payload,
+            session = self.host_sessions.get(request.url, self._pool_size(model_config))
+            response = session.post(
+                request.url,
+                headers=request.headers,
+                json=request.payload,
                 timeout=model_config.timeout
             )
 
             processing_time = time.time() - start_time
 
             if response.status_code == 200:
-                result = response.json()
-                content = result["choices"][0]["message"]["content"]
-
-                # Groq often provides usage info
-                usage = result.get("usage", {})
-                total_tokens = usage.get("total_tokens", 0)
-                cost = (total_tokens / 1000) * model_config.cost_per_1k_tokens  # Often free
-
-                return ModelResponse(
-                    success=True,
-                    response=content,
-                    provider=model_config.provider,
-                    model_name=model_config.model_name,
-                    processing_time=processing_time,
-                    token_count=total_tokens,
-                    cost=cost
-                )
+                return self._parse_response(adapter, model_config, response.json(), processing_time)
             else:
-                return ModelResponse(
-                    success=False,
-                    response="",
-                    provider=model_config.provider,
-                    model_name=model_config.model_name,
-                    processing_time=processing_time,
-                    error=f"HTTP {response.status_code}: {response.text}"
+                return self._endpoint_error(
+                    model_config, processing_time,
+                    f"HTTP {response.status_code}: {response.text}",
+                    endpoint_down=self._is_endpoint_failure(response.status_code)
                 )
 
+        except requests.exceptions.Timeout:
+            return self._endpoint_error(model_config, time.time() - start_time, "Request timeout")
         except Exception as e:
-            return ModelResponse(
-                success=False,
-                response="",
-                provider=model_config.provider,
-                model_name=model_config.model_name,
-                processing_time=time.time() - start_time,
-                error=str(e)
+            return self._endpoint_error(model_config, time.time() - start_time, str(e))
+
+    async def _execute_async(self,
+                             model_config: ModelConfig,
+                             adapter: ProviderAdapter,
+                             prompt: str,
+                             image: Optional[ImagePayload] = None) -> ModelResponse:
+        """Build, send and parse a provider request on the event loop"""
+        loop = asyncio.get_running_loop()
+
+        if not AIOHTTP_AVAILABLE:
+            # Keep the loop free by running the blocking transport in a worker thread
+            return await loop.run_in_executor(
+                None, self._execute, model_config, adapter, prompt, image
             )
 
-    def _call_together(self,
-                      model_config: ModelConfig,
-                      prompt: str,
-                      image_path: Optional[str] = None,
-                      **kwargs) -> ModelResponse:
-        """Call Together AI API"""
         start_time = time.time()
 
-        if not model_config.api_key:
-            return ModelResponse(
-                success=False,
-                response="",
-                provider=model_config.provider,
-                model_name=model_config.model_name,
-                processing_time=time.time() - start_time,
-                error="Together AI API key not provided"
-            )
-
-        headers = {
-            "Authorization": f"Bearer {model_config.api_key}",
-            "Content-Type": "application/json"
-        }
+        try:
+            # Image reading and base64 encoding is CPU/disk bound - keep it off the loop
+            request = await loop.run_in_executor(None, self._build_request, adapter, model_config, prompt, image)
+        except ValueError as e:
+            return self._error_response(model_config, time.time() - start_time, str(e))
 
-        # Together AI uses OpenAI-compatible format
-        messages = [{"role": "user", "content": prompt}]
+        try:
+            session = await self.engine.get_session(request.url, self._pool_size(model_config))
+            async with session.post(
+                request.url,
+                headers=request.headers,
+                json=request.payload,
+                timeout=aiohttp.ClientTimeout(total=model_config.timeout)
+            ) as response:
+                if response.status == 200:
+                    result = await response.json(content_type=None)
+                    processing_time = time.time() - start_time
+                    return self._parse_response(adapter, model_config, result, processing_time)
+                else:
+                    text = await response.text()
+                    return self._endpoint_error(
+                        model_config, time.time() - start_time,
+                        f"HTTP {response.status}: {text}",
+                        endpoint_down=self._is_endpoint_failure(response.status)
+                    )
 
-        payload = {
-            "model": model_config.model_name,
-            "messages": messages,
-            "temperature": model_config.temperature
-        }
+        except asyncio.TimeoutError:
+            return self._endpoint_error(model_config, time.time() - start_time, "Request timeout")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            return self._endpoint_error(model_config, time.time() - start_time, str(e))
 
-        if model_config.max_tokens:
-            payload["max_tokens"] = model_config.max_tokens
+    def _parse_response(self,
+                        adapter: ProviderAdapter,
+                        model_config: ModelConfig,
+                        result: Dict,
+                        processing_time: float) -> ModelResponse:
+        """
+        Turn a provider's JSON answer into a ModelResponse with cost
 
+        The endpoint is only credited with a success once the content has been
+        extracted; answers the adapter cannot extract content from are
+        recorded as endpoint failures and returned as error responses.
+        """
         try:
-            response = self.session.post(
-                model_config.api_url,
-                headers=headers,
-                json=payload,
-                timeout=model_config.timeout
-            )
+            parsed = adapter.parse_response(result)
+        except ProviderResponseError as e:
+            return self._endpoint_error(model_config, processing_time, str(e))
+
+        self._record_endpoint_success(model_config, processing_time)
+
+        return ModelResponse(
+            success=True,
+            response=parsed.text,
+            provider=model_config.provider,
+            model_name=model_config.model_name,
+            processing_time=processing_time,
+            token_count=parsed.token_count,
+            cost=((parsed.token_count or 0) / 1000) * model_config.cost_per_1k_tokens
+        )
+
+    # ------------------------------------------------------------------
+    # Endpoint health
+    # ------------------------------------------------------------------
+
+    @staticmethod
+    def _is_endpoint_failure(status: int) -> bool:
+        """Server errors and rate limiting count against the endpoint; other 4xx are caller errors"""
+        return status >= 500 or status == 429
+
+    def _record_endpoint_success(self, model_config: ModelConfig, latency: float):
+        slow = latency > model_config.timeout * 0.5
+        self.circuit_breakers.get(model_config).record_success(latency, slow=slow)
+
+    def _endpoint_error(self,
+                        model_config: ModelConfig,
+                        processing_time: float,
+                        error: str,
+                        endpoint_down: bool = True) -> ModelResponse:
+        """Failed transport call - feeds the endpoint's circuit breaker"""
+        breaker = self.circuit_breakers.get(model_config)
+        if endpoint_down:
+            state = breaker.record_failure(processing_time, error)
+            if state == CircuitState.OPEN and not breaker.probing:
+                self._start_probe(model_config)
+        else:
+            breaker.record_success(processing_time)
+        return self._error_response(model_config, processing_time, error)
 
-            processing_time = time.time() - start_time
+    def _start_probe(self, model_config: ModelConfig):
+        """Watch an open endpoint in the background until it answers again"""
+        breaker = self.circuit_breakers.get(model_config)
+        breaker.probing = True
+        try:
+            asyncio.run_coroutine_threadsafe(self._probe_until_recovered(model_config), self.engine.loop)
+        except RuntimeError:
+            breaker.probing = False  # Engine shutting down
 
-            if response.status_code == 200:
-                result = response.json()
-                content = result["choices"][0]["message"]["content"]
-
-                # Calculate cost
-                usage = result.get("usage", {})
-                total_tokens = usage.get("total_tokens", 0)
-                cost = (total_tokens / 1000) * model_config.cost_per_1k_tokens
-
-                return ModelResponse(
-                    success=True,
-                    response=content,
-                    provider=model_config.provider,
-                    model_name=model_config.model_name,
-                    processing_time=processing_time,
-                    token_count=total_tokens,
-                    cost=cost
-                )
-            else:
-                return ModelResponse(
-                    success=False,
-                    response="",
-                    provider=model_config.provider,
-                    model_name=model_config.model_name,
-                    processing_time=processing_time,
-                    error=f"HTTP {response.status_code}: {response.text}"
+    async def _probe_until_recovered(self, model_config: ModelConfig):
+        breaker = self.circuit_breakers.get(model_config)
+        url = probe_url(model_config)
+        try:
+            while breaker.state == CircuitState.OPEN:
+                await asyncio.sleep(self.probe_interval)
+                if breaker.state != CircuitState.OPEN:
+                    break
+                if await self._probe(url):
+                    print(f"🩺 Endpoint reachable again: {url}")
+                    breaker.mark_recovered()
+        finally:
+            breaker.probing = False
+
+    async def _probe(self, url: str) -> bool:
+        """Any non-5xx answer means the endpoint is back"""
+        try:
+            if not AIOHTTP_AVAILABLE:
+                loop = asyncio.get_running_loop()
+                session = self.host_sessions.get(url)
+                response = await loop.run_in_executor(
+                    None, lambda: session.get(url, timeout=PROBE_TIMEOUT)
                 )
+                return response.status_code < 500
+
+            session = await self.engine.get_session(url)
+            async with session.get(url, timeout=aiohttp.ClientTimeout(total=PROBE_TIMEOUT)) as response:
+                return response.status < 500
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            return False
+
+    def get_provider_health(self) -> Dict[str, Dict[str, Any]]:
+        """Circuit state and health score of every endpoint used so far"""
+        return self.circuit_breakers.snapshot()
+
+    def _error_response(self, model_config: ModelConfig, processing_time: float, error: str) -> ModelResponse:
+        """Failed response for a model"""
+        return ModelResponse(
+            success=False,
+            response="",
+            provider=model_config.provider,
+            model_name=model_config.model_name,
+            processing_time=processing_time,
+            error=error
+        )
+
+    def _disabled_response(self, model_config: ModelConfig) -> ModelResponse:
+        return self._error_response(model_config, 0.0, "Model is disabled")
+
+    def _not_implemented_response(self, model_config: ModelConfig, processing_time: float) -> ModelResponse:
+        return self._error_response(
+            model_config, processing_time,
+            f"Provider {model_config.provider.value} not implemented"
+        )
 
-        except Exception as e:
-            return ModelResponse(
-                success=False,
-                response="",
-                provider=model_config.provider,
-                model_name=model_config.model_name,
-                processing_time=time.time() - start_time,
-                error=str(e)
-            )
-
-    def _call_deepseek_api(self,
-                          model_config: ModelConfig,
-                          prompt: str,
-                          image_path: Optional[str] = None,
-                          **kwargs) -> ModelResponse:
-        """Call DeepSeek API"""
-        start_time = time.time()
+    def _assess_response_quality(self, response: str, analysis_type: AnalysisType) -> float:
+        """Assess the quality of a model response"""
+        if not response or len(response.strip()) < 10:
+            return 0.0
 
-        if not model_config.api_key:
-            return ModelResponse(
-                success=False,
-                response="",
-                provider=model_config.provider,
-                model_name=model_config.model_name,
-                processing_time=time.time() - start_time,
-                error="DeepSeek API key not provided"
-            )
+        quality_score = 0.5  # Base score
 
-        headers = {
-            "Authorization": f"Bearer {model_config.api_key}",
-            "Content-Type": "application/json"
+        # Check for medical keywords based on analysis type
+        medical_keywords = {
+            AnalysisType.FOLLICLE_ANALYSIS: ["follicle", "afc", "ovarian", "antral", "dominant"],
+            AnalysisType.SPERM_ANALYSIS: ["sperm", "motility", "morphology", "concentration", "who"],
+            AnalysisType.EMBRYO_ANALYSIS: ["embryo", "blastocyst", "gardner", "icm", "trophectoderm"],
+            AnalysisType.OOCYTE_ANALYSIS: ["oocyte", "metaphase", "polar body", "zona pellucida"],
+            AnalysisType.HYSTEROSCOPY_ANALYSIS: ["endometrial", "uterine", "cavity", "hysteroscopy"]
         }
 
-        messages = [{"role": "user", "content": prompt}]
+        keywords = medical_keywords.get(analysis_type, [])
+        response_lower = response.lower()
 
-        payload = {
-            "model": model_config.model_name,
-            "messages": messages,
-            "temperature": model_config.temperature
-        }
+        # Award points for relevant keywords
+        keyword_score = sum(0.1 for keyword in keywords if keyword in response_lower)
+        quality_score += min(keyword_score, 0.3)  # Max 0.3 from keywords
 
-        if model_config.max_tokens:
-            payload["max_tokens"] = model_config.max_tokens
+        # Check for numerical values (important for medical analysis)
+        import re
+        numbers = re.findall(r'\d+\.?\d*', response)
+        if numbers:
+            quality_score += 0.1
 
-        try:
-            response = self.session.post(
-                model_config.api_url,
-                headers=headers,
-                json=payload,
-                timeout=model_config.timeout
-            )
+        # Check for structured format
+        if any(marker in response for marker in ["1.", "2.", "•", "-", ":"]):
+            quality_score += 0.1
 
-            processing_time = time.time() - start_time
+        return min(quality_score, 1.0)
 
-            if response.status_code == 200:
-                result = response.json()
-                content = result["choices"][0]["message"]["content"]
-
-                # Calculate cost
-                usage = result.get("usage", {})
-                total_tokens = usage.get("total_tokens", 0)
-                cost = (total_tokens / 1000) * model_config.cost_per_1k_tokens
-
-                return ModelResponse(
-                    success=True,
-                    response=content,
-                    provider=model_config.provider,
-                    model_name=model_config.model_name,
-                    processing_time=processing_time,
-                    token_count=total_tokens,
-                    cost=cost
-                )
-            else:
-                return ModelResponse(
-                    success=False,
-                    response="",
-                    provider=model_config.provider,
-                    model_name=model_config.model_name,
-                    processing_time=processing_time,
-                    error=f"HTTP {response.status_code}: {response.text}"
-                )
+    def close(self):
+        """Release pooled connections and stop contributing to /metrics"""
+        self.telemetry.unregister_collector(self._collect_metrics)
+        self.engine.close()
+        self.host_sessions.close()
+        self.response_cache.close()
 
-        except Exception as e:
-            return ModelResponse(
-                success=False,
-                response="",
-                provider=model_config.provider,
-                model_name=model_config.model_name,
-                processing_time=time.time() - start_time,
-                error=str(e)
-            )
+def fields_captured(*patterns: str) -> Callable[[str], bool]:
+    """stop_when predicate that is true once every regex pattern matches the streamed text"""
+    compiled = [re.compile(pattern, re.IGNORECASE) for pattern in patterns]
+    return lambda text: all(regex.search(text) for regex in compiled)
 
 # Global service manager instance
 service_manager = ModelServiceManager()
+atexit.register(service_manager.close)
@@ -0,0 +1,194 @@
+"""
+FertiVision powered by AI - Preprocessed Image Cache
+
+Content-addressed cache for the enhanced images image_preprocessing sends to
+the vision model. Entries are keyed on the source image's SHA-256, the
+analysis kind and the preprocessing version, so retries, re-analysis with
+another provider and repeated dataset runs skip CLAHE, equalization and the
+bilateral filter entirely.
+
+Two tiers:
+- In-memory LRU bounded in bytes
+- Directory of encoded images bounded in bytes, shared between processes
+  (app.py and api_server.py); least recently used files are evicted
+
+Bump image_preprocessing.PREPROCESS_VERSION whenever an enhancement changes
+so stale variants are never served.
+
+© 2025 FertiVision powered by AI (made by greybrain.ai) - DeepSeek LLM Image Analysis
+"""
+
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional, Any, List, Tuple
+
+from image_payload import ImagePayload
+
+DEFAULT_CACHE_DIR = os.getenv('FERTIVISION_PREPROCESS_CACHE_DIR', "preprocess_cache")
+
+class PreprocessCache:
+    """Two-tier (memory LRU + directory) cache of preprocessed images"""
+
+    def __init__(self,
+                 cache_dir: Optional[str] = DEFAULT_CACHE_DIR,
+                 max_memory_bytes: int = 64 * 1024 * 1024,
+                 max_disk_bytes: int = 512 * 1024 * 1024,
+                 enabled: bool = True):
+        self.cache_dir = cache_dir
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.enabled = enabled
+        self._memory: "OrderedDict[str, ImagePayload]" = OrderedDict()
+        self._memory_bytes = 0
+        self._disk_bytes: Optional[int] = None
+        self._lock = threading.Lock()
+        self._stats = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0}
+
+    @staticmethod
+    def make_key(source_hash: str, kind: str, version: int) -> str:
+        """Content-addressed key of one preprocessed variant"""
+        material = json.dumps([source_hash, kind, version])
+        return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def get(self, key: str) -> Optional[ImagePayload]:
+        """Cached variant, memory tier first"""
+        if not self.enabled:
+            return None
+        with self._lock:
+            payload = self._memory.get(key)
+            if payload is not None:
+                self._memory.move_to_end(key)
+                self._stats['memory_hits'] += 1
+                return payload
+
+        if self.cache_dir:
+            path = self._path(key)
+            try:
+                with open(path, "rb") as f:
+                    data = f.read()
+                # Recently used files survive eviction
+                os.utime(path)
+            except OSError:
+                data = None
+            if data:
+                payload = ImagePayload(data)
+                with self._lock:
+                    self._remember(key, payload)
+                    self._stats['disk_hits'] += 1
+                return payload
+
+        with self._lock:
+            self._stats['misses'] += 1
+        return None
+
+    def put(self, key: str, payload: ImagePayload):
+        """Store a variant in both tiers"""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._remember(key, payload)
+            self._stats['stores'] += 1
+        if not self.cache_dir:
+            return
+
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Readers in other processes never see a partial file
+            temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(temp_path, "wb") as f:
+                f.write(payload.data)
+            os.replace(temp_path, path)
+        except OSError as e:
+            print(f"⚠️ Preprocess cache write failed: {e}")
+            return
+
+        with self._lock:
+            if self._disk_bytes is None:
+                self._disk_bytes = sum(size for _, _, size in self._disk_entries())
+            else:
+                self._disk_bytes += len(payload)
+            if self._disk_bytes > self.max_disk_bytes:
+                self._evict_disk()
+
+    def _remember(self, key: str, payload: ImagePayload):
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            return
+        self._memory[key] = payload
+        self._memory_bytes += len(payload)
+        while self._memory_bytes > self.max_memory_bytes and len(self._memory) > 1:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted)
+
+    def _disk_entries(self) -> List[Tuple[float, str, int]]:
+        """(last use, path, size) of every file in the disk tier"""
+        entries = []
+        if not self.cache_dir or not os.path.isdir(self.cache_dir):
+            return entries
+        for shard in os.scandir(self.cache_dir):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if entry.name.endswith(".tmp"):
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, entry.path, stat.st_size))
+        return entries
+
+    def _evict_disk(self):
+        """Remove least recently used files until under 90% of the size budget"""
+        # Rescan: other processes share the directory
+        entries = sorted(self._disk_entries())
+        total = sum(size for _, _, size in entries)
+        target = int(self.max_disk_bytes * 0.9)
+        for _, path, size in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            self._stats['evictions'] += 1
+        self._disk_bytes = total
+
+    def clear(self):
+        """Remove all cached variants"""
+        with self._lock:
+            self._memory.clear()
+            self._memory_bytes = 0
+            for _, path, _ in self._disk_entries():
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            self._disk_bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        """Hit/miss counters and tier sizes"""
+        with self._lock:
+            hits = self._stats['memory_hits'] + self._stats['disk_hits']
+            lookups = hits + self._stats['misses']
+            return {
+                **self._stats,
+                'hits': hits,
+                'hit_rate': hits / lookups if lookups else 0.0,
+                'memory_entries': len(self._memory),
+                'memory_bytes': self._memory_bytes,
+                'disk_bytes': self._disk_bytes,
+                'enabled': self.enabled
+            }
+
+# Shared by image_analysis and ultrasound_analysis through image_preprocessing
+preprocess_cache = PreprocessCache()
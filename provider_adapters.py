@@ -0,0 +1,303 @@
+"""
+FertiVision powered by AI - Provider Adapters
+
+Table of model providers. Each adapter knows how to build a provider's HTTP
+request, parse its answer and whether it can stream; the model service looks
+the adapter up by ModelProvider instead of branching on it. Most hosted
+providers speak the OpenAI chat completions protocol, so a single adapter
+parameterized by label, vision support and extra headers serves all of them.
+
+New OpenAI-compatible providers only need a register_adapter() call.
+
+© 2025 FertiVision powered by AI (made by greybrain.ai) - DeepSeek LLM Image Analysis
+"""
+
+import threading
+from dataclasses import dataclass, field
+from typing import Dict, Optional, List, Any
+
+from model_config import ModelProvider, ModelConfig
+from image_payload import ImagePayload
+
+@dataclass
+class ProviderRequest:
+    """Prepared HTTP request for a provider call"""
+    url: str
+    payload: Dict[str, Any]
+    headers: Dict[str, str] = field(default_factory=dict)
+
+@dataclass
+class ParsedResponse:
+    """Text and token usage extracted from a provider answer"""
+    text: str
+    token_count: Optional[int] = None
+
+class ProviderResponseError(Exception):
+    """Provider answered 200 but without usable content"""
+
+class ProviderAdapter:
+    """Request building and response parsing for one provider protocol"""
+
+    stream_format: Optional[str] = None  # "ndjson", "sse" or None when the provider cannot stream
+
+    def __init__(self, label: str, requires_key: bool = True):
+        self.label = label
+        self.requires_key = requires_key
+        self._headers: Dict[Optional[str], Dict[str, str]] = {}
+        self._lock = threading.Lock()
+
+    def check_key(self, model_config: ModelConfig):
+        if self.requires_key and not model_config.api_key:
+            raise ValueError(f"{self.label} API key not provided")
+
+    def headers(self, model_config: ModelConfig) -> Dict[str, str]:
+        """Request headers, built once per API key"""
+        key = model_config.api_key
+        headers = self._headers.get(key)
+        if headers is None:
+            with self._lock:
+                headers = self._headers.setdefault(key, self._build_headers(key))
+        return headers
+
+    def _build_headers(self, api_key: Optional[str]) -> Dict[str, str]:
+        return {"Content-Type": "application/json"}
+
+    def build_request(self, model_config: ModelConfig, prompt: str, image: Optional[ImagePayload] = None) -> ProviderRequest:
+        raise NotImplementedError
+
+    def parse_response(self, result: Dict) -> ParsedResponse:
+        raise NotImplementedError
+
+    def prepare_stream(self, payload: Dict[str, Any]):
+        """Switch a built payload to streaming mode"""
+        payload["stream"] = True
+
+class OllamaAdapter(ProviderAdapter):
+    """Local Ollama /api/generate"""
+
+    stream_format = "ndjson"
+
+    def __init__(self):
+        super().__init__("Ollama", requires_key=False)
+
+    def build_request(self, model_config: ModelConfig, prompt: str, image: Optional[ImagePayload] = None) -> ProviderRequest:
+        payload = {
+            "model": model_config.model_name,
+            "prompt": prompt,
+            "stream": False,
+            "options": {
+                "temperature": model_config.temperature
+            }
+        }
+
+        # Add image if provided
+        if image is not None:
+            payload["images"] = [image.base64]
+
+        return ProviderRequest(url=model_config.api_url, payload=payload, headers=self.headers(model_config))
+
+    def parse_response(self, result: Dict) -> ParsedResponse:
+        if not isinstance(result, dict):
+            raise ProviderResponseError(f"Unexpected Ollama response: {type(result).__name__} instead of an object")
+        return ParsedResponse(result.get("response", ""))
+
+class OpenAICompatibleAdapter(ProviderAdapter):
+    """
+    Chat completions protocol shared by OpenAI, OpenRouter, Groq, Together AI,
+    DeepSeek and most self-hosted servers
+
+    vision_marker: substring of the model name that marks a vision model;
+    None sends text only, "" sends the image to every model.
+    """
+
+    stream_format = "sse"
+
+    def __init__(self,
+                 label: str,
+                 vision_marker: Optional[str] = None,
+                 extra_headers: Optional[Dict[str, str]] = None,
+                 requires_key: bool = True,
+                 stream_usage: bool = False):
+        super().__init__(label, requires_key=requires_key)
+        self.vision_marker = vision_marker
+        self.extra_headers = extra_headers or {}
+        self.stream_usage = stream_usage
+
+    def _build_headers(self, api_key: Optional[str]) -> Dict[str, str]:
+        headers = {"Content-Type": "application/json", **self.extra_headers}
+        if api_key:
+            headers["Authorization"] = f"Bearer {api_key}"
+        return headers
+
+    def supports_vision(self, model_config: ModelConfig) -> bool:
+        return self.vision_marker is not None and self.vision_marker in model_config.model_name
+
+    def build_request(self, model_config: ModelConfig, prompt: str, image: Optional[ImagePayload] = None) -> ProviderRequest:
+        self.check_key(model_config)
+
+        # Vision model gets the image, text-only model gets the prompt
+        messages = openai_style_messages(prompt, image, self.supports_vision(model_config))
+        payload = {
+            "model": model_config.model_name,
+            "messages": messages,
+            "temperature": model_config.temperature
+        }
+        if model_config.max_tokens:
+            payload["max_tokens"] = model_config.max_tokens
+
+        return ProviderRequest(url=model_config.api_url, payload=payload, headers=self.headers(model_config))
+
+    def parse_response(self, result: Dict) -> ParsedResponse:
+        try:
+            content = result["choices"][0]["message"]["content"]
+            usage = result.get("usage") or {}
+            return ParsedResponse(content, usage.get("total_tokens", 0))
+        except (KeyError, IndexError, TypeError, AttributeError) as e:
+            raise ProviderResponseError(f"No message content in {self.label} response (missing {e})")
+
+    def prepare_stream(self, payload: Dict[str, Any]):
+        payload["stream"] = True
+        if self.stream_usage:
+            payload["stream_options"] = {"include_usage": True}
+
+class AnthropicAdapter(ProviderAdapter):
+    """Anthropic Messages API"""
+
+    def __init__(self):
+        super().__init__("Anthropic")
+
+    def _build_headers(self, api_key: Optional[str]) -> Dict[str, str]:
+        return {
+            "x-api-key": api_key or "",
+            "Content-Type": "application/json",
+            "anthropic-version": "2023-06-01"
+        }
+
+    def build_request(self, model_config: ModelConfig, prompt: str, image: Optional[ImagePayload] = None) -> ProviderRequest:
+        self.check_key(model_config)
+
+        # Note: Claude doesn't support vision yet, so we'll use text-only
+        payload = {
+            "model": model_config.model_name,
+            "max_tokens": model_config.max_tokens or 4000,
+            "temperature": model_config.temperature,
+            "messages": [
+                {
+                    "role": "user",
+                    "content": prompt
+                }
+            ]
+        }
+
+        return ProviderRequest(url=model_config.api_url, payload=payload, headers=self.headers(model_config))
+
+    def parse_response(self, result: Dict) -> ParsedResponse:
+        try:
+            usage = result.get("usage") or {}
+            return ParsedResponse(
+                result["content"][0]["text"],
+                usage.get("input_tokens", 0) + usage.get("output_tokens", 0)
+            )
+        except (KeyError, IndexError, TypeError, AttributeError) as e:
+            raise ProviderResponseError(f"No text content in Anthropic response (missing {e})")
+
+class GeminiAdapter(ProviderAdapter):
+    """Google Gemini generateContent"""
+
+    def __init__(self):
+        super().__init__("Google")
+
+    def build_request(self, model_config: ModelConfig, prompt: str, image: Optional[ImagePayload] = None) -> ProviderRequest:
+        self.check_key(model_config)
+
+        # Prepare content
+        contents = [{"parts": [{"text": prompt}]}]
+
+        # Add image if provided and model supports vision
+        if image is not None and "vision" in model_config.model_name:
+            contents[0]["parts"].append({
+                "inline_data": {
+                    "mime_type": image.mime_type,
+                    "data": image.base64
+                }
+            })
+
+        payload = {
+            "contents": contents,
+            "generationConfig": {
+                "temperature": model_config.temperature,
+                "maxOutputTokens": model_config.max_tokens or 2048
+            }
+        }
+
+        return ProviderRequest(
+            url=f"{model_config.api_url}?key={model_config.api_key}",
+            payload=payload,
+            headers=self.headers(model_config)
+        )
+
+    def parse_response(self, result: Dict) -> ParsedResponse:
+        if not isinstance(result, dict) or not result.get("candidates"):
+            raise ProviderResponseError("No candidates in response")
+        candidate = result["candidates"][0]
+        try:
+            content = candidate["content"]["parts"][0]["text"]
+        except (KeyError, IndexError, TypeError) as e:
+            # Candidates blocked by a safety filter come back without parts
+            reason = candidate.get("finishReason") if isinstance(candidate, dict) else None
+            raise ProviderResponseError(f"No text in Gemini candidate (missing {e}, finish reason {reason})")
+
+        # Estimate tokens (Google doesn't provide usage in response)
+        return ParsedResponse(content, int(len(content.split()) * 1.3))
+
+def openai_style_messages(prompt: str, image: Optional[ImagePayload], with_image: bool) -> List[Dict]:
+    """Build OpenAI-compatible chat messages, optionally with an inline image"""
+    if image is not None and with_image:
+        return [{
+            "role": "user",
+            "content": [
+                {"type": "text", "text": prompt},
+                {
+                    "type": "image_url",
+                    "image_url": {
+                        "url": image.data_url()
+                    }
+                }
+            ]
+        }]
+    return [{"role": "user", "content": prompt}]
+
+_adapters: Dict[ModelProvider, ProviderAdapter] = {}
+
+def register_adapter(provider: ModelProvider, adapter: ProviderAdapter):
+    """Route calls for a provider through an adapter (replaces any existing one)"""
+    _adapters[provider] = adapter
+
+def get_adapter(provider: ModelProvider) -> Optional[ProviderAdapter]:
+    return _adapters.get(provider)
+
+def registered_providers() -> List[ModelProvider]:
+    return list(_adapters)
+
+register_adapter(ModelProvider.OLLAMA_LOCAL, OllamaAdapter())
+register_adapter(ModelProvider.OPENAI, OpenAICompatibleAdapter("OpenAI", vision_marker="vision", stream_usage=True))
+register_adapter(ModelProvider.ANTHROPIC, AnthropicAdapter())
+register_adapter(ModelProvider.GOOGLE, GeminiAdapter())
+register_adapter(ModelProvider.OPENROUTER, OpenAICompatibleAdapter(
+    "OpenRouter",
+    vision_marker="vision",
+    extra_headers={
+        "HTTP-Referer": "https://fertivision.ai",
+        "X-Title": "FertiVision powered by AI"
+    }
+))
+# Groq vision models are LLaVA based
+register_adapter(ModelProvider.GROQ, OpenAICompatibleAdapter("Groq", vision_marker="llava"))
+register_adapter(ModelProvider.TOGETHER_AI, OpenAICompatibleAdapter("Together AI"))
+register_adapter(ModelProvider.DEEPSEEK, OpenAICompatibleAdapter("DeepSeek"))
+register_adapter(ModelProvider.PERPLEXITY, OpenAICompatibleAdapter("Perplexity"))
+# Cohere through its OpenAI compatibility endpoint (/compatibility/v1/chat/completions)
+register_adapter(ModelProvider.COHERE, OpenAICompatibleAdapter("Cohere", vision_marker="vision"))
+# Self-hosted OpenAI-compatible servers (vLLM, LM Studio, llama.cpp); the key is optional
+register_adapter(ModelProvider.LOCAL_API, OpenAICompatibleAdapter("Local API", vision_marker="", requires_key=False))
+register_adapter(ModelProvider.CUSTOM_API, OpenAICompatibleAdapter("Custom API", vision_marker="", requires_key=False))
@@ -1,15 +1,21 @@
 import json
+import uuid
 import datetime
-from typing import Dict, List, Optional, Tuple
+from typing import Dict, List, Optional, Tuple, Any, Callable, Iterable, Iterator, Union
 from dataclasses import dataclass, asdict
 from enum import Enum
-import sqlite3
 import logging
+from analysis_schema import typed_values, AnalysisRef, ID_COLUMNS
+from analysis_history import HistoryFilters
+from storage import get_repository, AnalysisRepository, StoredAnalysis
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Rows written per transaction by the classify_*_batch methods
+DEFAULT_BATCH_CHUNK = 1000
+
 class SpermMotility(Enum):
     PROGRESSIVE = "progressive"
     NON_PROGRESSIVE = "non_progressive"
@@ -84,46 +90,72 @@ class EmbryoAnalysis:
     notes: str
     timestamp: str
 
+@dataclass
+class BatchResult:
+    """Outcome of one input row of a classify_*_batch call"""
+    index: int
+    success: bool
+    analysis: Optional[Any] = None
+    error: Optional[str] = None
+
+def _json_default(obj):
+    """Serialize Enums and numpy scalars in analysis records"""
+    if isinstance(obj, Enum):
+        return obj.value
+    if hasattr(obj, 'item'):
+        return obj.item()
+    return str(obj)
+
+def _iter_records(records: Union[Iterable[Dict[str, Any]], Dict[str, Iterable[Any]]]) -> Iterator[Dict[str, Any]]:
+    """Rows from a list of dicts, a dict of columns or a DataFrame"""
+    if hasattr(records, 'to_dict') and hasattr(records, 'columns'):
+        records = records.to_dict('records')
+    if isinstance(records, dict):
+        names = list(records)
+        for values in zip(*(records[name] for name in names)):
+            yield dict(zip(names, values))
+        return
+    for row in records:
+        yield dict(row)
+
 class ReproductiveClassificationSystem:
-    def __init__(self, db_path: str = "reproductive_analysis.db"):
+    def __init__(self, db_path: str = "reproductive_analysis.db", write_behind: bool = False,
+                 archive_dir: Optional[str] = None, storage: Optional[AnalysisRepository] = None):
+        """
+        db_path is a SQLite file or a postgresql:// URL (see storage.py);
+        storage passes a ready repository instead
+        """
         self.db_path = db_path
+        self.storage = storage or get_repository(db_path, archive_dir=archive_dir)
         self.init_database()
+        if write_behind:
+            self.enable_write_behind()
+    
+    # Connection pool, write-behind queue and archive of SQLite storage
+    
+    @property
+    def db(self):
+        return self.storage.db
+    
+    @property
+    def writes(self):
+        return getattr(self.storage, 'writes', None)
+    
+    @property
+    def archive(self):
+        return getattr(self.storage, 'archive', None)
+    
+    def enable_write_behind(self):
+        """Queue analysis writes for a background group-committing writer instead of writing inline"""
+        self.storage.enable_write_behind()
+    
+    def flush_writes(self):
+        """Wait until queued writes are committed (no-op without write-behind)"""
+        self.storage.flush()
     
     def init_database(self):
-        """Initialize SQLite database for storing analyses"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        # Create tables for each analysis type
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS sperm_analyses (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                sample_id TEXT UNIQUE,
-                data TEXT,
-                timestamp TEXT
-            )
-        ''')
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS oocyte_analyses (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                oocyte_id TEXT UNIQUE,
-                data TEXT,
-                timestamp TEXT
-            )
-        ''')
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS embryo_analyses (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                embryo_id TEXT UNIQUE,
-                data TEXT,
-                timestamp TEXT
-            )
-        ''')
-        
-        conn.commit()
-        conn.close()
+        """Create the analysis tables"""
+        self.storage.create_schema()
     
     def classify_sperm(self, 
                       concentration: float,
@@ -133,6 +165,21 @@ class ReproductiveClassificationSystem:
         """
         Classify sperm sample according to WHO 2021 criteria
         """
+        analysis = self._build_sperm_analysis(concentration, progressive_motility, normal_morphology, **kwargs)
+        
+        # Store in database
+        self._store_analysis('sperm_analyses', analysis.sample_id, analysis,
+                             patient_id=kwargs.get('patient_id'), case_id=kwargs.get('case_id'))
+        
+        logger.info(f"Sperm analysis completed: {analysis.classification}")
+        return analysis
+    
+    def _build_sperm_analysis(self,
+                              concentration: float,
+                              progressive_motility: float,
+                              normal_morphology: float,
+                              **kwargs) -> SpermAnalysis:
+        """WHO 2021 classification without storing"""
         # WHO 2021 reference values for normozoospermia
         classification_criteria = {
             'concentration': 15,      # million/ml
@@ -179,11 +226,6 @@ class ReproductiveClassificationSystem:
             notes=kwargs.get('notes', ''),
             timestamp=datetime.datetime.now().isoformat()
         )
-        
-        # Store in database
-        self._store_analysis('sperm_analyses', analysis.sample_id, analysis)
-        
-        logger.info(f"Sperm analysis completed: {classification}")
         return analysis
     
     def classify_oocyte(self,
@@ -193,6 +235,19 @@ class ReproductiveClassificationSystem:
         """
         Classify oocyte according to ESHRE guidelines
         """
+        analysis = self._build_oocyte_analysis(maturity, morphology_score, **kwargs)
+        
+        self._store_analysis('oocyte_analyses', analysis.oocyte_id, analysis,
+                             patient_id=kwargs.get('patient_id'), case_id=kwargs.get('case_id'))
+        
+        logger.info(f"Oocyte analysis completed: {analysis.classification}")
+        return analysis
+    
+    def _build_oocyte_analysis(self,
+                               maturity: OocyteMaturity,
+                               morphology_score: int,
+                               **kwargs) -> OocyteAnalysis:
+        """ESHRE oocyte classification without storing"""
         # Determine classification based on maturity and morphology
         if maturity == OocyteMaturity.MII and morphology_score >= 3:
             classification = "Excellent quality - suitable for ICSI"
@@ -223,10 +278,6 @@ class ReproductiveClassificationSystem:
             notes=kwargs.get('notes', ''),
             timestamp=datetime.datetime.now().isoformat()
         )
-        
-        self._store_analysis('oocyte_analyses', analysis.oocyte_id, analysis)
-        
-        logger.info(f"Oocyte analysis completed: {classification}")
         return analysis
     
     def classify_embryo(self,
@@ -237,6 +288,20 @@ class ReproductiveClassificationSystem:
         """
         Classify embryo according to ASRM/ESHRE guidelines
         """
+        analysis = self._build_embryo_analysis(day, cell_count, fragmentation, **kwargs)
+        
+        self._store_analysis('embryo_analyses', analysis.embryo_id, analysis,
+                             patient_id=kwargs.get('patient_id'), case_id=kwargs.get('case_id'))
+        
+        logger.info(f"Embryo analysis completed: {analysis.classification}")
+        return analysis
+    
+    def _build_embryo_analysis(self,
+                               day: int,
+                               cell_count: int,
+                               fragmentation: float,
+                               **kwargs) -> EmbryoAnalysis:
+        """ASRM/ESHRE embryo classification without storing"""
         # Day-specific classification
         if day <= 3:
             # Cleavage stage embryo classification
@@ -269,10 +334,6 @@ class ReproductiveClassificationSystem:
             notes=kwargs.get('notes', ''),
             timestamp=datetime.datetime.now().isoformat()
         )
-        
-        self._store_analysis('embryo_analyses', analysis.embryo_id, analysis)
-        
-        logger.info(f"Embryo analysis completed: {classification}")
         return analysis
     
     def _classify_cleavage_embryo(self, day: int, cell_count: int, fragmentation: float, kwargs: dict) -> Tuple[EmbryoGrade, str]:
@@ -311,42 +372,125 @@ class ReproductiveClassificationSystem:
         else:
             return EmbryoGrade.POOR, f"Grade {expansion}{icm}{te} - Poor blastocyst"
     
-    def _store_analysis(self, table: str, id_value: str, analysis):
+    # Bulk classification
+    
+    def classify_sperm_batch(self, records, chunk_size: int = DEFAULT_BATCH_CHUNK) -> List[BatchResult]:
+        """
+        Classify and store many sperm samples
+        
+        records is an iterable of dicts with classify_sperm's arguments, or a
+        dict of equal-length columns (or a DataFrame). Rows are written with
+        executemany, chunk_size rows per transaction. A row that fails is
+        reported in its BatchResult and does not abort the batch.
+        """
+        return self._classify_batch('sperm_analyses', self._build_sperm_analysis, records, chunk_size, 'SPERM')
+    
+    def classify_oocyte_batch(self, records, chunk_size: int = DEFAULT_BATCH_CHUNK) -> List[BatchResult]:
+        """Classify and store many oocytes; maturity may be an OocyteMaturity, its value or its name"""
+        return self._classify_batch('oocyte_analyses', self._build_oocyte_row, records, chunk_size, 'OOC')
+    
+    def classify_embryo_batch(self, records, chunk_size: int = DEFAULT_BATCH_CHUNK) -> List[BatchResult]:
+        """Classify and store many embryos"""
+        return self._classify_batch('embryo_analyses', self._build_embryo_analysis, records, chunk_size, 'EMB')
+    
+    def _build_oocyte_row(self, **kwargs) -> OocyteAnalysis:
+        maturity = kwargs.pop('maturity', None)
+        if isinstance(maturity, str):
+            maturity = OocyteMaturity[maturity] if maturity in OocyteMaturity.__members__ else OocyteMaturity(maturity)
+        if not isinstance(maturity, OocyteMaturity):
+            raise ValueError(f"Invalid oocyte maturity: {maturity!r}")
+        return self._build_oocyte_analysis(maturity, **kwargs)
+    
+    def _classify_batch(self,
+                        table: str,
+                        build: Callable[..., Any],
+                        records,
+                        chunk_size: int,
+                        id_prefix: str) -> List[BatchResult]:
+        id_field = ID_COLUMNS[table]
+        stamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
+        # Batches started in the same second must not overwrite each other's rows
+        token = uuid.uuid4().hex[:8]
+        results: List[BatchResult] = []
+        pending: List[Tuple[BatchResult, StoredAnalysis]] = []
+        
+        for index, row in enumerate(_iter_records(records)):
+            try:
+                row.setdefault(id_field, f"{id_prefix}_{stamp}_{token}_{index:06d}")
+                analysis = build(**row)
+                stored = self._stored_analysis(table, analysis, row.get('patient_id'), row.get('case_id'))
+            except Exception as e:
+                results.append(BatchResult(index, False, error=str(e)))
+                continue
+            
+            result = BatchResult(index, True, analysis=analysis)
+            results.append(result)
+            pending.append((result, stored))
+            if len(pending) >= chunk_size:
+                self._write_batch_chunk(table, pending)
+                pending = []
+        
+        if pending:
+            self._write_batch_chunk(table, pending)
+        
+        stored = sum(1 for result in results if result.success)
+        logger.info(f"Batch classification into {table}: {stored} stored, {len(results) - stored} failed")
+        return results
+    
+    def _write_batch_chunk(self, table: str, pending: List[Tuple[BatchResult, StoredAnalysis]]):
+        """One transaction per chunk; rows the storage rejects are marked failed"""
+        errors = self.storage.store_batch(table, [stored for _, stored in pending])
+        for (result, _), error in zip(pending, errors):
+            if error is not None:
+                result.success = False
+                result.analysis = None
+                result.error = error
+    
+    def _store_analysis(self, table: str, id_value: str, analysis,
+                        patient_id: Optional[str] = None, case_id: Optional[str] = None):
         """Store analysis in database"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        # Determine the correct id field name for the table
-        if table == 'sperm_analyses':
-            id_field = 'sample_id'
-        elif table == 'oocyte_analyses':
-            id_field = 'oocyte_id'
-        elif table == 'embryo_analyses':
-            id_field = 'embryo_id'
-        else:
+        if table not in ('sperm_analyses', 'oocyte_analyses', 'embryo_analyses'):
             raise ValueError('Unknown table for storing analysis')
+        self.storage.store(self._stored_analysis(table, analysis, patient_id, case_id))
 
-        # Use a custom encoder to handle Enum serialization
-        def default_encoder(obj):
-            if isinstance(obj, Enum):
-                return obj.value
-            return str(obj)
+    def _stored_analysis(self, table: str, analysis,
+                         patient_id: Optional[str] = None, case_id: Optional[str] = None) -> StoredAnalysis:
+        """Row (natural key, JSON document, timestamp, typed columns) for an analysis"""
+        record = asdict(analysis)
+        if patient_id:
+            record['patient_id'] = patient_id
+        if case_id:
+            record['case_id'] = case_id
+        return StoredAnalysis(table, record[ID_COLUMNS[table]], json.dumps(record, default=_json_default),
+                              analysis.timestamp, typed_values(table, record))
 
-        cursor.execute(f'''
-            INSERT OR REPLACE INTO {table} (
-                {id_field}, data, timestamp
-            ) VALUES (?, ?, ?)
-        ''', (getattr(analysis, id_field), 
-              json.dumps(asdict(analysis), default=default_encoder), 
-              analysis.timestamp))
-        
-        conn.commit()
-        conn.close()
+    def _insert_analysis(self, table: str, id_value: str, record: dict, data_json: str, timestamp: str):
+        """Write the JSON document, its typed columns and its analysis_index entry"""
+        self.storage.store(StoredAnalysis(table, id_value, data_json, timestamp, typed_values(table, record)))
+    
+    def resolve_analysis(self, analysis_id: str) -> Optional[AnalysisRef]:
+        """Type, table and row of any public analysis ID (sample_id, scan_id, API analysis_id, ...)"""
+        return self.storage.resolve(analysis_id)
+    
+    def fetch_document(self, table: str, id_value: str) -> Optional[Tuple[str, str]]:
+        """(data JSON, timestamp) of an analysis, including queued and archived ones"""
+        return self.storage.fetch(table, id_value)
+    
+    def history(self,
+                filters: Optional[HistoryFilters] = None,
+                cursor: Optional[str] = None,
+                limit: int = 50,
+                fields: Optional[List[str]] = None) -> Dict[str, Any]:
+        """Page of past analyses of every type, newest first, live and archived (see analysis_history)"""
+        return self.storage.history(filters, cursor, limit, fields)
+    
+    def aggregate(self, group_by: str = 'classification',
+                  filters: Optional[HistoryFilters] = None) -> List[Dict[str, Any]]:
+        """Number of analyses per classification, type, patient, case or client"""
+        return self.storage.aggregate(group_by, filters)
     
     def generate_report(self, analysis_type: str, analysis_id: str) -> str:
         """Generate detailed report for analysis"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
         table_map = {
             'sperm': 'sperm_analyses',
             'oocyte': 'oocyte_analyses', 
@@ -366,9 +510,7 @@ class ReproductiveClassificationSystem:
         id_field = id_field_map.get(analysis_type)
         if not id_field:
             return "Invalid analysis type"
-        cursor.execute(f"SELECT data FROM {table} WHERE {id_field} = ?", (analysis_id,))
-        result = cursor.fetchone()
-        conn.close()
+        result = self.fetch_document(table, analysis_id)
         
         if not result:
             return f"No analysis found for ID: {analysis_id}"
@@ -0,0 +1,268 @@
+"""
+FertiVision powered by AI - Endpoint Request Scheduler
+
+Admission control in front of model endpoints. A CPU-only Ollama instance
+serves one or two generations efficiently; every request beyond that slows
+all of them down until they time out together. Each endpoint gets a bounded
+number of in-flight requests and a priority wait queue with deadlines.
+
+Works for both worker threads (blocking acquire) and the provider engine's
+event loop (async acquire).
+
+© 2025 FertiVision powered by AI (made by greybrain.ai) - DeepSeek LLM Image Analysis
+"""
+
+import time
+import heapq
+import asyncio
+import itertools
+import threading
+from collections import deque
+from contextlib import contextmanager, asynccontextmanager
+from typing import Dict, Optional, Any, Tuple
+from urllib.parse import urlparse
+
+# In-flight limit for local Ollama endpoints without an explicit max_in_flight
+DEFAULT_OLLAMA_IN_FLIGHT = 2
+
+WAIT_HISTORY_SIZE = 500
+
+# Seconds after which a model that stopped calling no longer limits its host
+MODEL_LIMITS_TTL = 600.0
+
+class SchedulerError(Exception):
+    """Request could not be admitted to the endpoint"""
+
+class QueueFullError(SchedulerError):
+    """Wait queue is at capacity - back off and retry or use another model"""
+
+class QueueTimeoutError(SchedulerError):
+    """Request waited longer than its queue deadline"""
+
+class _Waiter:
+    __slots__ = ('priority', 'seq', 'enqueued', 'event', 'loop', 'future', 'granted')
+
+    def __init__(self, priority: int, seq: int, event=None, loop=None, future=None):
+        self.priority = priority
+        self.seq = seq
+        self.enqueued = time.time()
+        self.event = event
+        self.loop = loop
+        self.future = future
+        self.granted = False
+
+    def __lt__(self, other: "_Waiter") -> bool:
+        # Higher priority first, FIFO within a priority
+        return (-self.priority, self.seq) < (-other.priority, other.seq)
+
+def _resolve(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
+
+class EndpointScheduler:
+    """Bounded in-flight slots with a priority wait queue"""
+
+    def __init__(self,
+                 name: str,
+                 max_in_flight: int = 1,
+                 max_queue: int = 16,
+                 queue_timeout: float = 60.0):
+        self.name = name
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._lock = threading.Lock()
+        self._queue: list = []
+        self._in_flight = 0
+        self._seq = itertools.count()
+        self._waits: deque = deque(maxlen=WAIT_HISTORY_SIZE)
+        self._stats = {
+            'admitted': 0,
+            'rejected': 0,
+            'timed_out': 0,
+            'max_queue_depth': 0
+        }
+
+    def configure(self, max_in_flight: int, max_queue: int, queue_timeout: float):
+        """Apply new limits; raising max_in_flight admits waiting requests"""
+        with self._lock:
+            self.max_in_flight = max_in_flight
+            self.max_queue = max_queue
+            self.queue_timeout = queue_timeout
+            self._dispatch()
+
+    def _admit_now(self) -> bool:
+        if self._in_flight < self.max_in_flight and not self._queue:
+            self._in_flight += 1
+            self._record_wait(0.0)
+            return True
+        if len(self._queue) >= self.max_queue:
+            self._stats['rejected'] += 1
+            raise QueueFullError(f"Queue full for {self.name} ({len(self._queue)} waiting)")
+        return False
+
+    def _enqueue(self, waiter: _Waiter):
+        heapq.heappush(self._queue, waiter)
+        self._stats['max_queue_depth'] = max(self._stats['max_queue_depth'], len(self._queue))
+
+    def _abandon(self, waiter: _Waiter):
+        self._queue.remove(waiter)
+        heapq.heapify(self._queue)
+        self._stats['timed_out'] += 1
+
+    def _record_wait(self, wait: float):
+        self._stats['admitted'] += 1
+        self._waits.append(wait)
+
+    def _dispatch(self):
+        """Hand free slots to the best waiters; caller holds the lock"""
+        while self._queue and self._in_flight < self.max_in_flight:
+            waiter = heapq.heappop(self._queue)
+            waiter.granted = True
+            self._in_flight += 1
+            self._record_wait(time.time() - waiter.enqueued)
+            if waiter.event is not None:
+                waiter.event.set()
+            else:
+                waiter.loop.call_soon_threadsafe(_resolve, waiter.future)
+
+    def acquire(self, priority: int = 0, timeout: Optional[float] = None):
+        """Block the calling thread until a slot is free"""
+        timeout = self.queue_timeout if timeout is None else timeout
+        with self._lock:
+            if self._admit_now():
+                return
+            waiter = _Waiter(priority, next(self._seq), event=threading.Event())
+            self._enqueue(waiter)
+
+        waiter.event.wait(timeout)
+        with self._lock:
+            if waiter.granted:
+                return
+            self._abandon(waiter)
+        raise QueueTimeoutError(f"Waited more than {timeout:.0f}s for {self.name}")
+
+    async def acquire_async(self, priority: int = 0, timeout: Optional[float] = None):
+        """Wait on the event loop until a slot is free"""
+        timeout = self.queue_timeout if timeout is None else timeout
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self._admit_now():
+                return
+            waiter = _Waiter(priority, next(self._seq), loop=loop, future=loop.create_future())
+            self._enqueue(waiter)
+
+        try:
+            await asyncio.wait_for(waiter.future, timeout)
+        except asyncio.TimeoutError:
+            with self._lock:
+                if waiter.granted:
+                    return  # Slot arrived as the deadline passed
+                self._abandon(waiter)
+            raise QueueTimeoutError(f"Waited more than {timeout:.0f}s for {self.name}")
+        except asyncio.CancelledError:
+            with self._lock:
+                if waiter.granted:
+                    self._in_flight -= 1
+                    self._dispatch()
+                else:
+                    self._queue.remove(waiter)
+                    heapq.heapify(self._queue)
+            raise
+
+    def release(self):
+        with self._lock:
+            self._in_flight -= 1
+            self._dispatch()
+
+    @contextmanager
+    def slot(self, priority: int = 0, timeout: Optional[float] = None):
+        self.acquire(priority, timeout)
+        try:
+            yield
+        finally:
+            self.release()
+
+    @asynccontextmanager
+    async def slot_async(self, priority: int = 0, timeout: Optional[float] = None):
+        await self.acquire_async(priority, timeout)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            waits = sorted(self._waits)
+            return {
+                **self._stats,
+                'endpoint': self.name,
+                'in_flight': self._in_flight,
+                'max_in_flight': self.max_in_flight,
+                'queue_depth': len(self._queue),
+                'max_queue': self.max_queue,
+                'avg_wait': sum(waits) / len(waits) if waits else 0.0,
+                'p95_wait': waits[min(len(waits) - 1, int(len(waits) * 0.95))] if waits else 0.0
+            }
+
+class SchedulerRegistry:
+    """One scheduler per endpoint host, shared by the model service and legacy callers"""
+
+    def __init__(self, stale_after: float = MODEL_LIMITS_TTL):
+        self.stale_after = stale_after
+        self._schedulers: Dict[str, EndpointScheduler] = {}
+        # host -> model -> ((max_in_flight, max_queue, queue_timeout), last requested)
+        self._limits: Dict[str, Dict[str, Tuple[Tuple[int, int, float], float]]] = {}
+        self._lock = threading.Lock()
+
+    def get(self,
+            url: str,
+            max_in_flight: int,
+            max_queue: int = 16,
+            queue_timeout: float = 60.0,
+            model: str = "") -> EndpointScheduler:
+        """
+        Scheduler for the host of url
+
+        Models on the same host share one scheduler, limited by the strictest
+        of each limit (in-flight, queue size, queue timeout) among the models
+        currently using it, whatever order they are called in. A model's new
+        limits replace its old ones, and models not seen for stale_after
+        seconds (removed from the configuration) stop counting.
+        """
+        key = endpoint_key(url)
+        now = time.time()
+        with self._lock:
+            requested = self._limits.setdefault(key, {})
+            requested[model] = ((max_in_flight, max_queue, queue_timeout), now)
+            for name, (_, seen) in list(requested.items()):
+                if now - seen > self.stale_after:
+                    del requested[name]
+            limits = tuple(min(values) for values in zip(*(limits for limits, _ in requested.values())))
+
+            scheduler = self._schedulers.get(key)
+            if scheduler is None:
+                return self._schedulers.setdefault(key, EndpointScheduler(key, *limits))
+            if limits != (scheduler.max_in_flight, scheduler.max_queue, scheduler.queue_timeout):
+                scheduler.configure(*limits)
+        return scheduler
+
+    def get_or_create(self, url: str, max_in_flight: int = DEFAULT_OLLAMA_IN_FLIGHT) -> EndpointScheduler:
+        """Existing scheduler for the host with its configured limits, or a new default one"""
+        key = endpoint_key(url)
+        with self._lock:
+            scheduler = self._schedulers.get(key)
+            if scheduler is None:
+                scheduler = self._schedulers[key] = EndpointScheduler(key, max_in_flight)
+            return scheduler
+
+    def metrics(self) -> Dict[str, Dict[str, Any]]:
+        return {key: scheduler.metrics() for key, scheduler in list(self._schedulers.items())}
+
+def endpoint_key(url: str) -> str:
+    """Schedulers are per host - /api/generate and /api/chat share one Ollama instance"""
+    parsed = urlparse(url)
+    return f"{parsed.scheme}://{parsed.netloc}"
+
+# Global registry instance
+scheduler_registry = SchedulerRegistry()
@@ -0,0 +1,206 @@
+"""
+FertiVision powered by AI - LLM Response Cache
+
+Content-addressed cache for vision model responses. Entries are keyed on the
+image bytes, prompt, provider, model and temperature, so a resubmitted image
+is answered from the cache instead of paying for another model call.
+
+Two tiers:
+- In-memory LRU for hot entries
+- SQLite file shared between processes (app.py and api_server.py)
+
+© 2025 FertiVision powered by AI (made by greybrain.ai) - DeepSeek LLM Image Analysis
+"""
+
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional, Any
+
+class ResponseCache:
+    """Two-tier (memory LRU + SQLite) cache for model responses"""
+
+    def __init__(self,
+                 db_path: str = "llm_response_cache.db",
+                 max_memory_entries: int = 256,
+                 max_disk_bytes: int = 256 * 1024 * 1024,
+                 ttl_seconds: int = 30 * 24 * 3600,
+                 enabled: bool = True):
+        self.db_path = db_path
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_bytes = max_disk_bytes
+        self.ttl_seconds = ttl_seconds
+        self.enabled = enabled
+        self._memory: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.RLock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._disk_bytes = 0
+        self._stats = {
+            'memory_hits': 0,
+            'disk_hits': 0,
+            'misses': 0,
+            'stores': 0,
+            'evictions': 0,
+            'expired': 0
+        }
+
+    @staticmethod
+    def make_key(image_hash: Optional[str],
+                 prompt: str,
+                 provider: str,
+                 model_name: str,
+                 temperature: float) -> str:
+        """Build the content-addressed key for a model call"""
+        prompt_hash = hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+        material = json.dumps([image_hash or "", prompt_hash, provider, model_name, round(float(temperature), 4)])
+        return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+    def _connection(self) -> sqlite3.Connection:
+        """Open the disk tier on first use"""
+        if self._conn is None:
+            directory = os.path.dirname(self.db_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.db_path, check_same_thread=False, timeout=5)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS response_cache (
+                    cache_key TEXT PRIMARY KEY,
+                    value TEXT,
+                    size INTEGER,
+                    created REAL,
+                    accessed REAL
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_response_cache_accessed ON response_cache(accessed)')
+            conn.commit()
+            self._disk_bytes = conn.execute('SELECT COALESCE(SUM(size), 0) FROM response_cache').fetchone()[0]
+            self._conn = conn
+        return self._conn
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """Look up a cached response, memory tier first"""
+        if not self.enabled:
+            return None
+
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                created, value = entry
+                if now - created <= self.ttl_seconds:
+                    self._memory.move_to_end(key)
+                    self._stats['memory_hits'] += 1
+                    return dict(value)
+                del self._memory[key]
+                self._stats['expired'] += 1
+
+            try:
+                conn = self._connection()
+                row = conn.execute(
+                    'SELECT value, created, size FROM response_cache WHERE cache_key = ?', (key,)
+                ).fetchone()
+                if row is not None:
+                    value_json, created, size = row
+                    if now - created <= self.ttl_seconds:
+                        conn.execute('UPDATE response_cache SET accessed = ? WHERE cache_key = ?', (now, key))
+                        conn.commit()
+                        value = json.loads(value_json)
+                        self._remember(key, created, value)
+                        self._stats['disk_hits'] += 1
+                        return dict(value)
+                    conn.execute('DELETE FROM response_cache WHERE cache_key = ?', (key,))
+                    conn.commit()
+                    self._disk_bytes -= size or 0
+                    self._stats['expired'] += 1
+            except sqlite3.Error as e:
+                print(f"⚠️ Response cache read failed: {e}")
+
+            self._stats['misses'] += 1
+            return None
+
+    def put(self, key: str, value: Dict[str, Any]):
+        """Store a response in both tiers"""
+        if not self.enabled:
+            return
+
+        now = time.time()
+        value_json = json.dumps(value)
+        size = len(value_json)
+        with self._lock:
+            self._remember(key, now, value)
+            self._stats['stores'] += 1
+            try:
+                conn = self._connection()
+                old = conn.execute('SELECT size FROM response_cache WHERE cache_key = ?', (key,)).fetchone()
+                conn.execute('''
+                    INSERT OR REPLACE INTO response_cache (cache_key, value, size, created, accessed)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', (key, value_json, size, now, now))
+                conn.commit()
+                self._disk_bytes += size - (old[0] if old else 0)
+                if self._disk_bytes > self.max_disk_bytes:
+                    self._evict_disk()
+            except sqlite3.Error as e:
+                print(f"⚠️ Response cache write failed: {e}")
+
+    def _remember(self, key: str, created: float, value: Dict[str, Any]):
+        self._memory[key] = (created, dict(value))
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+            self._stats['evictions'] += 1
+
+    def _evict_disk(self):
+        """Drop expired entries, then least recently used ones until under the size budget"""
+        conn = self._connection()
+        conn.execute('DELETE FROM response_cache WHERE created < ?', (time.time() - self.ttl_seconds,))
+        self._disk_bytes = conn.execute('SELECT COALESCE(SUM(size), 0) FROM response_cache').fetchone()[0]
+        target = int(self.max_disk_bytes * 0.9)
+        while self._disk_bytes > target:
+            rows = conn.execute(
+                'SELECT cache_key, size FROM response_cache ORDER BY accessed LIMIT 64'
+            ).fetchall()
+            if not rows:
+                break
+            conn.executemany('DELETE FROM response_cache WHERE cache_key = ?', [(k,) for k, _ in rows])
+            for _, size in rows:
+                self._disk_bytes -= size or 0
+                self._stats['evictions'] += 1
+        conn.commit()
+
+    def clear(self):
+        """Remove all cached responses"""
+        with self._lock:
+            self._memory.clear()
+            try:
+                conn = self._connection()
+                conn.execute('DELETE FROM response_cache')
+                conn.commit()
+                self._disk_bytes = 0
+            except sqlite3.Error as e:
+                print(f"⚠️ Response cache clear failed: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        """Hit/miss counters and tier sizes"""
+        with self._lock:
+            hits = self._stats['memory_hits'] + self._stats['disk_hits']
+            lookups = hits + self._stats['misses']
+            return {
+                **self._stats,
+                'hits': hits,
+                'hit_rate': hits / lookups if lookups else 0.0,
+                'memory_entries': len(self._memory),
+                'disk_bytes': self._disk_bytes,
+                'enabled': self.enabled
+            }
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
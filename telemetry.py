@@ -0,0 +1,277 @@
+"""
+FertiVision powered by AI - Model Telemetry
+
+Aggregates provider call outcomes per (provider, model, analysis type):
+latency histograms with p50/p95/p99, error counters by cause, token and cost
+totals and quality scores. Exposed as Prometheus text (/metrics) and as a
+JSON summary.
+
+© 2025 FertiVision powered by AI (made by greybrain.ai) - DeepSeek LLM Image Analysis
+"""
+
+import re
+import math
+import time
+import threading
+from collections import deque
+from typing import Dict, List, Optional, Any, Tuple, Callable
+
+# Histogram bucket upper bounds in seconds; vision calls run from sub-second to minutes
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0, math.inf)
+
+# Recent samples kept per series for percentiles
+PERCENTILE_WINDOW = 1000
+
+# (metric name, help, type, [(labels, value)]) from registered collectors
+Sample = Tuple[Dict[str, str], float]
+Family = Tuple[str, str, str, List[Sample]]
+
+def classify_error(error: Optional[str]) -> str:
+    """Map a ModelResponse error message to a low-cardinality cause label"""
+    if not error:
+        return "unknown"
+    text = error.lower()
+    if text.startswith("circuit open"):
+        return "circuit_open"
+    if text.startswith("queue full") or "waited more than" in text:
+        return "queue"
+    if "timeout" in text or "timed out" in text:
+        return "timeout"
+    if "api key not provided" in text:
+        return "missing_api_key"
+    if text == "model is disabled":
+        return "disabled"
+    match = re.match(r"http (\d{3})", text)
+    if match:
+        status = int(match.group(1))
+        if status == 429:
+            return "rate_limited"
+        if status in (401, 403):
+            return "auth"
+        return "http_5xx" if status >= 500 else "http_4xx"
+    if "connect" in text or "refused" in text or "cannot connect" in text:
+        return "connection"
+    if "not implemented" in text:
+        return "not_implemented"
+    return "other"
+
+class LatencyHistogram:
+    """Cumulative buckets for Prometheus plus a window of samples for percentiles"""
+
+    def __init__(self):
+        self.bucket_counts = [0] * len(LATENCY_BUCKETS)
+        self.count = 0
+        self.total = 0.0
+        self._recent: deque = deque(maxlen=PERCENTILE_WINDOW)
+
+    def observe(self, value: float):
+        for index, bound in enumerate(LATENCY_BUCKETS):
+            if value <= bound:
+                self.bucket_counts[index] += 1
+                break
+        self.count += 1
+        self.total += value
+        self._recent.append(value)
+
+    def percentile(self, percent: float) -> Optional[float]:
+        if not self._recent:
+            return None
+        samples = sorted(self._recent)
+        rank = min(len(samples) - 1, max(0, int(math.ceil(percent / 100.0 * len(samples))) - 1))
+        return samples[rank]
+
+class _Series:
+    """Counters for one (provider, model, analysis type)"""
+
+    def __init__(self):
+        self.latency = LatencyHistogram()
+        self.requests = {'success': 0, 'error': 0, 'cancelled': 0, 'cached': 0}
+        self.errors: Dict[str, int] = {}
+        self.tokens = 0
+        self.cost = 0.0
+        self.quality_sum = 0.0
+        self.quality_count = 0
+
+class Telemetry:
+    """Process-wide model call metrics"""
+
+    def __init__(self):
+        self._series: Dict[Tuple[str, str, str], _Series] = {}
+        self._collectors: List[Callable[[], List[Family]]] = []
+        self._lock = threading.Lock()
+        self.started = time.time()
+
+    def _get(self, provider: str, model: str, analysis_type: str) -> _Series:
+        key = (provider, model, analysis_type)
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = _Series()
+        return series
+
+    def record_call(self,
+                    analysis_type: str,
+                    provider: str,
+                    model: str,
+                    latency: float,
+                    success: bool,
+                    token_count: Optional[int] = None,
+                    cost: float = 0.0,
+                    error: Optional[str] = None,
+                    cancelled: bool = False):
+        """Record one provider call"""
+        with self._lock:
+            series = self._get(provider, model, analysis_type)
+            if cancelled:
+                series.requests['cancelled'] += 1
+            elif success:
+                series.requests['success'] += 1
+                series.latency.observe(latency)
+            else:
+                series.requests['error'] += 1
+                cause = classify_error(error)
+                series.errors[cause] = series.errors.get(cause, 0) + 1
+            series.tokens += token_count or 0
+            series.cost += cost or 0.0
+
+    def record_attempts(self, analysis_type: str, attempts: List[Dict[str, Any]]):
+        """Record the attempt list of a ModelResponse"""
+        for attempt in attempts:
+            self.record_call(
+                analysis_type,
+                attempt['provider'],
+                attempt['model_name'],
+                attempt['latency'],
+                attempt['success'],
+                token_count=attempt.get('token_count'),
+                cost=attempt.get('cost', 0.0),
+                error=attempt.get('error'),
+                cancelled=attempt.get('cancelled', False)
+            )
+
+    def record_cache_hit(self, analysis_type: str, provider: str, model: str):
+        with self._lock:
+            self._get(provider, model, analysis_type).requests['cached'] += 1
+
+    def record_quality(self, analysis_type: str, provider: str, model: str, quality_score: Optional[float]):
+        if quality_score is None:
+            return
+        with self._lock:
+            series = self._get(provider, model, analysis_type)
+            series.quality_sum += quality_score
+            series.quality_count += 1
+
+    def register_collector(self, collector: Callable[[], List[Family]]):
+        """Add a callable contributing extra metric families to /metrics"""
+        self._collectors.append(collector)
+
+    def unregister_collector(self, collector: Callable[[], List[Family]]):
+        """Remove a collector added with register_collector (no-op if it is not registered)"""
+        if collector in self._collectors:
+            self._collectors.remove(collector)
+
+    def reset(self):
+        with self._lock:
+            self._series.clear()
+            self.started = time.time()
+
+    def summary(self) -> Dict[str, Any]:
+        """JSON summary per provider/model/analysis type plus totals"""
+        with self._lock:
+            series_list = []
+            totals = {'requests': 0, 'errors': 0, 'tokens': 0, 'cost': 0.0}
+            for (provider, model, analysis_type), series in sorted(self._series.items()):
+                latency = series.latency
+                series_list.append({
+                    'provider': provider,
+                    'model': model,
+                    'analysis_type': analysis_type,
+                    'requests': dict(series.requests),
+                    'errors': dict(series.errors),
+                    'latency': {
+                        'count': latency.count,
+                        'mean': latency.total / latency.count if latency.count else None,
+                        'p50': latency.percentile(50),
+                        'p95': latency.percentile(95),
+                        'p99': latency.percentile(99)
+                    },
+                    'tokens': series.tokens,
+                    'cost': round(series.cost, 6),
+                    'avg_quality': series.quality_sum / series.quality_count if series.quality_count else None
+                })
+                totals['requests'] += sum(series.requests.values())
+                totals['errors'] += series.requests['error']
+                totals['tokens'] += series.tokens
+                totals['cost'] += series.cost
+            totals['cost'] = round(totals['cost'], 6)
+            return {
+                'uptime_seconds': time.time() - self.started,
+                'totals': totals,
+                'series': series_list
+            }
+
+    def render_prometheus(self) -> str:
+        """Prometheus text exposition format"""
+        lines: List[str] = []
+
+        def family(name: str, help_text: str, metric_type: str):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+
+        with self._lock:
+            items = sorted(self._series.items())
+
+            family("fertivision_model_requests_total", "Model calls by outcome", "counter")
+            for key, series in items:
+                for outcome, value in series.requests.items():
+                    lines.append(f"fertivision_model_requests_total{_labels(key, outcome=outcome)} {value}")
+
+            family("fertivision_model_errors_total", "Failed model calls by cause", "counter")
+            for key, series in items:
+                for cause, value in sorted(series.errors.items()):
+                    lines.append(f"fertivision_model_errors_total{_labels(key, cause=cause)} {value}")
+
+            family("fertivision_model_latency_seconds", "Latency of successful model calls", "histogram")
+            for key, series in items:
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS, series.latency.bucket_counts):
+                    cumulative += count
+                    le = "+Inf" if bound == math.inf else repr(bound)
+                    lines.append(f"fertivision_model_latency_seconds_bucket{_labels(key, le=le)} {cumulative}")
+                lines.append(f"fertivision_model_latency_seconds_sum{_labels(key)} {series.latency.total}")
+                lines.append(f"fertivision_model_latency_seconds_count{_labels(key)} {series.latency.count}")
+
+            family("fertivision_model_tokens_total", "Tokens used by model calls", "counter")
+            for key, series in items:
+                lines.append(f"fertivision_model_tokens_total{_labels(key)} {series.tokens}")
+
+            family("fertivision_model_cost_total", "Estimated model spend in USD", "counter")
+            for key, series in items:
+                lines.append(f"fertivision_model_cost_total{_labels(key)} {series.cost}")
+
+        for collector in list(self._collectors):
+            try:
+                families = collector()
+            except Exception as e:
+                print(f"⚠️ Metrics collector failed: {e}")
+                continue
+            for name, help_text, metric_type, samples in families:
+                family(name, help_text, metric_type)
+                for labels, value in samples:
+                    lines.append(f"{name}{_format_labels(labels)} {value}")
+
+        return "\n".join(lines) + "\n"
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels.items()) + "}"
+
+def _labels(key: Tuple[str, str, str], **extra) -> str:
+    provider, model, analysis_type = key
+    return _format_labels({'provider': provider, 'model': model, 'analysis_type': analysis_type, **extra})
+
+# Global telemetry instance
+telemetry = Telemetry()
@@ -0,0 +1,803 @@
+#!/usr/bin/env python3
+"""
+Test script for the FertiVision analysis database:
+- Pooled WAL-mode SQLite connections
+- Concurrent writers through the classification system
+- Typed columns, indexes and the online backfill
+- Bulk classification with chunked transactions
+- Write-behind queue with group commit and journal recovery
+- Analysis ID index and cross-type resolution
+- Compressed, deduplicated LLM text storage
+- Keyset-paginated analysis history
+- Monthly archive partitions with transparent reads
+- Online backups with verification and rotation
+- Storage repositories (SQLite; PostgreSQL when FERTIVISION_TEST_POSTGRES_URL is set)
+- PostgreSQL placeholder translation against a stubbed connection
+
+Uses a temporary database file, the working database is never touched.
+"""
+
+import os
+import json
+import sqlite3
+import tempfile
+import time
+import datetime
+import threading
+from contextlib import contextmanager
+
+from database import ConnectionPool, get_pool
+from reproductive_classification_system import ReproductiveClassificationSystem, OocyteMaturity
+from enhanced_reproductive_system import EnhancedReproductiveSystem
+from analysis_schema import backfill, migration_status, main as migrate_main
+from write_behind import WriteBehindQueue, close_write_queues
+from blob_store import blob_stats
+from analysis_history import HistoryFilters, parse_history_args
+from archive import archive_analyses
+from backup import backup_database, list_backups, BackupScheduler
+from storage import SQLiteRepository, PostgresRepository, get_repository, PSYCOPG2_AVAILABLE, _pg
+
+def temp_db_path(name="analysis.db"):
+    return os.path.join(tempfile.mkdtemp(prefix="fertivision_db_"), name)
+
+def test_connection_pool():
+    """Test connection reuse, pragmas and transaction handling"""
+    print("\n🧪 Testing SQLite connection pool...")
+
+    db_path = temp_db_path()
+    pool = ConnectionPool(db_path)
+    with pool.connection() as conn:
+        assert conn.execute('PRAGMA journal_mode').fetchone()[0] == "wal"
+        assert conn.execute('PRAGMA synchronous').fetchone()[0] == 1  # NORMAL
+        assert conn.execute('PRAGMA busy_timeout').fetchone()[0] == 5000
+        conn.execute('CREATE TABLE items (name TEXT)')
+        conn.execute("INSERT INTO items VALUES ('committed')")
+
+    for _ in range(20):
+        with pool.connection() as conn:
+            conn.execute('SELECT COUNT(*) FROM items').fetchone()
+    stats = pool.stats()
+    assert stats['opened'] == 1 and stats['reused'] == 20, stats
+    print(f"✅ One connection served 21 blocks ({stats})")
+
+    try:
+        with pool.connection() as conn:
+            conn.execute("INSERT INTO items VALUES ('rolled back')")
+            raise RuntimeError("abort")
+    except RuntimeError:
+        pass
+    with pool.connection() as conn:
+        names = [row[0] for row in conn.execute('SELECT name FROM items')]
+    assert names == ['committed'], names
+    print("✅ Commit on success, rollback on error")
+
+    # A deleted database must not be served from stale connections
+    pool.close()
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(db_path + suffix):
+            os.remove(db_path + suffix)
+    with pool.connection() as conn:
+        assert conn.execute("SELECT name FROM sqlite_master WHERE name = 'items'").fetchone() is None
+    print("✅ Replaced database file gets fresh connections")
+
+    assert get_pool(db_path) is get_pool(os.path.join(os.path.dirname(db_path), ".", "analysis.db"))
+
+def test_concurrent_writers():
+    """Test many threads storing analyses at once"""
+    print("\n🧪 Testing concurrent analysis writes...")
+
+    classifier = ReproductiveClassificationSystem(temp_db_path())
+    errors = []
+
+    def worker(index):
+        try:
+            for n in range(10):
+                classifier.classify_sperm(
+                    concentration=20.0 + n,
+                    progressive_motility=35.0,
+                    normal_morphology=5.0,
+                    sample_id=f"POOL_{index}_{n}"
+                )
+                classifier.generate_report('sperm', f"POOL_{index}_{n}")
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert not errors, errors
+    with classifier.db.connection() as conn:
+        count = conn.execute('SELECT COUNT(*) FROM sperm_analyses').fetchone()[0]
+    assert count == 80, count
+    stats = classifier.db.stats()
+    assert stats['opened'] <= 8 + 1, stats
+    print(f"✅ 80 analyses stored by 8 threads without lock errors ({stats['opened']} connections opened)")
+
+def create_legacy_database(db_path, rows):
+    """Database in the original JSON-only layout"""
+    conn = sqlite3.connect(db_path)
+    conn.execute('CREATE TABLE embryo_analyses (id INTEGER PRIMARY KEY AUTOINCREMENT, embryo_id TEXT UNIQUE, data TEXT, timestamp TEXT)')
+    conn.executemany(
+        'INSERT INTO embryo_analyses (embryo_id, data, timestamp) VALUES (?, ?, ?)',
+        [(f"LEGACY_{i}",
+          json.dumps({'embryo_id': f"LEGACY_{i}", 'day': 3 + i % 3, 'cell_count': 8, 'fragmentation': 5.0,
+                      'symmetry': 'symmetric', 'multinucleation': False,
+                      'grade': 'good' if i % 2 else 'fair', 'classification': f"Grade {i % 4}",
+                      'transfer_quality': bool(i % 2), 'freeze_quality': True, 'notes': '', 'timestamp': "2024-01-01T00:00:00"}),
+          "2024-01-01T00:00:00")
+         for i in range(rows)]
+    )
+    conn.commit()
+    conn.close()
+
+def test_typed_schema_migration():
+    """Test typed columns on new writes and the resumable online backfill"""
+    print("\n🧪 Testing typed schema and backfill...")
+
+    db_path = temp_db_path()
+    create_legacy_database(db_path, 1200)
+    classifier = ReproductiveClassificationSystem(db_path)
+
+    # Old rows are readable before the backfill; new rows get typed columns immediately
+    assert "LEGACY_7" in classifier.generate_report('embryo', "LEGACY_7")
+    classifier.classify_oocyte(maturity=OocyteMaturity.MII, morphology_score=3,
+                               oocyte_id="TYPED_OOC", patient_id="P-42", case_id="C-7")
+    with classifier.db.connection() as conn:
+        row = conn.execute("SELECT maturity, morphology_score, viability, patient_id, case_id FROM oocyte_analyses").fetchone()
+        assert row == ("metaphase_ii", 3, 1, "P-42", "C-7"), row
+        assert conn.execute("SELECT COUNT(*) FROM embryo_analyses WHERE grade IS NOT NULL").fetchone()[0] == 0
+        assert not migration_status(conn)['embryo_analyses']['complete']
+    print("✅ New writes populate typed columns, legacy rows still readable")
+
+    # Interrupt the backfill after two batches, then resume
+    class Interrupted(Exception):
+        pass
+
+    batches = []
+
+    def stop_after_two(table, done, total):
+        batches.append(done)
+        if len(batches) == 2:
+            raise Interrupted()
+
+    with classifier.db.connection() as conn:
+        try:
+            backfill(conn, ['embryo_analyses'], batch_size=250, progress=stop_after_two)
+        except Interrupted:
+            pass
+        assert migration_status(conn)['embryo_analyses']['last_id'] == 500
+
+    # Writers keep going while the backfill finishes
+    errors = []
+
+    def writer():
+        try:
+            for n in range(30):
+                classifier.classify_embryo(day=5, cell_count=100, fragmentation=0.0,
+                                           expansion='4', inner_cell_mass='A', trophectoderm='A',
+                                           embryo_id=f"LIVE_{n}")
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=writer)
+    thread.start()
+    assert migrate_main([db_path, '--batch-size', '100', '--pause', '0']) == 0
+    thread.join()
+    assert not errors, errors
+
+    with classifier.db.connection() as conn:
+        assert migration_status(conn)['embryo_analyses']['complete']
+        missing = conn.execute("SELECT COUNT(*) FROM embryo_analyses WHERE grade IS NULL").fetchone()[0]
+        assert missing == 0, missing
+        assert conn.execute("SELECT COUNT(*) FROM embryo_analyses WHERE grade = 'excellent' AND day = 5").fetchone()[0] == 30
+        assert conn.execute("SELECT COUNT(*) FROM embryo_analyses WHERE transfer_quality = 1").fetchone()[0] == 630
+        plan = " ".join(str(row) for row in conn.execute("EXPLAIN QUERY PLAN SELECT id FROM embryo_analyses WHERE grade = 'good'"))
+        assert "idx_embryo_analyses_grade" in plan, plan
+    print("✅ Backfill resumed after interruption and ran alongside writers")
+
+def test_batch_classification():
+    """Test classify_*_batch with row and columnar inputs"""
+    print("\n🧪 Testing bulk classification...")
+
+    classifier = ReproductiveClassificationSystem(temp_db_path())
+    count = 20000
+    columns = {
+        'concentration': [5.0 + i % 40 for i in range(count)],
+        'progressive_motility': [20.0 + i % 30 for i in range(count)],
+        'normal_morphology': [2.0 + i % 5 for i in range(count)],
+        'patient_id': [f"P{i % 500}" for i in range(count)],
+    }
+    columns['concentration'][7] = "not a number"
+
+    start = time.time()
+    results = classifier.classify_sperm_batch(columns, chunk_size=5000)
+    elapsed = time.time() - start
+    failed = [result for result in results if not result.success]
+    assert len(results) == count and [r.index for r in failed] == [7], failed
+    with classifier.db.connection() as conn:
+        stored = conn.execute('SELECT COUNT(*) FROM sperm_analyses').fetchone()[0]
+        per_patient = conn.execute("SELECT COUNT(*) FROM sperm_analyses WHERE patient_id = 'P42'").fetchone()[0]
+        normo = conn.execute("SELECT COUNT(*) FROM sperm_analyses WHERE classification = 'Normozoospermia'").fetchone()[0]
+    assert stored == count - 1 and per_patient == 40, (stored, per_patient)
+    assert normo == sum(1 for r in results if r.success and r.analysis.classification == 'Normozoospermia')
+    print(f"✅ {stored} sperm analyses stored in {elapsed:.2f}s, bad row reported without aborting")
+
+    oocytes = classifier.classify_oocyte_batch([
+        {'maturity': 'MII', 'morphology_score': 4, 'oocyte_id': 'B_OOC_1'},
+        {'maturity': 'metaphase_i', 'morphology_score': 2, 'oocyte_id': 'B_OOC_2'},
+        {'maturity': 'unknown', 'morphology_score': 2, 'oocyte_id': 'B_OOC_3'},
+        {'maturity': OocyteMaturity.GV, 'morphology_score': 1},
+    ])
+    assert [r.success for r in oocytes] == [True, True, False, True]
+    assert oocytes[0].analysis.viability and not oocytes[1].analysis.viability
+    assert "B_OOC_1" in classifier.generate_report('oocyte', 'B_OOC_1')
+
+    import pandas as pd
+    frame = pd.DataFrame({'day': [3, 3, 5], 'cell_count': [8, 4, 120], 'fragmentation': [5.0, 30.0, 0.0],
+                          'embryo_id': ['B_EMB_1', 'B_EMB_2', 'B_EMB_3']})
+    embryos = classifier.classify_embryo_batch(frame)
+    assert all(r.success for r in embryos), embryos
+    with classifier.db.connection() as conn:
+        assert conn.execute("SELECT day FROM embryo_analyses WHERE embryo_id = 'B_EMB_3'").fetchone()[0] == 5
+    print("✅ Oocyte rows and embryo DataFrame classified in bulk")
+
+    # Back-to-back batches in the same second get distinct generated IDs
+    first = classifier.classify_oocyte_batch([{'maturity': 'MII', 'morphology_score': 3}] * 3)
+    second = classifier.classify_oocyte_batch([{'maturity': 'MII', 'morphology_score': 3}] * 3)
+    ids = {r.analysis.oocyte_id for r in first + second}
+    assert len(ids) == 6, ids
+    with classifier.db.connection() as conn:
+        stored = conn.execute('SELECT COUNT(*) FROM oocyte_analyses WHERE oocyte_id LIKE ?', ('OOC_%',)).fetchone()[0]
+    assert stored == 7, stored  # Plus the GV oocyte of the first batch
+    print("✅ Consecutive batches keep every generated ID")
+
+def test_write_behind():
+    """Test queued writes, read-your-writes, group commit and crash recovery"""
+    print("\n🧪 Testing write-behind persistence...")
+
+    db_path = temp_db_path()
+    classifier = ReproductiveClassificationSystem(db_path, write_behind=True)
+    writes = classifier.writes
+
+    # Hold the writer back so the analyses are still queued when read
+    with writes.pool.connection() as blocker:
+        blocker.execute('BEGIN IMMEDIATE')
+        for n in range(50):
+            classifier.classify_sperm(concentration=20.0 + n, progressive_motility=35.0,
+                                      normal_morphology=5.0, sample_id=f"WB_{n}")
+        assert writes.pending('sperm_analyses', "WB_49") is not None
+        assert "WB_49" in classifier.generate_report('sperm', "WB_49")
+        with open(writes.journal_path) as journal:
+            assert len(journal.readlines()) == 50
+        print("✅ Queued analyses journaled and visible to reports before commit")
+
+    classifier.flush_writes()
+    stats = writes.stats()
+    assert stats['committed'] == 50 and stats['batches'] < 50 and stats['pending'] == 0, stats
+    with classifier.db.connection() as conn:
+        assert conn.execute('SELECT COUNT(*) FROM sperm_analyses').fetchone()[0] == 50
+    print(f"✅ 50 writes committed in {stats['batches']} transactions")
+
+    # Simulated crash: journaled writes that never reached the database
+    close_write_queues()
+    sql = SQLiteRepository.insert_sql('sperm_analyses')
+    with open(writes.journal_path, "w") as journal:
+        for n, seq in enumerate(range(51, 54)):
+            params = [f"LOST_{n}", json.dumps({'sample_id': f"LOST_{n}"}), "2024-01-01T00:00:00"] + [None] * 6
+            journal.write(json.dumps({'seq': seq, 'table': 'sperm_analyses', 'statements': [[sql, params]]}) + "\n")
+        journal.write('{"seq": 54, "tab')  # torn append
+
+    recovered = WriteBehindQueue(get_pool(db_path))
+    assert recovered.stats()['replayed'] == 3
+    with classifier.db.connection() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM sperm_analyses WHERE sample_id LIKE 'LOST_%'").fetchone()[0] == 3
+    assert os.path.getsize(recovered.journal_path) == 0
+    recovered.close()
+
+    # Replaying again must not duplicate anything past the checkpoint
+    again = WriteBehindQueue(get_pool(db_path))
+    assert again.stats()['replayed'] == 0
+    again.close()
+    print("✅ Journal replayed after crash, torn entry ignored, journal cleared")
+
+def test_write_behind_failed_commit():
+    """Test that a batch that fails to commit is retried, never skipped, and kept across restarts"""
+    print("\n🧪 Testing write-behind commit failures...")
+
+    db_path = temp_db_path()
+    ReproductiveClassificationSystem(db_path)  # Creates the tables
+    sql = SQLiteRepository.insert_sql('sperm_analyses')
+
+    def write(writes, sample_id):
+        params = [sample_id, json.dumps({'sample_id': sample_id}), "2024-01-01T00:00:00"] + [None] * 6
+        writes.submit('sperm_analyses', [(sql, params)], key=sample_id, row=tuple(params))
+
+    def count(pattern):
+        with get_pool(db_path).connection() as conn:
+            return conn.execute("SELECT COUNT(*) FROM sperm_analyses WHERE sample_id LIKE ?", (pattern,)).fetchone()[0]
+
+    # Locked database for the first two attempts: the batch stays pending, then commits
+    writes = WriteBehindQueue(get_pool(db_path), retry_delay=0.05)
+    commit = writes._commit
+    failures = {'left': 2}
+    def flaky_commit(batch):
+        if failures['left']:
+            failures['left'] -= 1
+            raise sqlite3.OperationalError("database is locked")
+        commit(batch)
+    writes._commit = flaky_commit
+    write(writes, "RETRY_0")
+    time.sleep(0.02)
+    assert writes.pending('sperm_analyses', "RETRY_0") is not None
+    assert writes.flush(timeout=5)
+    stats = writes.stats()
+    assert stats['retries'] == 2 and stats['pending'] == 0 and count("RETRY_%") == 1, stats
+    print(f"✅ Failed batch retried {stats['retries']} times and committed")
+
+    # Database unavailable until close: nothing past the failed write is checkpointed
+    def failing_commit(batch):
+        raise sqlite3.OperationalError("disk I/O error")
+    writes._commit = failing_commit
+    for n in range(3):
+        write(writes, f"KEPT_{n}")
+    assert not writes.flush(timeout=0.2)
+    assert writes.pending('sperm_analyses', "KEPT_0") is not None
+    writes.close()
+    with get_pool(db_path).connection() as conn:
+        last_seq = conn.execute('SELECT last_seq FROM write_behind_checkpoint WHERE id = 1').fetchone()[0]
+    assert last_seq == 1 and count("KEPT_%") == 0, last_seq
+    with open(writes.journal_path) as journal:
+        assert sum('KEPT_' in line for line in journal) == 3
+    print("✅ Checkpoint held at the last committed write, journal kept on close")
+
+    # Restart: the kept writes are replayed once
+    restarted = WriteBehindQueue(get_pool(db_path))
+    assert restarted.stats()['replayed'] == 3 and count("KEPT_%") == 3
+
+    # A write that can never commit (missing column) is dropped, the writes behind it commit
+    restarted.submit('sperm_analyses', [('INSERT INTO sperm_analyses (sample_id, no_such_column) VALUES (?, ?)',
+                                         ["BAD_0", 1])])
+    for n in range(3):
+        write(restarted, f"AFTER_{n}")
+    assert restarted.flush(timeout=5)
+    stats = restarted.stats()
+    assert stats['failed'] == 1 and stats['retries'] == 0 and count("AFTER_%") == 3, stats
+    restarted.close()
+    assert os.path.getsize(restarted.journal_path) == 0
+    print("✅ Kept writes replayed on restart, schema error dropped without stalling the queue")
+
+def test_analysis_index():
+    """Test resolving any public ID to its analysis with one indexed lookup"""
+    print("\n🧪 Testing analysis ID index...")
+
+    from PIL import Image
+
+    directory = tempfile.mkdtemp(prefix="fertivision_db_")
+    image_path = os.path.join(directory, "scan.png")
+    Image.new('RGB', (64, 64)).save(image_path)
+    db_path = os.path.join(directory, "analysis.db")
+    system = EnhancedReproductiveSystem(db_path, upload_folder=os.path.join(directory, "uploads"), mock_mode=True)
+
+    sperm = system.analyze_sperm_with_image(image_path, analysis_id="api-sperm-1")
+    scan = system.analyze_follicle_scan_with_image(image_path, analysis_id="api-scan-1")
+    procedure = system.analyze_hysteroscopy_with_image(image_path)
+    system.classify_embryo(day=3, cell_count=8, fragmentation=5.0, embryo_id="IDX_EMB")
+
+    ref = system.resolve_analysis("api-scan-1")
+    assert ref.analysis_type == 'follicle' and ref.natural_id == scan['analysis_id'] and ref.image_path == image_path, ref
+    assert system.resolve_analysis(sperm.sample_id).analysis_type == 'sperm'
+    assert system.resolve_analysis(procedure['analysis_id']).table == 'hysteroscopy_analyses'
+    assert system.resolve_analysis("IDX_EMB").image_path is None
+    assert system.resolve_analysis("missing") is None
+    with system.db.connection() as conn:
+        plan = " ".join(str(row) for row in conn.execute("EXPLAIN QUERY PLAN SELECT * FROM analysis_index WHERE public_id = 'x'"))
+        assert "sqlite_autoindex_analysis_index" in plan, plan
+    print("✅ Natural keys and API analysis IDs resolve to type, table and image")
+
+    # Export data without knowing the type; previously failed on tables without sample_id
+    record = system.get_analysis_by_id(None, "api-scan-1")
+    assert record['analysis_type'] == 'follicle' and record['scan_id'] == scan['analysis_id'], record
+    assert 'total_follicle_count' in record and record['image_path'] == image_path
+    assert system.get_analysis_by_id('hysteroscopy', procedure['analysis_id'])['procedure_id'] == procedure['analysis_id']
+    assert system.get_analysis_by_id('embryo', "api-scan-1") is None
+
+    # Replacing a row gives it a new row id; the alias must follow
+    system.classify_sperm(concentration=40.0, progressive_motility=50.0, normal_morphology=6.0, sample_id=sperm.sample_id)
+    with system.db.connection() as conn:
+        row_id = conn.execute('SELECT id FROM sperm_analyses WHERE sample_id = ?', (sperm.sample_id,)).fetchone()[0]
+    assert system.resolve_analysis("api-sperm-1").row_id == row_id
+    assert system.get_analysis_by_id(None, "api-sperm-1")['classification'] == "Normozoospermia"
+    print("✅ get_analysis_by_id works for every type and follows replaced rows")
+
+    # Rows stored before the index existed are indexed by the backfill
+    legacy_path = temp_db_path()
+    create_legacy_database(legacy_path, 300)
+    legacy = ReproductiveClassificationSystem(legacy_path)
+    assert legacy.resolve_analysis("LEGACY_5").analysis_type == 'embryo'  # natural key fallback
+    with legacy.db.connection() as conn:
+        backfill(conn, batch_size=100)
+        assert conn.execute("SELECT COUNT(*) FROM analysis_index WHERE table_name = 'embryo_analyses'").fetchone()[0] == 300
+    print("✅ Legacy rows resolved by fallback and indexed by the backfill")
+
+def test_llm_blob_store():
+    """Test that repeated LLM text is stored once, compressed, and read back transparently"""
+    print("\n🧪 Testing LLM text blob store...")
+
+    directory = tempfile.mkdtemp(prefix="fertivision_db_")
+    db_path = os.path.join(directory, "analysis.db")
+    system = EnhancedReproductiveSystem(db_path, upload_folder=os.path.join(directory, "uploads"), mock_mode=True)
+
+    text = "\n".join(f"Line {n}: progressive motility assessed, morphology within reference range" for n in range(60))
+    for n in range(20):
+        system.classify_sperm(concentration=30.0, progressive_motility=40.0, normal_morphology=5.0, sample_id=f"BLOB_{n}")
+        system._store_image_analysis(f"BLOB_{n}", "sperm", "/images/sample.png", text, {})
+    system._store_image_analysis("BLOB_0", "oocyte", "/images/other.png", "short", {})
+
+    with system.db.connection() as conn:
+        stats = blob_stats(conn)
+        assert conn.execute('SELECT COUNT(*) FROM image_analyses WHERE llm_analysis IS NOT NULL').fetchone()[0] == 0
+    assert stats['blobs'] == 2 and stats['references'] == 21, stats
+    assert stats['stored_bytes'] * 10 < stats['original_bytes'], stats
+    assert text in system.generate_enhanced_report('sperm', "BLOB_7")
+    print(f"✅ 21 rows share 2 blobs, {stats['original_bytes']} bytes stored as {stats['stored_bytes']}")
+
+    # Rows written before the blob store keep working and move over in the backfill
+    with system.db.connection() as conn:
+        conn.execute('''
+            INSERT INTO image_analyses (sample_id, analysis_type, image_path, llm_analysis, processed_data, timestamp)
+            VALUES ('OLD_1', 'sperm', '/images/old.png', ?, '{}', '2024-01-01T00:00:00')
+        ''', (text,))
+    system.classify_sperm(concentration=30.0, progressive_motility=40.0, normal_morphology=5.0, sample_id="OLD_1")
+    assert text in system.generate_enhanced_report('sperm', "OLD_1")
+    with system.db.connection() as conn:
+        moved = backfill(conn)['image_analyses']
+        assert moved == 1 and blob_stats(conn)['references'] == 22
+    assert text in system.generate_enhanced_report('sperm', "OLD_1")
+    print("✅ Legacy plain text readable and migrated into the blob store")
+
+def test_analysis_history():
+    """Test history filters, keyset pagination and field projection"""
+    print("\n🧪 Testing analysis history...")
+
+    directory = tempfile.mkdtemp(prefix="fertivision_db_")
+    system = EnhancedReproductiveSystem(os.path.join(directory, "analysis.db"),
+                                        upload_folder=os.path.join(directory, "uploads"), mock_mode=True)
+    system.classify_sperm_batch({
+        'concentration': [5.0 + i % 40 for i in range(3000)],
+        'progressive_motility': [40.0] * 3000,
+        'normal_morphology': [5.0] * 3000,
+        'patient_id': [f"P{i % 30}" for i in range(3000)],
+    })
+    system.classify_embryo_batch([{'day': 3, 'cell_count': 8, 'fragmentation': 5.0, 'patient_id': "P7",
+                                   'embryo_id': f"HIST_EMB_{n}"} for n in range(25)])
+    system._store_image_analysis("HIST_EMB_3", "embryo", "/images/e3.png", "LLM embryo assessment", {},
+                                 alias="api-emb-3", client="Demo IVF Clinic")
+
+    # Walk every page of one patient; no duplicates, newest first, stable under concurrent inserts
+    seen = []
+    cursor = None
+    while True:
+        page = system.history(HistoryFilters(patient_id="P7"), cursor=cursor, limit=17)
+        seen.extend(page['items'])
+        if len(seen) == 17:
+            system.classify_sperm(concentration=30.0, progressive_motility=40.0, normal_morphology=5.0,
+                                  sample_id="HIST_LATE", patient_id="P7")
+        cursor = page['next_cursor']
+        if not cursor:
+            break
+    ids = [item['analysis_id'] for item in seen]
+    assert len(ids) == len(set(ids)) == 100 + 25, len(ids)
+    assert "HIST_LATE" not in ids and "api-emb-3" not in ids
+    keys = [(item['timestamp'], item['analysis_id']) for item in seen]
+    assert keys == sorted(keys, reverse=True)
+    print(f"✅ {len(ids)} analyses of one patient paged without duplicates or gaps")
+
+    embryos = system.history(HistoryFilters(analysis_type='embryo', client="Demo IVF Clinic"),
+                             fields=['analysis_id', 'aliases', 'image_path', 'data', 'llm_analysis'])['items']
+    assert len(embryos) == 1 and embryos[0]['aliases'] == ["api-emb-3"], embryos
+    assert embryos[0]['data']['cell_count'] == 8 and embryos[0]['llm_analysis'] == "LLM embryo assessment"
+
+    # LLM text of a whole page in one query, newest image analysis per sample
+    for n, text in ((5, "LLM text 5"), (6, "LLM text 6"), (5, "LLM text 5 v2")):
+        system._store_image_analysis(f"HIST_EMB_{n}", "embryo", f"/images/e{n}.png", text, {})
+    statements = []
+    with system.storage.db.connection() as conn:
+        conn.set_trace_callback(statements.append)
+    try:
+        page = system.history(HistoryFilters(analysis_type='embryo', patient_id="P7"),
+                              fields=['analysis_id', 'llm_analysis'], limit=50)['items']
+    finally:
+        with system.storage.db.connection() as conn:
+            conn.set_trace_callback(None)
+    texts = {item['analysis_id']: item['llm_analysis'] for item in page}
+    assert len(texts) == 25 and texts["HIST_EMB_5"] == "LLM text 5 v2" and texts["HIST_EMB_6"] == "LLM text 6"
+    assert texts["HIST_EMB_0"] is None
+    assert sum(1 for sql in statements if 'FROM image_analyses' in sql) == 1, statements
+    print("✅ LLM text of a 25-item page read in one query")
+
+    default = system.history(HistoryFilters(classification="Normozoospermia"), limit=5)['items']
+    assert len(default) == 5 and 'llm_analysis' not in default[0] and 'data' not in default[0]
+    today = datetime.date.today().isoformat()
+    assert system.history(HistoryFilters(date_to="2000-01-01"))['items'] == []
+    assert len(system.history(HistoryFilters(date_from=today, patient_id="P1"), limit=500)['items']) == 100
+
+    for bad in ({'fields': 'analysis_id,secret'}, {'limit': '0'}, {'cursor': 'not-a-cursor'}, {'type': 'unknown'}):
+        try:
+            filters, cursor, limit, fields = parse_history_args(bad)
+            system.history(filters, cursor, limit, fields)
+            assert False, bad
+        except ValueError:
+            pass
+    print("✅ Type, client, classification and date filters with field projection")
+
+    with system.db.connection() as conn:
+        for column in ('patient_id', 'classification', 'client', 'analysis_type'):
+            plan = " ".join(str(row) for row in conn.execute(f'''
+                EXPLAIN QUERY PLAN SELECT public_id FROM analysis_index
+                WHERE public_id = natural_id AND {column} = 'x' AND (timestamp, public_id) < ('z', 'z')
+                ORDER BY timestamp DESC, public_id DESC LIMIT 51
+            '''))
+            assert f"idx_analysis_history_{column}" in plan and "TEMP B-TREE" not in plan, plan
+    print("✅ Every filter pages through an index without sorting")
+
+def test_archive_tier():
+    """Test archiving old analyses into monthly partitions and reading them back"""
+    print("\n🧪 Testing archive tier...")
+
+    directory = tempfile.mkdtemp(prefix="fertivision_db_")
+    system = EnhancedReproductiveSystem(os.path.join(directory, "analysis.db"),
+                                        upload_folder=os.path.join(directory, "uploads"), mock_mode=True)
+    system.classify_sperm_batch([{'concentration': 20.0, 'progressive_motility': 40.0, 'normal_morphology': 5.0,
+                                  'patient_id': "P-ARCH", 'sample_id': f"ARCH_{n:03d}"} for n in range(120)])
+    system.classify_embryo(day=3, cell_count=8, fragmentation=5.0, embryo_id="ARCH_EMB", patient_id="P-ARCH")
+    system._store_image_analysis("ARCH_EMB", "embryo", "/images/arch.png", "LLM archived assessment", {},
+                                 alias="api-arch-emb", client="Demo IVF Clinic")
+    system.classify_sperm(concentration=20.0, progressive_motility=40.0, normal_morphology=5.0,
+                          sample_id="ARCH_RECENT", patient_id="P-ARCH")
+
+    # Spread the old analyses over three months
+    with system.db.connection() as conn:
+        for n in range(120):
+            timestamp = f"2024-{1 + n % 3:02d}-{1 + n // 3 % 28:02d}T10:00:{n % 60:02d}"
+            conn.execute('UPDATE sperm_analyses SET timestamp = ? WHERE sample_id = ?', (timestamp, f"ARCH_{n:03d}"))
+            conn.execute('UPDATE analysis_index SET timestamp = ? WHERE natural_id = ?', (timestamp, f"ARCH_{n:03d}"))
+        conn.execute("UPDATE embryo_analyses SET timestamp = '2024-02-15T09:00:00' WHERE embryo_id = 'ARCH_EMB'")
+        conn.execute("UPDATE analysis_index SET timestamp = '2024-02-15T09:00:00' WHERE natural_id = 'ARCH_EMB'")
+    before = system.history(HistoryFilters(patient_id="P-ARCH"), limit=500,
+                            fields=['analysis_id', 'timestamp', 'data'])['items']
+
+    now = datetime.datetime(2024, 9, 1)
+    with system.db.connection() as conn:
+        archived = archive_analyses(conn, system.archive.archive_dir, older_than_days=90, batch_size=50, now=now)
+        assert archived['sperm_analyses'] == 120 and archived['embryo_analyses'] == 1, archived
+        assert conn.execute("SELECT COUNT(*) FROM sperm_analyses WHERE sample_id LIKE 'ARCH_%'").fetchone()[0] == 1
+        assert conn.execute("SELECT COUNT(*) FROM image_analyses WHERE sample_id = 'ARCH_EMB'").fetchone()[0] == 0
+        assert blob_stats(conn)['blobs'] == 0
+        assert archive_analyses(conn, system.archive.archive_dir, older_than_days=90, now=now)['sperm_analyses'] == 0
+    assert [partition.name for partition in system.archive.partitions()] == [
+        "analyses_2024_03.db", "analyses_2024_02.db", "analyses_2024_01.db"]
+    print(f"✅ {sum(archived.values())} analyses moved into 3 monthly partitions, rerun is a no-op")
+
+    assert "ARCH_007" in system.generate_report('sperm', "ARCH_007")
+    assert "LLM archived assessment" in system.generate_enhanced_report('embryo', "ARCH_EMB")
+    ref = system.resolve_analysis("api-arch-emb")
+    assert ref.natural_id == "ARCH_EMB" and ref.partition == "analyses_2024_02.db", ref
+    exported = system.get_analysis_by_id(None, "api-arch-emb")
+    assert exported['cell_count'] == 8 and exported['image_path'] == "/images/arch.png", exported
+    print("✅ Reports, ID resolution and export read archived analyses")
+
+    # Same pages as before archiving, walked with a cursor across live and archived rows
+    seen = []
+    cursor = None
+    while True:
+        page = system.history(HistoryFilters(patient_id="P-ARCH"), cursor=cursor, limit=25,
+                              fields=['analysis_id', 'timestamp', 'data'])
+        seen.extend(page['items'])
+        cursor = page['next_cursor']
+        if not cursor:
+            break
+    assert seen == before and len(seen) == 122, len(seen)
+    february = system.history(HistoryFilters(date_from="2024-02-01", date_to="2024-02-29"), limit=500)['items']
+    assert len(february) == 41 and all(item['timestamp'].startswith("2024-02") for item in february)
+    print("✅ History merges live and archived analyses in order")
+
+    # Interrupted archive run: ARCH_007 is in its partition and still live; history and aggregates count it once
+    partition = next(p for p in system.archive.partitions() if p.name == "analyses_2024_02.db")
+    with system.archive.connection(partition) as part:
+        columns = [row[1] for row in part.execute('PRAGMA table_info(analysis_index)')]
+        entry = part.execute(f"SELECT {', '.join(columns)} FROM analysis_index WHERE public_id = 'ARCH_007'").fetchone()
+    with system.db.connection() as conn:
+        conn.execute(f"INSERT INTO analysis_index ({', '.join(columns)}) VALUES ({', '.join('?' for _ in columns)})", entry)
+    listed = system.history(HistoryFilters(patient_id="P-ARCH"), limit=500)['items']
+    by_type = {group['value']: group['count'] for group in system.aggregate('analysis_type', HistoryFilters(patient_id="P-ARCH"))}
+    assert len(listed) == 122 and by_type == {'sperm': 121, 'embryo': 1}, (len(listed), by_type)
+    print("✅ Analyses left in both places by an interrupted run counted once")
+
+def test_online_backup():
+    """Test stepped online backups under concurrent writes, rotation and the scheduler"""
+    print("\n🧪 Testing online backup...")
+
+    directory = tempfile.mkdtemp(prefix="fertivision_db_")
+    db_path = os.path.join(directory, "analysis.db")
+    backup_dir = os.path.join(directory, "backups")
+    system = ReproductiveClassificationSystem(db_path)
+    system.classify_sperm_batch([{'concentration': 20.0, 'progressive_motility': 40.0, 'normal_morphology': 5.0,
+                                  'sample_id': f"BK_{n}"} for n in range(2000)])
+    # Older backups for rotation
+    os.makedirs(backup_dir)
+    for stamp in ("20240101_000000", "20240102_000000", "20240103_000000"):
+        open(os.path.join(backup_dir, f"analysis_{stamp}.db"), "w").close()
+
+    stop = threading.Event()
+    written = []
+    def writer():
+        while not stop.is_set():
+            system.classify_sperm(concentration=20.0, progressive_motility=40.0, normal_morphology=5.0,
+                                  sample_id=f"BK_LIVE_{len(written)}")
+            written.append(time.time())
+    thread = threading.Thread(target=writer)
+    thread.start()
+    time.sleep(0.05)
+    result = backup_database(db_path, backup_dir, pages_per_step=16, step_pause=0.002, retention=2)
+    stop.set()
+    thread.join()
+
+    assert result.error is None and result.verified and result.pages > 16, result
+    backup = sqlite3.connect(result.path)
+    copied = backup.execute("SELECT COUNT(*) FROM sperm_analyses").fetchone()[0]
+    assert backup.execute("PRAGMA journal_mode").fetchone()[0] == "delete"
+    backup.close()
+    assert 2000 <= copied < 2000 + len(written), (copied, len(written))
+    backups = list_backups(db_path, backup_dir)
+    assert len(backups) == 2 and backups[0] == result.path and backups[1].endswith("20240103_000000.db"), backups
+    print(f"✅ {result.pages} pages backed up in {result.duration}s while {len(written)} analyses were written")
+
+    scheduler = BackupScheduler(db_path, os.path.join(directory, "scheduled"), interval_hours=24, startup_delay=0)
+    scheduler.start()
+    deadline = time.time() + 10
+    while scheduler.last_result is None and time.time() < deadline:
+        time.sleep(0.02)
+    scheduler.stop()
+    status = scheduler.status()
+    assert status['backups'] == 1 and status['last_backup']['verified'], status
+    assert status['next_backup'] > datetime.datetime.now().isoformat()
+    print("✅ Scheduler backs up on start and reports its status")
+
+class RecordingPool:
+    """Stands in for PostgresPool: records the SQL each cursor is given and returns no rows"""
+
+    def __init__(self):
+        self.executed = []
+
+    @contextmanager
+    def connection(self):
+        yield self
+
+    def cursor(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, sql, params=()):
+        self.executed.append((sql, list(params)))
+
+    def fetchall(self):
+        return []
+
+def test_postgres_sql_translation():
+    """Test the qmark -> psycopg2 translation of the shared history SQL"""
+    print("\n🧪 Testing PostgreSQL SQL translation...")
+
+    assert _pg("SELECT ? FROM t WHERE note = 'why?' AND name LIKE 'A%' AND \"col?\" = ?") == \
+        "SELECT %s FROM t WHERE note = 'why?' AND name LIKE 'A%%' AND \"col?\" = %s"
+    assert _pg("SELECT 'it''s ?', ?") == "SELECT 'it''s ?', %s"
+
+    repository = PostgresRepository.__new__(PostgresRepository)
+    repository.db = RecordingPool()
+    filters = HistoryFilters(analysis_type='sperm', classification='Normozoospermia', patient_id='P1',
+                             date_from='2024-01-01', date_to='2024-12-31')
+    repository.history(filters, limit=10)
+    repository.aggregate('classification', filters)
+    assert len(repository.db.executed) == 2
+    for sql, params in repository.db.executed:
+        assert '?' not in sql and sql.count('%s') == len(params) > 0, (sql, params)
+        assert '%' not in sql.replace('%s', '').replace('%%', ''), sql
+    print("✅ History and aggregate SQL translated with matching placeholders")
+
+def check_repository_contract(system, backend):
+    """Store, fetch, resolve, list and aggregate through one storage backend"""
+    run = f"{backend}_{int(time.time() * 1000)}"
+    patient = f"P-{run}"
+    results = system.classify_sperm_batch([{'concentration': 5.0 if n % 4 == 0 else 30.0, 'progressive_motility': 40.0,
+                                            'normal_morphology': 5.0, 'patient_id': patient,
+                                            'sample_id': f"{run}_S{n}"} for n in range(40)])
+    assert all(result.success for result in results)
+    system.classify_embryo(day=3, cell_count=8, fragmentation=5.0, embryo_id=f"{run}_E", patient_id=patient)
+    system._store_image_analysis(f"{run}_E", "embryo", "/images/contract.png", "LLM contract assessment", {},
+                                 alias=f"api-{run}", client="Contract Clinic")
+
+    assert f"{run}_S3" in system.generate_report('sperm', f"{run}_S3")
+    assert "LLM contract assessment" in system.generate_enhanced_report('embryo', f"{run}_E")
+    ref = system.resolve_analysis(f"api-{run}")
+    assert ref.natural_id == f"{run}_E" and ref.analysis_type == "embryo", ref
+    exported = system.get_analysis_by_id(None, f"api-{run}")
+    assert exported['cell_count'] == 8 and exported['image_path'] == "/images/contract.png", exported
+
+    page = system.history(HistoryFilters(patient_id=patient), limit=30, fields=['analysis_id', 'timestamp'])
+    rest = system.history(HistoryFilters(patient_id=patient), cursor=page['next_cursor'], limit=30,
+                          fields=['analysis_id', 'aliases', 'data', 'llm_analysis'])
+    assert len(page['items']) == 30 and len(rest['items']) == 11 and rest['next_cursor'] is None
+    embryo = system.history(HistoryFilters(patient_id=patient, analysis_type='embryo'),
+                            fields=['aliases', 'data', 'llm_analysis'])['items'][0]
+    assert embryo['aliases'] == [f"api-{run}"] and embryo['data']['cell_count'] == 8
+    assert embryo['llm_analysis'] == "LLM contract assessment"
+
+    # A second image analysis of the sample: reports, history and the index all use the latest
+    system._store_image_analysis(f"{run}_E", "embryo", "/images/contract_v2.png", "LLM contract reassessment", {})
+    assert system.storage.fetch_image(f"{run}_E", "embryo") == ("/images/contract_v2.png", "LLM contract reassessment")
+    assert "LLM contract reassessment" in system.generate_enhanced_report('embryo', f"{run}_E")
+    embryo = system.history(HistoryFilters(patient_id=patient, analysis_type='embryo'),
+                            fields=['image_path', 'llm_analysis'])['items'][0]
+    assert embryo == {'image_path': "/images/contract_v2.png", 'llm_analysis': "LLM contract reassessment"}, embryo
+
+    by_type = {group['value']: group['count'] for group in system.aggregate('analysis_type', HistoryFilters(patient_id=patient))}
+    assert by_type == {'sperm': 40, 'embryo': 1}, by_type
+    by_class = system.aggregate('classification', HistoryFilters(patient_id=patient, analysis_type='sperm'))
+    assert [group['count'] for group in by_class] == [30, 10], by_class
+    try:
+        system.aggregate('data')
+        assert False
+    except ValueError:
+        pass
+
+def test_storage_backends():
+    """Test the repository contract on SQLite, and on PostgreSQL when a test server is configured"""
+    print("\n🧪 Testing storage backends...")
+
+    directory = tempfile.mkdtemp(prefix="fertivision_db_")
+    system = EnhancedReproductiveSystem(os.path.join(directory, "analysis.db"),
+                                        upload_folder=os.path.join(directory, "uploads"), mock_mode=True)
+    assert isinstance(system.storage, SQLiteRepository) and system.storage.backend == "sqlite"
+    check_repository_contract(system, "sqlite")
+    print("✅ SQLite repository stores, resolves, lists and aggregates every analysis type")
+
+    postgres_url = os.getenv('FERTIVISION_TEST_POSTGRES_URL')
+    if not postgres_url or not PSYCOPG2_AVAILABLE:
+        print("⏭️ PostgreSQL repository skipped (set FERTIVISION_TEST_POSTGRES_URL and install psycopg2)")
+        return
+    probe = get_repository(postgres_url)
+    assert isinstance(probe, PostgresRepository)
+    probe.close()
+    # Two application nodes, each with its own connection pool
+    nodes = [EnhancedReproductiveSystem(postgres_url, upload_folder=os.path.join(directory, "uploads"), mock_mode=True)
+             for _ in range(2)]
+    check_repository_contract(nodes[0], "postgresql")
+    latest = nodes[0].history(limit=1)['items']
+    assert nodes[1].history(limit=1)['items'] == latest
+    assert nodes[1].resolve_analysis(latest[0]['analysis_id']) is not None
+    for node in nodes:
+        node.storage.close()
+    print("✅ PostgreSQL repository passes the same contract")
+
+if __name__ == "__main__":
+    test_connection_pool()
+    test_concurrent_writers()
+    test_typed_schema_migration()
+    test_batch_classification()
+    test_write_behind()
+    test_write_behind_failed_commit()
+    test_analysis_index()
+    test_llm_blob_store()
+    test_analysis_history()
+    test_archive_tier()
+    test_online_backup()
+    test_storage_backends()
+    test_postgres_sql_translation()
+    print("\n🎉 All database tests passed!")
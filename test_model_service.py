@@ -0,0 +1,1195 @@
+#!/usr/bin/env python3
+"""
+Test script for the FertiVision model service:
+- Concurrent async provider calls
+- Fallback handling
+- Hedged fallback racing
+- Response cache
+- Circuit breaker and recovery probes
+- Encode-once image payloads
+- Streaming with early termination
+- Endpoint request scheduler
+- Provider image profiles
+- In-memory image preprocessing
+- Telemetry and Prometheus metrics
+- Provider adapter registry and per-host connection pools
+
+Runs against a local fake Ollama endpoint, no real model service needed.
+"""
+
+import json
+import time
+import threading
+import asyncio
+import io
+import os
+import base64
+import socket
+import tempfile
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from model_config import (
+    ModelProvider, AnalysisType, ModelConfig, AnalysisConfig, model_manager
+)
+from model_service import ModelServiceManager, fields_captured
+from telemetry import Telemetry, classify_error
+from response_cache import ResponseCache
+from circuit_breaker import CircuitState
+import image_payload
+from image_payload import ImagePayload, ImageProfile
+import image_preprocessing
+from image_preprocessing import preprocess_file, preprocess_payload, PREPROCESS_VERSION
+from preprocess_cache import PreprocessCache
+from batch_preprocessing import BatchPreprocessor
+from follicle_detection import detect_follicles
+from sperm_motility import analyze_motility_video
+from enhanced_reproductive_system import EnhancedReproductiveSystem
+from image_analysis import ImageAnalyzer
+from ultrasound_analysis import UltrasoundAnalyzer
+import cv2
+import numpy as np
+from PIL import Image
+from request_scheduler import EndpointScheduler, SchedulerRegistry, QueueFullError, QueueTimeoutError, endpoint_key
+import provider_adapters
+from provider_adapters import OpenAICompatibleAdapter, ProviderResponseError, register_adapter, get_adapter
+import logging
+
+FOLLICLE_TEXT = "Follicle scan: 1. Antral follicle count: 9 - dominant follicle 16mm, ovarian volume 8ml"
+
+STREAM_LINES = [
+    "FOLLICLE SCAN ANALYSIS REPORT:\n",
+    "- Total visible follicles: 9\n",
+    "- Antral follicle count: 7\n",
+    "- Dominant follicle size: 16mm\n",
+    "- Ovarian volume estimate: 8 ml\n",
+] + [f"- Additional commentary line {i}\n" for i in range(30)]
+
+class FakeOllamaHandler(BaseHTTPRequestHandler):
+    """Minimal /api/generate endpoint with a configurable delay (?delay=seconds)"""
+    delay = 0.3
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        payload = json.loads(self.rfile.read(length) or b"{}")
+        self.server.requests_seen.append(payload)
+        query = parse_qs(urlparse(self.path).query)
+        if payload.get("stream"):
+            return self._stream_ndjson()
+        with self.server.active_lock:
+            self.server.active += 1
+            self.server.peak_active = max(self.server.peak_active, self.server.active)
+        time.sleep(float(query.get('delay', [self.delay])[0]))
+        with self.server.active_lock:
+            self.server.active -= 1
+        body = json.dumps({"response": FOLLICLE_TEXT}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _stream_ndjson(self):
+        """Ollama-style NDJSON stream, one line of the report per chunk"""
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.end_headers()
+        try:
+            for line in STREAM_LINES:
+                self.wfile.write(json.dumps({"response": line, "done": False}).encode() + b"\n")
+                self.wfile.flush()
+                time.sleep(0.03)
+            self.wfile.write(json.dumps({"response": "", "done": True, "prompt_eval_count": 10, "eval_count": 90}).encode() + b"\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def do_GET(self):
+        body = json.dumps({"models": []}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class BrokenBodyHandler(FakeOllamaHandler):
+    """Answers 200 with a proxy error page instead of JSON"""
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        body = b"<html><body>Bad gateway</body></html>"
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def start_fake_ollama(handler=FakeOllamaHandler, port=0):
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.requests_seen = []
+    server.active = 0
+    server.peak_active = 0
+    server.active_lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def ollama_model(server, delay=None, **overrides):
+    url = f"http://127.0.0.1:{server.server_address[1]}/api/generate"
+    if delay is not None:
+        url += f"?delay={delay}"
+    settings = dict(
+        provider=ModelProvider.OLLAMA_LOCAL,
+        model_name="llava:7b",
+        api_url=url,
+        timeout=10
+    )
+    settings.update(overrides)
+    return ModelConfig(**settings)
+
+def make_service(cache_dir=None):
+    """Service manager with a private response cache and schedulers so tests never share state"""
+    cache_dir = cache_dir or tempfile.mkdtemp(prefix="fertivision_cache_")
+    return ModelServiceManager(
+        response_cache=ResponseCache(db_path=os.path.join(cache_dir, "cache.db")),
+        schedulers=SchedulerRegistry(),
+        telemetry=Telemetry()
+    )
+
+class use_analysis_config:
+    """Temporarily install an AnalysisConfig in the global model manager"""
+
+    def __init__(self, config: AnalysisConfig):
+        self.config = config
+
+    def __enter__(self):
+        self.previous = model_manager.configurations.get(self.config.analysis_type)
+        model_manager.configurations[self.config.analysis_type] = self.config
+        return self.config
+
+    def __exit__(self, *exc):
+        if self.previous is not None:
+            model_manager.configurations[self.config.analysis_type] = self.previous
+        else:
+            model_manager.configurations.pop(self.config.analysis_type, None)
+
+def test_concurrent_async_analyses():
+    """Many analyses stay in flight at once on one event loop"""
+    print("⚡ Testing concurrent async analyses...")
+    server = start_fake_ollama()
+    service = make_service()
+    config = AnalysisConfig(
+        analysis_type=AnalysisType.FOLLICLE_ANALYSIS,
+        primary_model=ollama_model(server, max_in_flight=16),
+        fallback_models=[],
+        quality_threshold=0.0
+    )
+
+    async def run_batch(count):
+        return await asyncio.gather(*[
+            service.analyze_with_model_async(AnalysisType.FOLLICLE_ANALYSIS, f"prompt {i}")
+            for i in range(count)
+        ])
+
+    try:
+        with use_analysis_config(config):
+            start = time.time()
+            responses = service.engine.run(run_batch(10))
+            elapsed = time.time() - start
+
+        assert all(r.success for r in responses), [r.error for r in responses]
+        assert all(r.response == FOLLICLE_TEXT for r in responses)
+        # Ten sequential calls would take ~3s
+        assert elapsed < 10 * FakeOllamaHandler.delay / 2, f"Calls were not concurrent: {elapsed:.2f}s"
+        print(f"✅ 10 analyses completed in {elapsed:.2f}s")
+    finally:
+        service.close()
+        server.shutdown()
+
+def test_sync_wrapper_and_fallback():
+    """Blocking API falls back to the next enabled model"""
+    print("🔄 Testing sync wrapper and fallback...")
+    server = start_fake_ollama()
+    service = make_service()
+    dead_primary = ModelConfig(
+        provider=ModelProvider.OLLAMA_LOCAL,
+        model_name="llava:7b",
+        api_url="http://127.0.0.1:9/api/generate",  # Nothing listens on the discard port
+        timeout=2
+    )
+    config = AnalysisConfig(
+        analysis_type=AnalysisType.FOLLICLE_ANALYSIS,
+        primary_model=dead_primary,
+        fallback_models=[ollama_model(server, enabled=False), ollama_model(server, model_name="llava:13b")],
+        quality_threshold=0.5
+    )
+
+    try:
+        with use_analysis_config(config):
+            response = service.analyze_with_model(AnalysisType.FOLLICLE_ANALYSIS, "Count follicles")
+
+        assert response.success, response.error
+        assert response.model_name == "llava:13b"
+        assert response.quality_score is not None and response.quality_score > 0.5
+        assert [r["model"] for r in server.requests_seen] == ["llava:13b"]
+        print(f"✅ Fallback answered with quality {response.quality_score:.2f}")
+    finally:
+        service.close()
+        server.shutdown()
+
+def test_hedged_fallback():
+    """A hanging primary is raced by the fallback and then cancelled"""
+    print("🏁 Testing hedged fallback...")
+    server = start_fake_ollama()
+    service = make_service()
+    config = AnalysisConfig(
+        analysis_type=AnalysisType.FOLLICLE_ANALYSIS,
+        primary_model=ollama_model(server, delay=3, model_name="llava:7b"),
+        fallback_models=[ollama_model(server, delay=0.1, model_name="llava:13b")],
+        quality_threshold=0.5,
+        hedge_requests=True,
+        hedge_delay=0.2
+    )
+
+    try:
+        with use_analysis_config(config):
+            start = time.time()
+            response = service.analyze_with_model(AnalysisType.FOLLICLE_ANALYSIS, "Count follicles")
+            elapsed = time.time() - start
+
+        assert response.success, response.error
+        assert response.model_name == "llava:13b"
+        assert elapsed < 1.5, f"Hedge did not cut latency: {elapsed:.2f}s"
+        by_model = {a['model_name']: a for a in response.attempts}
+        assert by_model["llava:7b"]['cancelled']
+        assert by_model["llava:13b"]['success']
+        print(f"✅ Hedged response in {elapsed:.2f}s, primary cancelled")
+    finally:
+        service.close()
+        server.shutdown()
+
+def test_hedge_delay_percentile():
+    """Hedge delay follows the model's observed latency percentile"""
+    print("📈 Testing hedge delay percentile...")
+    service = make_service()
+    model = ModelConfig(provider=ModelProvider.OLLAMA_LOCAL, model_name="llava:7b", api_url="http://localhost:11434/api/generate")
+    config = AnalysisConfig(
+        analysis_type=AnalysisType.FOLLICLE_ANALYSIS,
+        primary_model=model,
+        fallback_models=[],
+        hedge_percentile=90.0,
+        hedge_delay=12.0
+    )
+    assert service.get_hedge_delay(model, config) == 12.0
+    for latency in range(1, 101):
+        service._record_latency(model, float(latency))
+    assert service.get_hedge_delay(model, config) == 90.0
+    service.close()
+    print("✅ Hedge delay uses latency percentile")
+
+def test_missing_api_key():
+    """Cloud adapters report a missing key without a network call"""
+    print("🔑 Testing missing API key handling...")
+    service = make_service()
+    model = ModelConfig(
+        provider=ModelProvider.GROQ,
+        model_name="llava-v1.5-7b-4096-preview",
+        api_url="https://api.groq.com/openai/v1/chat/completions",
+        api_key=None
+    )
+    try:
+        response = service._call_model(model, "Hello")
+        assert not response.success
+        assert response.error == "Groq API key not provided"
+
+        response = service.engine.run(service._call_model_async(model, "Hello"))
+        assert response.error == "Groq API key not provided"
+        print("✅ Missing API key reported")
+
+        # A half-open trial that fails before reaching the endpoint hands its slot back
+        breaker = service.circuit_breakers.get(model)
+        for _ in range(3):
+            breaker.record_failure(0.1, "HTTP 503")
+        breaker.mark_recovered()
+        config = AnalysisConfig(analysis_type=AnalysisType.FOLLICLE_ANALYSIS, primary_model=model,
+                                fallback_models=[], quality_threshold=0.0)
+        with use_analysis_config(config):
+            for stream in (False, True):
+                if stream:
+                    response = list(service.stream_with_model(AnalysisType.FOLLICLE_ANALYSIS, "Hello"))[-1].response
+                else:
+                    response = service.analyze_with_model(AnalysisType.FOLLICLE_ANALYSIS, f"Hello {stream}")
+                assert response.error == "Groq API key not provided", response.error
+                assert breaker.state == CircuitState.HALF_OPEN and breaker.allow_request()
+                breaker.release_trial()
+        print("✅ Half-open trial released when the call never reached the endpoint")
+    finally:
+        service.close()
+
+def test_response_cache():
+    """Repeat analyses of the same image are served from the cache"""
+    print("💾 Testing response cache...")
+    server = start_fake_ollama()
+    cache_dir = tempfile.mkdtemp(prefix="fertivision_cache_")
+    service = make_service(cache_dir)
+    image_path = os.path.join(cache_dir, "scan.jpg")
+    with open(image_path, "wb") as f:
+        f.write(b"\xff\xd8fake-jpeg-bytes")
+    config = AnalysisConfig(
+        analysis_type=AnalysisType.FOLLICLE_ANALYSIS,
+        primary_model=ollama_model(server),
+        fallback_models=[],
+        quality_threshold=0.5
+    )
+
+    try:
+        with use_analysis_config(config):
+            first = service.analyze_with_model(AnalysisType.FOLLICLE_ANALYSIS, "Count follicles", image_path)
+            second = service.analyze_with_model(AnalysisType.FOLLICLE_ANALYSIS, "Count follicles", image_path)
+            assert first.success and not first.cached
+            assert second.cached and second.response == FOLLICLE_TEXT
+            assert second.processing_time < 0.1
+            assert len(server.requests_seen) == 1
+
+            # Different prompt or bypass flag go to the model
+            service.analyze_with_model(AnalysisType.FOLLICLE_ANALYSIS, "Measure follicles", image_path)
+            bypass = service.analyze_with_model(AnalysisType.FOLLICLE_ANALYSIS, "Count follicles", image_path, use_cache=False)
+            assert not bypass.cached
+            assert len(server.requests_seen) == 3
+
+            # Changed image bytes miss the cache
+            with open(image_path, "wb") as f:
+                f.write(b"\xff\xd8other-jpeg-bytes")
+            assert not service.analyze_with_model(AnalysisType.FOLLICLE_ANALYSIS, "Count follicles", image_path).cached
+
+        stats = service.response_cache.stats()
+        assert stats['memory_hits'] == 1 and stats['misses'] == 3, stats
+        service.close()
+
+        # Disk tier survives a restart
+        service = make_service(cache_dir)
+        with open(image_path, "wb") as f:
+            f.write(b"\xff\xd8fake-jpeg-bytes")
+        with use_analysis_config(config):
+            restored = service.analyze_with_model(AnalysisType.FOLLICLE_ANALYSIS, "Count follicles", image_path)
+        assert restored.cached
+        assert service.response_cache.stats()['disk_hits'] == 1
+        print(f"✅ Cache hit served in {second.processing_time * 1000:.1f}ms")
+    finally:
+        service.close()
+        server.shutdown()
+
+def test_response_cache_eviction():
+    """Cache tiers honour LRU size limits and TTL"""
+    print("🧹 Testing response cache eviction...")
+    cache_dir = tempfile.mkdtemp(prefix="fertivision_cache_")
+    cache = ResponseCache(db_path=os.path.join(cache_dir, "cache.db"), max_memory_entries=2, max_disk_bytes=2000)
+    try:
+        for i in range(20):
+            cache.put(f"key{i}", {'response': "x" * 100})
+        stats = cache.stats()
+        assert stats['memory_entries'] == 2
+        assert stats['disk_bytes'] <= 2000
+        assert cache.get("key19") is not None
+        assert cache.get("key0") is None
+
+        cache.ttl_seconds = 0
+        time.sleep(0.01)
+        assert cache.get("key19") is None
+        assert cache.stats()['expired'] >= 1
+        print("✅ Size and TTL eviction work")
+    finally:
+        cache.close()
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def test_circuit_breaker():
+    """A dead primary is skipped once its circuit opens and rejoins after a probe"""
+    print("🔌 Testing circuit breaker...")
+    fallback_server = start_fake_ollama()
+    primary_port = free_port()
+    primary_server = None
+    service = make_service()
+    service.probe_interval = 0.1
+    primary = ModelConfig(
+        provider=ModelProvider.OLLAMA_LOCAL,
+        model_name="llava:7b",
+        api_url=f"http://127.0.0.1:{primary_port}/api/generate",
+        timeout=2
+    )
+    config = AnalysisConfig(
+        analysis_type=AnalysisType.FOLLICLE_ANALYSIS,
+        primary_model=primary,
+        fallback_models=[ollama_model(fallback_server, delay=0, model_name="llava:13b")],
+        quality_threshold=0.0
+    )
+
+    try:
+        with use_analysis_config(config):
+            for i in range(3):
+                response = service.analyze_with_model(AnalysisType.FOLLICLE_ANALYSIS, f"scan {i}")
+                assert response.model_name == "llava:13b"
+            breaker = service.circuit_breakers.get(primary)
+            assert breaker.state == CircuitState.OPEN
+
+            response = service.analyze_with_model(AnalysisType.FOLLICLE_ANALYSIS, "scan 3")
+            assert response.success and response.model_name == "llava:13b"
+            assert response.attempts[0]['error'].startswith("Circuit open")
+            assert response.attempts[0]['latency'] == 0.0
+
+            # Bring the primary back; the background probe notices
+            primary_server = start_fake_ollama(port=primary_port)
+            deadline = time.time() + 3
+            while breaker.state == CircuitState.OPEN and time.time() < deadline:
+                time.sleep(0.05)
+            assert breaker.state == CircuitState.HALF_OPEN
+
+            response = service.analyze_with_model(AnalysisType.FOLLICLE_ANALYSIS, "scan 4")
+            assert response.model_name == "llava:7b", response.attempts
+            assert breaker.state == CircuitState.CLOSED
+
+        health = service.get_provider_health()
+        assert all(h['state'] == 'closed' for h in health.values())
+        print("✅ Open circuit skipped and recovered via probe")
+    finally:
+        service.close()
+        fallback_server.shutdown()
+        if primary_server:
+            primary_server.shutdown()
+
+    # A 200 whose body cannot be parsed counts against the endpoint, never for it
+    broken_server = start_fake_ollama(handler=BrokenBodyHandler)
+    service = make_service()
+    broken = ollama_model(broken_server, model_name="llava:broken")
+    try:
+        for i in range(3):
+            assert not service._call_model(broken, f"scan {i}").success
+        snapshot = service.circuit_breakers.get(broken).snapshot()
+        assert snapshot['state'] == 'open' and snapshot['failure_rate'] == 1.0, snapshot
+        print("✅ Unparseable answers open the circuit")
+    finally:
+        service.close()
+        broken_server.shutdown()
+
+def test_image_payload():
+    """Image bytes are encoded once and shared across the fallback chain"""
+    print("🖼️ Testing image payload...")
+    png = ImagePayload(b"\x89PNG\r\n\x1a\n" + b"\x00" * 64)
+    assert png.mime_type == "image/png"
+    assert png.data_url().startswith("data:image/png;base64,")
+    dicom = ImagePayload(b"\x00" * 128 + b"DICM" + b"\x00" * 16)
+    assert dicom.mime_type == "application/dicom"
+    assert ImagePayload(b"unknown", source_path="scan.tif").mime_type == "image/tiff"
+
+    server = start_fake_ollama()
+    service = make_service()
+    dead_primary = ModelConfig(
+        provider=ModelProvider.OLLAMA_LOCAL,
+        model_name="llava:7b",
+        api_url="http://127.0.0.1:9/api/generate",
+        timeout=2
+    )
+    config = AnalysisConfig(
+        analysis_type=AnalysisType.FOLLICLE_ANALYSIS,
+        primary_model=dead_primary,
+        fallback_models=[
+            ollama_model(server, delay=0, model_name="llava:13b"),
+            ollama_model(server, delay=0, model_name="llava:34b")
+        ],
+        quality_threshold=0.0
+    )
+
+    encode_calls = []
+    original_encode = image_payload.base64.b64encode
+
+    def counting_encode(data):
+        encode_calls.append(len(data))
+        return original_encode(data)
+
+    image = ImagePayload(b"\xff\xd8\xff" + os.urandom(4096))
+    image_payload.base64.b64encode = counting_encode
+    try:
+        with use_analysis_config(config):
+            response = service.analyze_with_model(AnalysisType.FOLLICLE_ANALYSIS, "Count follicles", image=image)
+        assert response.success and response.model_name == "llava:13b"
+        assert server.requests_seen[0]["images"] == [image.base64]
+        assert len(encode_calls) == 1, encode_calls
+        print("✅ Image encoded once for the whole chain")
+    finally:
+        image_payload.base64.b64encode = original_encode
+        service.close()
+        server.shutdown()
+
+def test_streaming_early_stop():
+    """Streamed chunks arrive incrementally and generation stops once fields are captured"""
+    print("📡 Testing streaming with early termination...")
+    server = start_fake_ollama()
+    service = make_service()
+    config = AnalysisConfig(
+        analysis_type=AnalysisType.FOLLICLE_ANALYSIS,
+        primary_model=ollama_model(server),
+        fallback_models=[],
+        quality_threshold=0.0
+    )
+
+    try:
+        with use_analysis_config(config):
+            # Full stream
+            chunks = list(service.stream_with_model(AnalysisType.FOLLICLE_ANALYSIS, "Report"))
+            final = chunks[-1].response
+            assert chunks[-1].done and final.success
+            assert len(chunks) == len(STREAM_LINES) + 1
+            assert final.response == "".join(STREAM_LINES)
+            assert final.token_count == 100 and not final.stopped_early
+            assert server.requests_seen[-1]["stream"] is True
+
+            # Early stop once the ovarian volume line is complete
+            start = time.time()
+            first_chunk_at = None
+            stop_when = fields_captured(r"total visible follicles[^\n]*\n", r"ovarian volume[^\n]*\n")
+            for chunk in service.stream_with_model(AnalysisType.FOLLICLE_ANALYSIS, "Report again", stop_when=stop_when):
+                if first_chunk_at is None:
+                    first_chunk_at = time.time() - start
+                if chunk.done:
+                    final = chunk.response
+            elapsed = time.time() - start
+
+        assert final.success and final.stopped_early
+        assert final.response == "".join(STREAM_LINES[:5])
+        assert first_chunk_at < 0.5
+        assert elapsed < len(STREAM_LINES) * 0.03 / 2, f"Stream was not cut short: {elapsed:.2f}s"
+        print(f"✅ First chunk after {first_chunk_at:.2f}s, stopped early after {elapsed:.2f}s")
+
+        # Stream cut off by the timeout: a failure, with the text seen so far kept aside
+        cut_off = ollama_model(server, timeout=0.3)
+        with use_analysis_config(AnalysisConfig(analysis_type=AnalysisType.FOLLICLE_ANALYSIS, primary_model=cut_off,
+                                                fallback_models=[], quality_threshold=0.0)):
+            chunks = list(service.stream_with_model(AnalysisType.FOLLICLE_ANALYSIS, "Report slowly"))
+        final = chunks[-1].response
+        assert not final.success and final.error == "Request timeout" and final.response == ""
+        assert final.partial_response == "".join(chunk.text for chunk in chunks[:-1]) != ""
+        breaker = service.circuit_breakers.get(cut_off).snapshot()
+        assert breaker['failure_rate'] > 0 and breaker['last_error'] == "Request timeout", breaker
+        print("✅ Stream cut off midway reported as a failure")
+    finally:
+        service.close()
+        server.shutdown()
+
+def test_sse_stream_parsing():
+    """OpenAI-compatible SSE lines decode to text deltas"""
+    print("🧵 Testing SSE stream parsing...")
+    parse = ModelServiceManager._parse_stream_line
+    assert parse("sse", b'data: {"choices":[{"delta":{"content":"AFC: 7"}}]}\n') == ("AFC: 7", False, None)
+    assert parse("sse", b'data: {"choices":[],"usage":{"total_tokens":42}}\n') == ("", False, 42)
+    assert parse("sse", b"data: [DONE]\n") == ("", True, None)
+    assert parse("sse", b": keep-alive\n") == ("", False, None)
+    assert parse("ndjson", b'{"response":"","done":true,"prompt_eval_count":3,"eval_count":4}') == ("", True, 7)
+    print("✅ SSE and NDJSON lines parsed")
+
+def test_endpoint_scheduler():
+    """Slots are bounded, waiters are served by priority, overload is rejected"""
+    print("🚦 Testing endpoint scheduler...")
+    scheduler = EndpointScheduler("http://127.0.0.1:11434", max_in_flight=1, max_queue=2, queue_timeout=2)
+    order = []
+
+    def worker(name, priority):
+        with scheduler.slot(priority):
+            order.append(name)
+            time.sleep(0.05)
+
+    scheduler.acquire()  # Hold the only slot while waiters queue up
+    threads = [threading.Thread(target=worker, args=("low", 0)), threading.Thread(target=worker, args=("high", 5))]
+    threads[0].start()
+    time.sleep(0.05)
+    threads[1].start()
+    time.sleep(0.05)
+
+    try:
+        scheduler.acquire(timeout=0.1)
+        assert False, "Expected a queue-full error"
+    except QueueFullError:
+        pass
+
+    scheduler.release()
+    for thread in threads:
+        thread.join()
+    assert order == ["high", "low"], order
+
+    scheduler.acquire()
+    try:
+        scheduler.acquire(timeout=0.1)
+        assert False, "Expected a queue timeout"
+    except QueueTimeoutError:
+        pass
+
+    async def timed_out_async():
+        try:
+            await scheduler.acquire_async(timeout=0.1)
+            return False
+        except QueueTimeoutError:
+            return True
+
+    assert asyncio.run(timed_out_async())
+    scheduler.release()
+
+    metrics = scheduler.metrics()
+    assert metrics['in_flight'] == 0 and metrics['queue_depth'] == 0
+    assert metrics['rejected'] == 1 and metrics['timed_out'] == 2
+    assert metrics['max_queue_depth'] == 2
+    print(f"✅ Priority order {order}, avg wait {metrics['avg_wait']:.2f}s")
+
+    # Models sharing a host get the strictest limits, whichever asks first
+    for calls in ([("a", 4, 16), ("b", 2, 8)], [("b", 2, 8), ("a", 4, 16)]):
+        registry = SchedulerRegistry()
+        for n, (model, limit, queue_size) in enumerate(calls * 2):
+            shared = registry.get(f"http://127.0.0.1:11434/api/{'generate' if n % 2 else 'chat'}", limit,
+                                  max_queue=queue_size, model=model)
+        assert (shared.max_in_flight, shared.max_queue) == (2, 8), calls
+
+    # Raising a model's limit takes effect, and admits requests already waiting
+    shared.acquire()
+    shared.acquire()
+    waiter = threading.Thread(target=lambda: (shared.acquire(timeout=2), shared.release()))
+    waiter.start()
+    time.sleep(0.05)
+    assert shared.metrics()['queue_depth'] == 1
+    assert registry.get("http://127.0.0.1:11434/api/chat", 6, max_queue=16, model="b").max_in_flight == 4
+    waiter.join(1)
+    assert not waiter.is_alive()
+    shared.release()
+    shared.release()
+
+    # A model gone from the configuration stops throttling the host
+    registry = SchedulerRegistry(stale_after=0.05)
+    registry.get("http://127.0.0.1:11434/api/chat", 1, model="removed")
+    time.sleep(0.1)
+    assert registry.get("http://127.0.0.1:11434/api/chat", 3, model="current").max_in_flight == 3
+    print("✅ Shared host limits follow the models currently using the host")
+
+def test_scheduled_ollama_calls():
+    """Concurrent analyses never exceed the endpoint's in-flight limit"""
+    print("🧮 Testing scheduled Ollama calls...")
+    server = start_fake_ollama()
+    service = make_service()
+    config = AnalysisConfig(
+        analysis_type=AnalysisType.FOLLICLE_ANALYSIS,
+        primary_model=ollama_model(server, delay=0.1, max_in_flight=2, max_queue=3),
+        fallback_models=[],
+        quality_threshold=0.0
+    )
+
+    async def run_batch(count):
+        return await asyncio.gather(*[
+            service.analyze_with_model_async(AnalysisType.FOLLICLE_ANALYSIS, f"prompt {i}")
+            for i in range(count)
+        ])
+
+    try:
+        with use_analysis_config(config):
+            responses = service.engine.run(run_batch(7))
+
+        assert server.peak_active == 2, server.peak_active
+        succeeded = [r for r in responses if r.success]
+        rejected = [r for r in responses if not r.success]
+        assert len(succeeded) == 5 and len(rejected) == 2
+        assert all(r.error.startswith("Queue full") for r in rejected)
+
+        metrics = list(service.get_scheduler_metrics().values())[0]
+        assert metrics['max_queue_depth'] == 3 and metrics['rejected'] == 2
+        assert metrics['in_flight'] == 0
+        print(f"✅ Peak concurrency {server.peak_active}, {len(rejected)} requests shed")
+    finally:
+        service.close()
+        server.shutdown()
+
+def test_provider_image_profiles():
+    """Large TIFFs are downscaled and recompressed once per provider profile"""
+    print("📐 Testing provider image profiles...")
+    pixels = (np.random.default_rng(7).random((1500, 2000)) * 4000).astype(np.uint16)
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, format="TIFF")
+    tiff = ImagePayload(buffer.getvalue())
+    assert tiff.mime_type == "image/tiff"
+
+    profile = ImageProfile(max_edge=1000, format="jpeg", quality=85)
+    small = tiff.transcode(profile)
+    assert small.mime_type == "image/jpeg"
+    assert max(Image.open(io.BytesIO(small.data)).size) == 1000
+    assert len(small) * 5 < len(tiff), (len(small), len(tiff))
+    assert tiff.transcode(profile) is small
+    assert ImagePayload(buffer.getvalue()).transcode(profile) is small  # Shared per image hash
+
+    buffer = io.BytesIO()
+    Image.new("RGB", (64, 48)).save(buffer, format="PNG")
+    png = ImagePayload(buffer.getvalue())
+    assert png.transcode(ImageProfile(max_edge=1000, format="original")) is png
+    assert ImagePayload(b"\x00" * 128 + b"DICM").transcode(profile).mime_type == "application/dicom"
+
+    server = start_fake_ollama()
+    service = make_service()
+    config = AnalysisConfig(
+        analysis_type=AnalysisType.FOLLICLE_ANALYSIS,
+        primary_model=ollama_model(server, delay=0, image_max_edge=800),
+        fallback_models=[],
+        quality_threshold=0.0
+    )
+    try:
+        with use_analysis_config(config):
+            response = service.analyze_with_model(AnalysisType.FOLLICLE_ANALYSIS, "Count follicles", image=tiff)
+        assert response.success
+        sent = Image.open(io.BytesIO(base64.b64decode(server.requests_seen[0]["images"][0])))
+        assert sent.format == "JPEG" and max(sent.size) == 800
+        print(f"✅ {len(tiff) // 1024}KB TIFF sent as {len(small) // 1024}KB JPEG")
+    finally:
+        service.close()
+        server.shutdown()
+
+def test_image_preprocessing():
+    """Uploads are enhanced in memory; nothing is written next to them"""
+    print("🧪 Testing in-memory preprocessing...")
+    upload_dir = tempfile.mkdtemp(prefix="fertivision_uploads_")
+    path = os.path.join(upload_dir, "sample.v2.png")
+    pixels = (np.random.default_rng(3).random((120, 160, 3)) * 80 + 60).astype(np.uint8)
+    Image.fromarray(pixels).save(path, format="PNG")
+
+    shared_cache = image_preprocessing.preprocess_cache
+    image_preprocessing.preprocess_cache = PreprocessCache(cache_dir=None)
+    try:
+        sperm = ImageAnalyzer(mock_mode=True).preprocess_image(path, "sperm")
+        follicle = UltrasoundAnalyzer(mock_mode=True).preprocess_ultrasound_image(path, "follicle")
+    finally:
+        image_preprocessing.preprocess_cache = shared_cache
+    assert sperm.mime_type == follicle.mime_type == "image/png" and sperm.source_path == path
+    enhanced = np.asarray(Image.open(io.BytesIO(follicle.data)))
+    assert enhanced.shape == (120, 160, 3) and (enhanced[..., 0] == enhanced[..., 2]).all()
+    assert np.ptp(enhanced) > np.ptp(pixels.mean(axis=2))  # CLAHE stretched the contrast
+    assert os.listdir(upload_dir) == ["sample.v2.png"]
+
+    cache = PreprocessCache(cache_dir=None)
+    original = ImagePayload.from_file(path)
+    assert preprocess_payload(original, "unknown", cache=cache) is original
+    dicom = ImagePayload(b"\x00" * 128 + b"DICM" + b"\x00" * 16)
+    assert preprocess_payload(dicom, "embryo", cache=cache) is dicom
+
+    debug_dir = os.path.join(upload_dir, "debug")
+    preprocess_file(path, "embryo", debug_dir=debug_dir, cache=cache)
+    assert os.listdir(debug_dir) == ["sample.v2_embryo_processed.png"]
+    print("✅ Images enhanced in memory, debug copies only on request")
+
+def test_preprocess_cache():
+    """Preprocessed variants are reused from memory, then from disk"""
+    print("🗂️ Testing preprocessed image cache...")
+    work_dir = tempfile.mkdtemp(prefix="fertivision_preprocess_")
+    path = os.path.join(work_dir, "embryo.png")
+    pixels = (np.random.default_rng(5).random((96, 128, 3)) * 255).astype(np.uint8)
+    Image.fromarray(pixels).save(path, format="PNG")
+    cache_dir = os.path.join(work_dir, "cache")
+
+    cache = PreprocessCache(cache_dir=cache_dir)
+    first = preprocess_file(path, "embryo", cache=cache)
+    again = preprocess_file(path, "embryo", cache=cache)
+    assert again.data is first.data and again.source_path == path
+    assert cache.stats()['misses'] == 1 and cache.stats()['memory_hits'] == 1
+
+    # A hit never runs the enhancement
+    enhance = image_preprocessing.ENHANCERS['embryo']
+    def fail(image):
+        raise AssertionError("enhancement ran on a cache hit")
+    image_preprocessing.ENHANCERS['embryo'] = fail
+    try:
+        restarted = PreprocessCache(cache_dir=cache_dir)
+        from_disk = preprocess_file(path, "embryo", cache=restarted)
+        assert from_disk.data == first.data and from_disk.mime_type == "image/png"
+        assert restarted.stats()['disk_hits'] == 1
+    finally:
+        image_preprocessing.ENHANCERS['embryo'] = enhance
+
+    # Other kinds and versions are separate entries
+    sperm = preprocess_file(path, "sperm", cache=cache)
+    assert sperm.data != first.data
+    source = ImagePayload.from_file(path).sha256
+    assert cache.get(PreprocessCache.make_key(source, "embryo", PREPROCESS_VERSION + 1)) is None
+
+    # Disk tier stays within its byte budget, least recently used first
+    small = PreprocessCache(cache_dir=os.path.join(work_dir, "small"), max_disk_bytes=len(first) * 2)
+    keys = [PreprocessCache.make_key(f"source{i}", "embryo", PREPROCESS_VERSION) for i in range(4)]
+    for key in keys:
+        small.put(key, first)
+        time.sleep(0.01)
+    assert small.stats()['evictions'] >= 2 and small.stats()['disk_bytes'] <= len(first) * 2
+    fresh = PreprocessCache(cache_dir=small.cache_dir)
+    assert fresh.get(keys[-1]) is not None and fresh.get(keys[0]) is None
+    print("✅ Cache hits skip preprocessing, disk tier bounded")
+
+def test_batch_preprocessing():
+    """Batches run on the process pool and match one-at-a-time preprocessing"""
+    print("🏭 Testing batch preprocessing...")
+    work_dir = tempfile.mkdtemp(prefix="fertivision_batch_")
+    paths = []
+    for i in range(4):
+        path = os.path.join(work_dir, f"scan_{i}.png")
+        pixels = (np.random.default_rng(10 + i).random((80, 100, 3)) * 255).astype(np.uint8)
+        Image.fromarray(pixels).save(path, format="PNG")
+        paths.append(path)
+    broken = os.path.join(work_dir, "broken.png")
+    with open(broken, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n" + b"\x00" * 32)
+    batch = paths + [broken, paths[1]]
+    shared_memory_before = set(os.listdir("/dev/shm")) if os.path.isdir("/dev/shm") else set()
+
+    cache = PreprocessCache(cache_dir=None)
+    preprocessor = BatchPreprocessor(workers=2, cache=cache, debug_dir=None)
+    # Forks only while single-threaded (earlier tests may have left daemon threads)
+    single_threaded = threading.active_count() == 1
+    assert preprocessor.start() == single_threaded
+    try:
+        results = preprocessor.preprocess_many(batch, "follicle")
+        expected = [preprocess_file(path, "follicle", debug_dir=None, cache=PreprocessCache(cache_dir=None))
+                    for path in batch]
+        assert [r.source_path for r in results] == batch
+        assert [r.data for r in results] == [e.data for e in expected]
+        assert results[4].data == ImagePayload.from_file(broken).data  # Undecodable: original sent
+        assert cache.stats()['stores'] == 4  # Duplicate processed once
+
+        again = preprocessor.preprocess_many(paths, "follicle")
+        assert cache.stats()['memory_hits'] == 4 and [r.data for r in again] == [r.data for r in results[:4]]
+        unknown = ImageAnalyzer(mock_mode=True).preprocess_many(paths[:2], "semen_video")
+        assert [r.data for r in unknown] == [ImagePayload.from_file(p).data for p in paths[:2]]
+    finally:
+        preprocessor.close()
+
+    # Never forks once another thread is running: the batch is processed in-process
+    stop = threading.Event()
+    thread = threading.Thread(target=stop.wait)
+    thread.start()
+    late = BatchPreprocessor(workers=2, cache=PreprocessCache(cache_dir=None), debug_dir=None)
+    try:
+        assert not late.start()
+        assert [r.data for r in late.preprocess_many(batch, "follicle")] == [e.data for e in expected]
+    finally:
+        stop.set()
+        thread.join()
+        late.close()
+    if os.path.isdir("/dev/shm"):
+        assert set(os.listdir("/dev/shm")) <= shared_memory_before  # Every block unlinked
+    print("✅ Batch preprocessing ordered, deduplicated and cached")
+
+def synthetic_follicle_scan(path, follicles, mm_per_pixel=0.1, seed=1):
+    """Speckled sector scan with anechoic follicles of known diameters (mm) at pixel centers"""
+    rng = np.random.default_rng(seed)
+    sector = np.zeros((600, 800), np.uint8)
+    cv2.ellipse(sector, (400, 20), (560, 560), 0, 50, 130, 255, -1)
+    scan = np.zeros_like(sector)
+    tissue = np.clip(rng.rayleigh(60, sector.shape) + 40, 0, 255).astype(np.uint8)
+    scan[sector > 0] = tissue[sector > 0]
+    for (x, y), diameter in follicles:
+        radius = diameter / 2 / mm_per_pixel
+        mask = np.zeros_like(sector)
+        cv2.ellipse(mask, (x, y), (int(radius * 1.1), int(radius * 0.9)), 30, 0, 360, 255, -1)
+        fluid = np.clip(rng.rayleigh(6, sector.shape) + 5, 0, 255).astype(np.uint8)
+        scan[mask > 0] = fluid[mask > 0]
+    cv2.imwrite(path, scan)
+    return path
+
+def test_follicle_detector():
+    """Follicles are measured locally; the vision model only sees uncertain scans"""
+    print("🔬 Testing classical follicle detector...")
+    work_dir = tempfile.mkdtemp(prefix="fertivision_follicles_")
+    truth = [((300, 250), 18.0), ((600, 300), 8.0), ((520, 260), 5.0), ((360, 420), 12.0), ((560, 380), 6.5)]
+    scan = synthetic_follicle_scan(os.path.join(work_dir, "monitoring.png"), truth)
+
+    detection = detect_follicles(ImagePayload.from_file(scan), mm_per_pixel=0.1)
+    assert detection.total_follicle_count == 5 and detection.confidence >= 0.9, detection
+    for measured, (_, expected) in zip(detection.follicle_sizes, sorted(truth, key=lambda f: -f[1])):
+        assert abs(measured - expected) <= max(1.0, expected * 0.1), (measured, expected)
+    assert detection.antral_follicle_count == 3 and detection.dominant_follicle_size == detection.follicle_sizes[0]
+    assert detection.processing_time < 0.5
+    uncalibrated = detect_follicles(ImagePayload.from_file(scan))
+    assert uncalibrated.confidence == 0.0 and uncalibrated.calibration_source == "none"
+    assert detect_follicles(ImagePayload.from_file(scan), default_mm_per_pixel=0.1).calibration_source == "config"
+    touching = synthetic_follicle_scan(os.path.join(work_dir, "touching.png"),
+                                       [((300, 250), 10.0), ((395, 250), 10.0), ((500, 380), 8.0)])
+    assert detect_follicles(ImagePayload.from_file(touching), mm_per_pixel=0.1).confidence < 0.6
+
+    analyzer = UltrasoundAnalyzer(mock_mode=False, follicle_mode="fast", mm_per_pixel=0.1)
+    calls = []
+    def fake_llm(prompt, image, analysis_type="vision", stop_when=None):
+        calls.append(analysis_type)
+        return {"success": True, "analysis": "Total visible follicles: 2\nAntral follicle count: 2\n"
+                                             "Dominant follicle: 9mm\nStromal echogenicity: increased\n"}
+    analyzer._query_deepseek = fake_llm
+
+    fast = analyzer.analyze_follicle_scan(scan)
+    assert not calls and fast.total_follicle_count == 5 and fast.antral_follicle_count == 3
+    assert fast.follicle_sizes == detection.follicle_sizes and "follicle detector" in fast.notes
+    narrated = analyzer.analyze_follicle_scan(scan, narrative=True)
+    assert calls == ["follicle"] and narrated.total_follicle_count == 5
+    assert narrated.stromal_echogenicity == "increased"
+    uncertain = analyzer.analyze_follicle_scan(touching)
+    assert calls == ["follicle", "follicle"] and uncertain.total_follicle_count == 2
+    print("✅ Monitoring scans measured locally, uncertain ones sent to the model")
+
+def synthetic_motility_video(path, seconds=3.0, fps=30, counts=(24, 12, 24), microns_per_pixel=0.5, seed=0):
+    """Bright heads: straight swimmers at 50 µm/s, circling ones and immotile ones, in that proportion"""
+    rng = np.random.default_rng(seed)
+    width, height = 640, 480
+    sperm = [dict(kind=kind, x=rng.uniform(20, width - 20), y=rng.uniform(20, height - 20),
+                  angle=rng.uniform(0, 2 * np.pi), phase=rng.uniform(0, 2 * np.pi))
+             for kind, count in zip(("progressive", "circling", "immotile"), counts) for _ in range(count)]
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"MJPG"), fps, (width, height), False)
+    step = 50 / microns_per_pixel / fps
+    for frame in range(int(seconds * fps)):
+        image = np.clip(rng.normal(120, 6, (height, width)), 0, 255).astype(np.uint8)
+        t = frame / fps
+        for s in sperm:
+            if s["kind"] == "progressive":
+                s["x"] = (s["x"] + step * np.cos(s["angle"])) % width
+                s["y"] = (s["y"] + step * np.sin(s["angle"])) % height
+                x, y = s["x"], s["y"]
+            elif s["kind"] == "circling":
+                x = s["x"] + 10 * np.cos(2 * np.pi * t + s["phase"])
+                y = s["y"] + 10 * np.sin(2 * np.pi * t + s["phase"])
+            else:
+                x, y = s["x"] + rng.normal(0, 0.3), s["y"] + rng.normal(0, 0.3)
+            cv2.ellipse(image, (int(round(x)), int(round(y))), (4, 3), np.degrees(s["angle"]), 0, 360, 200, -1)
+        writer.write(image)
+    writer.release()
+    return path
+
+def test_sperm_motility_video():
+    """Motility videos are tracked and graded locally, faster than real time"""
+    print("🎞️ Testing sperm motility video analysis...")
+    work_dir = tempfile.mkdtemp(prefix="fertivision_motility_")
+    video = synthetic_motility_video(os.path.join(work_dir, "sample.avi"))
+
+    result = analyze_motility_video(video, microns_per_pixel=0.5)
+    assert result.frames_analyzed == 90 and result.processing_time < result.duration, result
+    assert abs(result.progressive_motility - 40) <= 10, result
+    assert abs(result.non_progressive_motility - 20) <= 10, result
+    assert abs(result.immotile - 40) <= 10, result
+    # 60 heads in 320 x 240 µm x 20 µm deep: 39 million/ml
+    assert abs(result.concentration - 39.1) <= 39.1 * 0.15, result
+    assert result.mean_vsl <= result.mean_vap <= result.mean_vcl and 30 <= result.mean_vap <= 55
+    try:
+        analyze_motility_video(video, microns_per_pixel=None)
+        assert False, "calibration is required"
+    except ValueError:
+        pass
+
+    system = EnhancedReproductiveSystem(os.path.join(work_dir, "analysis.db"), upload_folder=os.path.join(work_dir, "uploads"),
+                                        mock_mode=True, sperm_video_microns_per_pixel=0.5)
+    try:
+        sample = system.analyze_sperm_with_image(video, patient_id="P-7")
+        assert sample.progressive_motility == result.progressive_motility
+        assert sample.concentration == result.concentration and sample.normal_morphology == 78.0
+        assert sample.image_path == video and "CASA" in sample.image_analysis
+        measured = system.analyze_sperm_with_image(video, normal_morphology="3", microns_per_pixel="0.5")
+        assert measured.normal_morphology == 3.0 and "Teratozoospermia" in measured.classification
+    finally:
+        system.storage.close()
+    print("✅ Motility graded from video, results fed to WHO classification")
+
+def test_telemetry_metrics():
+    """Attempts are aggregated per provider/model/analysis type and exported"""
+    print("📊 Testing telemetry...")
+    assert classify_error("Request timeout") == "timeout"
+    assert classify_error("HTTP 429: slow down") == "rate_limited"
+    assert classify_error("HTTP 503: overloaded") == "http_5xx"
+    assert classify_error("Groq API key not provided") == "missing_api_key"
+    assert classify_error("Circuit open for ollama_local at http://x") == "circuit_open"
+    assert classify_error("Cannot connect to host 127.0.0.1:9") == "connection"
+
+    server = start_fake_ollama()
+    service = make_service()
+    dead_primary = ModelConfig(
+        provider=ModelProvider.OLLAMA_LOCAL,
+        model_name="llava:7b",
+        api_url="http://127.0.0.1:9/api/generate",
+        timeout=2
+    )
+    config = AnalysisConfig(
+        analysis_type=AnalysisType.FOLLICLE_ANALYSIS,
+        primary_model=dead_primary,
+        fallback_models=[ollama_model(server, delay=0.05, model_name="llava:13b", cost_per_1k_tokens=0.5)],
+        quality_threshold=0.5
+    )
+
+    try:
+        with use_analysis_config(config):
+            for i in range(2):
+                service.analyze_with_model(AnalysisType.FOLLICLE_ANALYSIS, f"Count follicles {i}")
+            service.analyze_with_model(AnalysisType.FOLLICLE_ANALYSIS, "Count follicles 0")  # Cache hit
+
+        summary = service.get_metrics_summary()
+        series = {s['model']: s for s in summary['series']}
+        assert series['llava:7b']['requests']['error'] == 2
+        assert series['llava:7b']['errors'] == {'connection': 2}, series['llava:7b']['errors']
+        fallback = series['llava:13b']
+        assert fallback['requests']['success'] == 2 and fallback['requests']['cached'] == 1
+        assert fallback['latency']['p50'] >= 0.05 and fallback['latency']['p99'] is not None
+        assert fallback['avg_quality'] > 0.5
+        assert summary['response_cache']['memory_hits'] == 1
+
+        text = service.render_metrics()
+        labels = 'provider="ollama_local",model="llava:13b",analysis_type="follicle_analysis"'
+        assert f'fertivision_model_requests_total{{{labels},outcome="success"}} 2' in text
+        assert f'fertivision_model_latency_seconds_count{{{labels}}} 2' in text
+        assert f'fertivision_model_latency_seconds_bucket{{{labels},le="+Inf"}} 2' in text
+        assert 'cause="connection"} 2' in text
+        assert 'fertivision_response_cache_lookups_total{result="memory_hit"} 1' in text
+        assert 'fertivision_endpoint_queue_depth' in text
+        print(f"✅ Metrics exported ({len(text.splitlines())} lines)")
+    finally:
+        service.close()
+        server.shutdown()
+
+    # A closed manager stops contributing to the shared registry
+    shared = Telemetry()
+    cache_dir = tempfile.mkdtemp(prefix="fertivision_cache_")
+    closed = ModelServiceManager(response_cache=ResponseCache(db_path=os.path.join(cache_dir, "cache.db")),
+                                 schedulers=SchedulerRegistry(), telemetry=shared)
+    assert 'fertivision_response_cache_lookups_total' in shared.render_prometheus()
+    closed.close()
+    assert 'fertivision_response_cache_lookups_total' not in shared.render_prometheus()
+    print("✅ Collector unregistered on close")
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    """OpenAI-compatible /v1/chat/completions endpoint with keep-alive"""
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        payload = json.loads(self.rfile.read(length) or b"{}")
+        self.server.requests_seen.append((dict(self.headers), payload))
+        time.sleep(0.05)
+        body = json.dumps({
+            "choices": [{"message": {"content": FOLLICLE_TEXT}}],
+            "usage": {"total_tokens": 120}
+        }).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class _PoolWarnings(logging.Handler):
+    def __init__(self):
+        super().__init__(logging.WARNING)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+def test_provider_adapters():
+    """Test table-driven provider dispatch and per-host connection pools"""
+    print("\n🧪 Testing provider adapters and host pools...")
+
+    server = start_fake_ollama(FakeOpenAIHandler)
+    service = make_service()
+    url = f"http://127.0.0.1:{server.server_address[1]}/v1/chat/completions"
+    pool_warnings = _PoolWarnings()
+    logging.getLogger("urllib3").addHandler(pool_warnings)
+    try:
+        # CUSTOM_API goes through the OpenAI-compatible adapter, key optional
+        model = ModelConfig(
+            provider=ModelProvider.CUSTOM_API,
+            model_name="local-vision",
+            api_url=url,
+            api_key="test-key",
+            cost_per_1k_tokens=0.5,
+            max_in_flight=24,
+            timeout=10
+        )
+        image = ImagePayload(b"\x89PNG\r\n\x1a\n" + b"\x00" * 64)
+        response = service._call_model(model, "Describe", image=image)
+        assert response.success, response.error
+        assert response.token_count == 120 and abs(response.cost - 0.06) < 1e-9
+        headers, payload = server.requests_seen[-1]
+        assert headers["Authorization"] == "Bearer test-key"
+        assert payload["messages"][0]["content"][1]["type"] == "image_url"
+        print("✅ CUSTOM_API dispatched through the OpenAI-compatible adapter")
+
+        # Many threads on one host share a pool sized to its concurrency
+        threads = [threading.Thread(target=service._call_model, args=(model, "Hello")) for _ in range(24)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert service.host_sessions.pool_sizes()[endpoint_key(url)] == 24
+        assert service.engine.run(service._call_model_async(model, "Hello")).success
+        assert service.engine.pool_sizes()[endpoint_key(url)] == 24
+        assert not [m for m in pool_warnings.messages if "pool is full" in m.lower()], pool_warnings.messages
+        print("✅ One keep-alive pool per host, no discarded connections")
+
+        # Text-only adapters drop the image; providers without an adapter are reported
+        deepseek = ModelConfig(provider=ModelProvider.DEEPSEEK, model_name="deepseek-chat", api_url=url, api_key="k")
+        assert service._call_model(deepseek, "Describe", image=image).success
+        assert isinstance(server.requests_seen[-1][1]["messages"][0]["content"], str)
+        unknown = ModelConfig(provider=ModelProvider.REPLICATE, model_name="x", api_url=url)
+        assert "not implemented" in service._call_model(unknown, "Hello").error
+
+        # New providers only need a registry entry
+        previous = get_adapter(ModelProvider.MEDICAL_API)
+        register_adapter(ModelProvider.MEDICAL_API, OpenAICompatibleAdapter("Medical API"))
+        try:
+            medical = ModelConfig(provider=ModelProvider.MEDICAL_API, model_name="med", api_url=url)
+            assert service._call_model(medical, "Hello").error == "Medical API API key not provided"
+            medical.api_key = "k"
+            assert service._call_model(medical, "Hello").success
+        finally:
+            provider_adapters._adapters.pop(ModelProvider.MEDICAL_API, None)
+            if previous is not None:
+                register_adapter(ModelProvider.MEDICAL_API, previous)
+        print("✅ Registered adapters route new providers without code changes")
+
+        # 200 answers without content raise ProviderResponseError with a readable message
+        malformed = [
+            (ModelProvider.OPENAI, {"error": "overloaded"}, "choices"),
+            (ModelProvider.OPENAI, {"choices": []}, "No message content"),
+            (ModelProvider.ANTHROPIC, {"content": []}, "No text content"),
+            (ModelProvider.GOOGLE, {"candidates": [{"finishReason": "SAFETY"}]}, "SAFETY"),
+            (ModelProvider.OLLAMA_LOCAL, ["not", "an", "object"], "Unexpected Ollama response"),
+        ]
+        for provider, body, expected in malformed:
+            try:
+                get_adapter(provider).parse_response(body)
+                assert False, provider
+            except ProviderResponseError as e:
+                assert expected in str(e), (provider, str(e))
+        print("✅ Malformed provider answers reported as response errors")
+    finally:
+        logging.getLogger("urllib3").removeHandler(pool_warnings)
+        service.close()
+        server.shutdown()
+
+if __name__ == "__main__":
+    test_concurrent_async_analyses()
+    test_sync_wrapper_and_fallback()
+    test_hedged_fallback()
+    test_hedge_delay_percentile()
+    test_missing_api_key()
+    test_response_cache()
+    test_response_cache_eviction()
+    test_circuit_breaker()
+    test_image_payload()
+    test_streaming_early_stop()
+    test_sse_stream_parsing()
+    test_endpoint_scheduler()
+    test_scheduled_ollama_calls()
+    test_provider_image_profiles()
+    test_image_preprocessing()
+    test_preprocess_cache()
+    test_batch_preprocessing()
+    test_follicle_detector()
+    test_sperm_motility_video()
+    test_telemetry_metrics()
+    test_provider_adapters()
+    print("\n🎉 All model service tests passed!")
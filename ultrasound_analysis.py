@@ -7,19 +7,34 @@ import io
 from typing import Dict, List, Optional, Tuple
 import cv2
 import numpy as np
+from image_payload import ImagePayload
+from image_preprocessing import preprocess_file
+from batch_preprocessing import preprocess_many
+from follicle_detection import FollicleDetection, detect_follicles, MIN_CONFIDENCE
+from request_scheduler import scheduler_registry, SchedulerError
 import datetime
 from dataclasses import dataclass, asdict
 from enum import Enum
 
 # Import new model service
 try:
-    from model_service import service_manager
+    from model_service import service_manager, fields_captured
     from model_config import AnalysisType
     MODEL_SERVICE_AVAILABLE = True
 except ImportError:
     MODEL_SERVICE_AVAILABLE = False
     print("⚠️ Model service not available, using legacy mode")
 
+# Report lines the follicle parser reads; a streamed report can stop once all are complete
+FOLLICLE_REQUIRED_FIELDS = [
+    r"total visible follicles[^\n\d]*\d[^\n]*\n",
+    r"antral follicle count[^\n\d]*\d[^\n]*\n",
+    r"dominant follicle[^\n\d]*\d[^\n]*\n",
+    r"ovarian volume[^\n\d]*\d[^\n]*\n",
+    r"stromal echogenicity[:\s]*\w+[^\n]*\n",
+    r"blood flow[:\s]*\w+[^\n]*\n",
+]
+
 class FollicleStage(Enum):
     PRIMORDIAL = "primordial"
     PRIMARY = "primary"
@@ -75,59 +90,53 @@ class HysteroscopyAnalysis:
     timestamp: str
 
 class UltrasoundAnalyzer:
-    def __init__(self, deepseek_api_key: str = None, deepseek_url: str = "http://localhost:11434/api/generate", mock_mode: bool = False):
-        """Initialize ultrasound analyzer with DeepSeek LLM"""
+    def __init__(self, deepseek_api_key: str = None, deepseek_url: str = "http://localhost:11434/api/generate", mock_mode: bool = False, early_stop: bool = False,
+                 follicle_mode: str = "llm", mm_per_pixel: Optional[float] = None, min_cv_confidence: float = MIN_CONFIDENCE):
+        """Initialize ultrasound analyzer with DeepSeek LLM
+
+        Set early_stop=True to stream follicle reports and stop generation once
+        every field the parser needs has been produced.
+
+        Set follicle_mode="fast" to measure follicle scans with OpenCV (see
+        follicle_detection) and return at once; the LLM is only called for a
+        narrative or when the measurement confidence is below
+        min_cv_confidence. mm_per_pixel calibrates scans that carry none.
+        """
         self.deepseek_url = deepseek_url
         self.api_key = deepseek_api_key
         self.mock_mode = mock_mode
+        self.early_stop = early_stop
+        self.follicle_mode = follicle_mode
+        self.mm_per_pixel = mm_per_pixel
+        self.min_cv_confidence = min_cv_confidence
         
     def encode_image_to_base64(self, image_path: str) -> str:
         """Convert image to base64 for LLM processing"""
         with open(image_path, "rb") as image_file:
             return base64.b64encode(image_file.read()).decode('utf-8')
     
-    def preprocess_ultrasound_image(self, image_path: str, scan_type: str) -> str:
-        """Preprocess ultrasound images for better analysis"""
-        try:
-            image = cv2.imread(image_path)
-            if image is None:
-                return image_path
-            
-            if scan_type == "follicle":
-                # Enhance contrast for follicle detection
-                gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-                # Apply CLAHE for better contrast
-                clahe = cv2.createCLAHE(clipLimit=3.0, tileGridSize=(8,8))
-                enhanced = clahe.apply(gray)
-                # Convert back to BGR
-                enhanced = cv2.cvtColor(enhanced, cv2.COLOR_GRAY2BGR)
-                
-            elif scan_type == "hysteroscopy":
-                # Enhance for endometrial structure visibility
-                lab = cv2.cvtColor(image, cv2.COLOR_BGR2LAB)
-                l, a, b = cv2.split(lab)
-                # Apply CLAHE to L channel
-                clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8,8))
-                l = clahe.apply(l)
-                enhanced = cv2.merge([l, a, b])
-                enhanced = cv2.cvtColor(enhanced, cv2.COLOR_LAB2BGR)
-                
-            else:
-                enhanced = image
-            
-            # Save preprocessed image (robust path handling)
-            base, ext = os.path.splitext(image_path)
-            processed_path = f"{base}_processed{ext}"
-            cv2.imwrite(processed_path, enhanced)
-            
-            return processed_path
-        except Exception as e:
-            print(f"Error preprocessing ultrasound image: {e}")
-            return image_path
+    def preprocess_ultrasound_image(self, image_path: str, scan_type: str) -> ImagePayload:
+        """Preprocess ultrasound images for better analysis, in memory (see image_preprocessing)"""
+        return preprocess_file(image_path, scan_type)
 
-    def analyze_follicle_scan(self, image_path: str, ovary_side: str = "bilateral") -> FollicleAnalysis:
-        """Analyze follicle ultrasound scan using LLaVA LLM"""
+    def preprocess_many(self, image_paths: List[str], scan_type: str) -> List[ImagePayload]:
+        """Preprocess a batch of ultrasound images on all cores, in input order (see batch_preprocessing)"""
+        return preprocess_many(image_paths, scan_type)
+
+    def analyze_follicle_scan(self, image_path: str, ovary_side: str = "bilateral",
+                              mm_per_pixel: Optional[float] = None, narrative: bool = False) -> FollicleAnalysis:
+        """Analyze follicle ultrasound scan using LLaVA LLM, or measure it locally in fast mode"""
         try:
+            measured = None
+            if self.follicle_mode == "fast":
+                detection = detect_follicles(ImagePayload.from_file(image_path), mm_per_pixel, self.mm_per_pixel)
+                if detection.confidence >= self.min_cv_confidence:
+                    measured = detection
+                    if not narrative:
+                        return self._follicle_analysis_from_detection(image_path, ovary_side, measured)
+                else:
+                    print(f"🔍 Follicle measurement confidence {detection.confidence:.2f}, asking the vision model")
+
             # Mock mode for testing without LLM service
             if self.mock_mode:
                 scan_id = f"follicle_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}_{os.path.basename(image_path).split('.')[0]}"
@@ -150,8 +159,7 @@ class UltrasoundAnalyzer:
                     timestamp=datetime.datetime.now().isoformat()
                 )
 
-            processed_image = self.preprocess_ultrasound_image(image_path, "follicle")
-            base64_image = self.encode_image_to_base64(processed_image)
+            image = self.preprocess_ultrasound_image(image_path, "follicle")
             
             prompt = f"""
             You are an expert reproductive endocrinologist analyzing an ovarian follicle ultrasound scan for research and educational purposes. This is a training exercise for medical AI systems. Please analyze this {ovary_side} ovarian ultrasound image and provide detailed assessment:
@@ -203,7 +211,8 @@ class UltrasoundAnalyzer:
             """
             
             # Query LLaVA LLM
-            deepseek_result = self._query_deepseek(prompt, base64_image, "follicle")
+            stop_when = fields_captured(*FOLLICLE_REQUIRED_FIELDS) if self.early_stop and MODEL_SERVICE_AVAILABLE else None
+            deepseek_result = self._query_deepseek(prompt, image, "follicle", stop_when=stop_when)
 
             if deepseek_result.get("success"):
                 # Parse the AI analysis text and create FollicleAnalysis object
@@ -216,17 +225,16 @@ class UltrasoundAnalyzer:
                 afc_count = self._extract_number_from_text(ai_analysis, "antral follicle count", 6)
                 dominant_size = self._extract_number_from_text(ai_analysis, "dominant follicle", 14.0)
                 ovarian_volume = self._extract_number_from_text(ai_analysis, "ovarian volume", 7.5)
-                
-                # Determine classification based on AFC
-                if afc_count < 6:
-                    classification = "Low ovarian reserve"
-                    ivf_prognosis = "Poor response expected"
-                elif afc_count > 25:
-                    classification = "High ovarian reserve (possible PCOS)"
-                    ivf_prognosis = "High response risk - monitor for OHSS"
+                if measured:
+                    # Counts and sizes from the measurement, narrative from the model
+                    total_count = measured.total_follicle_count
+                    afc_count = measured.antral_follicle_count
+                    dominant_size = measured.dominant_follicle_size
+                    follicle_sizes = measured.follicle_sizes
                 else:
-                    classification = "Normal ovarian reserve"
-                    ivf_prognosis = "Good response expected"
+                    follicle_sizes = self._extract_follicle_sizes_from_text(ai_analysis)
+                
+                classification, ivf_prognosis = self._classify_afc(afc_count)
                 
                 return FollicleAnalysis(
                     scan_id=scan_id,
@@ -235,7 +243,7 @@ class UltrasoundAnalyzer:
                     total_follicle_count=total_count,
                     antral_follicle_count=afc_count,
                     dominant_follicle_size=dominant_size,
-                    follicle_sizes=self._extract_follicle_sizes_from_text(ai_analysis),
+                    follicle_sizes=follicle_sizes,
                     ovarian_volume=ovarian_volume,
                     stromal_echogenicity=self._extract_text_value(ai_analysis, "stromal echogenicity", "normal"),
                     blood_flow=self._extract_text_value(ai_analysis, "blood flow", "normal"),
@@ -245,6 +253,8 @@ class UltrasoundAnalyzer:
                     notes=f"AI Analysis by DeepSeek: {ai_analysis[:200]}..." if len(ai_analysis) > 200 else ai_analysis,
                     timestamp=datetime.datetime.now().isoformat()
                 )
+            elif measured:
+                return self._follicle_analysis_from_detection(image_path, ovary_side, measured)
             else:
                 # Fallback to basic analysis if AI fails
                 scan_id = f"follicle_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}_{os.path.basename(image_path).split('.')[0]}"
@@ -287,6 +297,43 @@ class UltrasoundAnalyzer:
                 timestamp=datetime.datetime.now().isoformat()
             )
 
+    @staticmethod
+    def _classify_afc(afc_count: float) -> Tuple[str, str]:
+        """Ovarian reserve classification and IVF prognosis from the AFC"""
+        if afc_count < 6:
+            return "Low ovarian reserve", "Poor response expected"
+        if afc_count > 25:
+            return "High ovarian reserve (possible PCOS)", "High response risk - monitor for OHSS"
+        return "Normal ovarian reserve", "Good response expected"
+
+    def _follicle_analysis_from_detection(self, image_path: str, ovary_side: str,
+                                          detection: FollicleDetection) -> FollicleAnalysis:
+        """FollicleAnalysis of a local measurement; volume, echogenicity and flow are not assessed"""
+        afc_count = detection.antral_follicle_count
+        classification, ivf_prognosis = self._classify_afc(afc_count)
+        notes = (f"Measured by follicle detector in {detection.processing_time * 1000:.0f} ms "
+                 f"(confidence {detection.confidence:.2f}, calibration: {detection.calibration_source}, "
+                 f"{detection.mm_per_pixel} mm/pixel)")
+        if detection.notes:
+            notes += ". " + "; ".join(detection.notes)
+        return FollicleAnalysis(
+            scan_id=f"follicle_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}_{os.path.basename(image_path).split('.')[0]}",
+            patient_id="CV_PATIENT_001",
+            ovary_side=ovary_side,
+            total_follicle_count=detection.total_follicle_count,
+            antral_follicle_count=afc_count,
+            dominant_follicle_size=detection.dominant_follicle_size,
+            follicle_sizes=detection.follicle_sizes,
+            ovarian_volume=0.0,
+            stromal_echogenicity="not assessed",
+            blood_flow="not assessed",
+            classification=classification,
+            amh_correlation=f"Correlation based on measured AFC: {afc_count}",
+            ivf_prognosis=ivf_prognosis,
+            notes=notes,
+            timestamp=datetime.datetime.now().isoformat()
+        )
+
     def analyze_hysteroscopy_image(self, image_path: str) -> HysteroscopyAnalysis:
         """Analyze hysteroscopy image using DeepSeek LLM"""
         try:
@@ -313,8 +360,7 @@ class UltrasoundAnalyzer:
                     timestamp=datetime.datetime.now().isoformat()
                 )
             
-            processed_image = self.preprocess_ultrasound_image(image_path, "hysteroscopy")
-            base64_image = self.encode_image_to_base64(processed_image)
+            image = self.preprocess_ultrasound_image(image_path, "hysteroscopy")
             
             prompt = """
             You are an expert gynecologist with subspecialty training in reproductive endocrinology and hysteroscopy. This is an educational analysis for medical AI training purposes only. Please provide a comprehensive technical assessment of this hysteroscopic image following AAGL (American Association of Gynecologic Laparoscopists) guidelines.
@@ -374,7 +420,7 @@ class UltrasoundAnalyzer:
             """
 
             # Query LLaVA LLM
-            deepseek_result = self._query_deepseek(prompt, base64_image)
+            deepseek_result = self._query_deepseek(prompt, image)
 
             if deepseek_result.get("success"):
                 # Parse the AI analysis text and create HysteroscopyAnalysis object
@@ -455,7 +501,7 @@ class UltrasoundAnalyzer:
                 "analysis": ""
             }
 
-    def _query_deepseek(self, prompt: str, base64_image: str, analysis_type: str = "vision") -> Dict:
+    def _query_deepseek(self, prompt: str, image: ImagePayload, analysis_type: str = "vision", stop_when=None) -> Dict:
         """Query DeepSeek LLM and AI models with image and prompt using new model service"""
 
         # Use new model service if available
@@ -473,44 +519,35 @@ class UltrasoundAnalyzer:
 
                 analysis_enum = analysis_type_map.get(analysis_type, AnalysisType.VISION_ANALYSIS)
 
-                # Create temporary image file for model service
-                import tempfile
-                with tempfile.NamedTemporaryFile(suffix='.jpg', delete=False) as tmp_file:
-                    # Decode base64 image and save
-                    image_data = base64.b64decode(base64_image)
-                    tmp_file.write(image_data)
-                    tmp_file_path = tmp_file.name
-
-                try:
-                    # Call model service
+                # Call model service - the payload is encoded once for the whole fallback chain
+                if stop_when is not None:
+                    response = None
+                    for chunk in service_manager.stream_with_model(analysis_enum, prompt, image=image, stop_when=stop_when):
+                        if chunk.done:
+                            response = chunk.response
+                else:
                     response = service_manager.analyze_with_model(
                         analysis_type=analysis_enum,
                         prompt=prompt,
-                        image_path=tmp_file_path
+                        image=image
                     )
 
-                    if response.success:
-                        return {
-                            "success": True,
-                            "analysis": response.response,
-                            "provider": response.provider.value,
-                            "model": response.model_name,
-                            "processing_time": response.processing_time,
-                            "cost": response.cost,
-                            "quality_score": response.quality_score
-                        }
-                    else:
-                        return {
-                            "success": False,
-                            "error": response.error,
-                            "analysis": ""
-                        }
-                finally:
-                    # Clean up temporary file
-                    try:
-                        os.unlink(tmp_file_path)
-                    except:
-                        pass
+                if response.success:
+                    return {
+                        "success": True,
+                        "analysis": response.response,
+                        "provider": response.provider.value,
+                        "model": response.model_name,
+                        "processing_time": response.processing_time,
+                        "cost": response.cost,
+                        "quality_score": response.quality_score
+                    }
+                else:
+                    return {
+                        "success": False,
+                        "error": response.error,
+                        "analysis": ""
+                    }
 
             except Exception as e:
                 print(f"⚠️ Model service error, falling back to legacy mode: {e}")
@@ -521,16 +558,18 @@ class UltrasoundAnalyzer:
             payload = {
                 "model": "llava:7b",  # Changed to llava for vision support
                 "prompt": prompt,
-                "images": [base64_image],
+                "images": [image.base64],
                 "stream": False
             }
 
-            response = requests.post(
-                self.deepseek_url,
-                json=payload,
-                headers={"Content-Type": "application/json"},
-                timeout=60  # Longer timeout for complex analysis
-            )
+            # Local LLaVA is CPU-bound - wait for a free slot instead of overloading it
+            with scheduler_registry.get_or_create(self.deepseek_url).slot():
+                response = requests.post(
+                    self.deepseek_url,
+                    json=payload,
+                    headers={"Content-Type": "application/json"},
+                    timeout=60  # Longer timeout for complex analysis
+                )
 
             if response.status_code == 200:
                 result = response.json()
@@ -547,6 +586,12 @@ class UltrasoundAnalyzer:
                     "analysis": ""
                 }
 
+        except SchedulerError as e:
+            return {
+                "success": False,
+                "error": f"Vision LLM busy: {e}",
+                "analysis": ""
+            }
         except requests.exceptions.ConnectionError:
             return {
                 "success": False,
@@ -0,0 +1,360 @@
+"""
+FertiVision powered by AI - Write-Behind Persistence
+
+Optional asynchronous write path for the analysis tables. Request handlers
+hand their INSERTs, together with the statements that must commit alongside
+them (the analysis_index entry), to a bounded in-process queue and return;
+a background writer drains the queue and commits up to batch_size writes per
+transaction, so one commit (and one WAL sync) is shared by many analyses.
+
+Durability:
+- every write is appended to a journal file before it is queued
+- each group commit also records the last journal sequence number it
+  applied in `write_behind_checkpoint`, in the same transaction
+- on startup, journal entries past the checkpoint are replayed; once the
+  queue is drained the journal is truncated
+- a batch that fails to commit (database locked, I/O error) stays
+  pending and is retried with backoff before any newer write is taken, so
+  the checkpoint never moves past an uncommitted write; if it still fails
+  when the queue is closed, it and everything after it are left in the
+  journal for the next start; a write that can never commit (schema or
+  constraint error) is dropped and logged instead
+- close() (registered with atexit) drains the queue before the process exits
+
+Until the writer commits them, pending rows are visible through pending(),
+so read paths can serve their own writes without waiting for the database.
+
+One process owns the journal of a database file; run a single write-behind
+writer per file.
+
+© 2025 FertiVision powered by AI (made by greybrain.ai) - DeepSeek LLM Image Analysis
+"""
+
+import os
+import json
+import base64
+import time
+import queue
+import atexit
+import sqlite3
+import threading
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Any, Tuple, Hashable
+
+from database import ConnectionPool, get_pool
+
+# Writes waiting for the writer before submit() blocks (backpressure)
+MAX_PENDING_WRITES = 10000
+
+# Rows committed per transaction
+WRITE_BATCH_SIZE = 200
+
+# Longest a write waits in the queue when traffic is light (seconds)
+FLUSH_INTERVAL = 0.05
+
+# Backoff between attempts to commit a failed batch (seconds)
+RETRY_DELAY = 0.1
+MAX_RETRY_DELAY = 5.0
+
+# Attempts per batch once close() was called, before leaving it to the next start
+CLOSE_RETRIES = 3
+
+# Primary SQLite result codes worth retrying: BUSY, LOCKED, IOERR, FULL, CANTOPEN
+TRANSIENT_CODES = {5, 6, 10, 13, 14}
+TRANSIENT_MESSAGES = ("locked", "busy", "disk i/o", "database or disk is full", "unable to open")
+
+Statement = Tuple[str, List[Any]]
+
+def _encode_param(value: Any) -> Any:
+    # BLOB parameters (compressed LLM text) travel through the JSON journal as base64
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return {'b64': base64.b64encode(bytes(value)).decode('ascii')}
+    return value
+
+def _decode_param(value: Any) -> Any:
+    if isinstance(value, dict) and 'b64' in value:
+        return base64.b64decode(value['b64'])
+    return value
+
+def is_transient(error: sqlite3.Error) -> bool:
+    """Whether a failed commit may succeed later (lock, I/O); schema and data errors never will"""
+    code = getattr(error, 'sqlite_errorcode', None)
+    if code is not None:
+        return code & 0xFF in TRANSIENT_CODES
+    message = str(error).lower()
+    return any(text in message for text in TRANSIENT_MESSAGES)
+
+@dataclass
+class PendingWrite:
+    """Statements of one write, applied together"""
+    seq: int
+    statements: List[Statement]
+    table: str
+    key: Optional[Hashable] = None
+    row: Optional[Tuple[Any, ...]] = None
+
+class WriteBehindQueue:
+    """Bounded write queue with a group-committing background writer"""
+
+    def __init__(self,
+                 pool: ConnectionPool,
+                 journal_path: Optional[str] = None,
+                 max_pending: int = MAX_PENDING_WRITES,
+                 batch_size: int = WRITE_BATCH_SIZE,
+                 flush_interval: float = FLUSH_INTERVAL,
+                 fsync: bool = False,
+                 retry_delay: float = RETRY_DELAY,
+                 max_retry_delay: float = MAX_RETRY_DELAY):
+        self.pool = pool
+        self.journal_path = journal_path or pool.db_path + ".journal"
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        # Without fsync the journal survives process crashes, like synchronous=NORMAL in WAL mode
+        self.fsync = fsync
+        self._queue: "queue.Queue[Optional[PendingWrite]]" = queue.Queue(maxsize=max_pending)
+        self._pending: Dict[Tuple[str, Hashable], PendingWrite] = {}
+        self._lock = threading.Lock()
+        self._stats = {'submitted': 0, 'committed': 0, 'batches': 0, 'failed': 0, 'replayed': 0, 'retries': 0}
+        self._closed = False
+        # Set when close() gave up on a batch: later writes stay in the journal too
+        self._abandoned = False
+
+        self._init_checkpoint()
+        self._seq = self._committed_seq = self._recover()
+        self._journal = open(self.journal_path, "a", encoding="utf-8")
+
+        self._thread = threading.Thread(target=self._run, name="fertivision-write-behind", daemon=True)
+        self._thread.start()
+
+    def _init_checkpoint(self):
+        with self.pool.connection() as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS write_behind_checkpoint (
+                    id INTEGER PRIMARY KEY CHECK (id = 1),
+                    last_seq INTEGER
+                )
+            ''')
+            conn.execute('INSERT OR IGNORE INTO write_behind_checkpoint (id, last_seq) VALUES (1, 0)')
+
+    def _recover(self) -> int:
+        """Replay journal entries the database has not seen; returns the last sequence number"""
+        with self.pool.connection() as conn:
+            last_seq = conn.execute('SELECT last_seq FROM write_behind_checkpoint WHERE id = 1').fetchone()[0]
+
+        entries = []
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, encoding="utf-8") as journal:
+                for line in journal:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # Torn last line from a crash mid-append; the write never returned
+                        continue
+                    if entry['seq'] > last_seq:
+                        statements = [(sql, [_decode_param(value) for value in params])
+                                      for sql, params in entry['statements']]
+                        entries.append(PendingWrite(entry['seq'], statements, entry['table']))
+
+        if entries:
+            print(f"🔄 Replaying {len(entries)} journaled writes into {self.pool.db_path}")
+            for start in range(0, len(entries), self.batch_size):
+                self._commit(entries[start:start + self.batch_size])
+            last_seq = entries[-1].seq
+            self._stats['replayed'] = len(entries)
+
+        # Everything in the journal is now in the database
+        open(self.journal_path, "w").close()
+        return last_seq
+
+    def submit(self,
+               table: str,
+               statements: List[Statement],
+               key: Optional[Hashable] = None,
+               row: Optional[Tuple[Any, ...]] = None):
+        """
+        Journal and queue a write; blocks while the queue is full
+
+        key/row make the write visible through pending(table, key) until it
+        is committed.
+        """
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("Write-behind queue is closed")
+            self._seq += 1
+            write = PendingWrite(self._seq, [(sql, list(params)) for sql, params in statements], table, key, row)
+            journaled = [(sql, [_encode_param(value) for value in params]) for sql, params in write.statements]
+            self._journal.write(json.dumps({'seq': write.seq, 'table': table, 'statements': journaled}) + "\n")
+            self._journal.flush()
+            if self.fsync:
+                os.fsync(self._journal.fileno())
+            if key is not None:
+                self._pending[(table, key)] = write
+            self._stats['submitted'] += 1
+            # Held under the lock so queue order matches journal order
+            self._queue.put(write)
+
+    def pending(self, table: str, key: Hashable) -> Optional[Tuple[Any, ...]]:
+        """Row of a write to (table, key) that is not committed yet"""
+        write = self._pending.get((table, key))
+        return write.row if write is not None else None
+
+    def _run(self):
+        while True:
+            try:
+                first = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                self._truncate_journal()
+                continue
+            if first is None:
+                self._queue.task_done()
+                return
+
+            batch = [first]
+            stop = False
+            while len(batch) < self.batch_size:
+                try:
+                    write = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if write is None:
+                    self._queue.task_done()
+                    stop = True
+                    break
+                batch.append(write)
+
+            committed = not self._abandoned and self._commit_with_retry(batch)
+            with self._lock:
+                if committed:
+                    for write in batch:
+                        if write.key is not None and self._pending.get((write.table, write.key)) is write:
+                            del self._pending[(write.table, write.key)]
+                    self._committed_seq = batch[-1].seq
+            for _ in batch:
+                self._queue.task_done()
+            if stop:
+                return
+
+    def _commit_with_retry(self, batch: List[PendingWrite]) -> bool:
+        """Commit a batch, retrying with backoff; False when closing and it still fails"""
+        attempts = 0
+        while True:
+            try:
+                self._commit(batch)
+                return True
+            except Exception as e:
+                attempts += 1
+                self._stats['retries'] += 1
+                if self._closed and attempts >= CLOSE_RETRIES:
+                    self._abandoned = True
+                    print(f"❌ Write-behind commit failed on close, writes from seq {batch[0].seq} "
+                          f"kept in {self.journal_path} for the next start: {e}")
+                    return False
+                delay = min(self.retry_delay * 2 ** (attempts - 1), self.max_retry_delay)
+                print(f"⚠️ Write-behind commit of {len(batch)} writes failed ({e}), retrying in {delay:.1f}s")
+                time.sleep(delay)
+
+    def _commit(self, batch: List[PendingWrite]):
+        """Group commit; on a bad row retry row by row so it cannot stall the queue"""
+        last_seq = batch[-1].seq
+        try:
+            with self.pool.connection() as conn:
+                for write in batch:
+                    for sql, params in write.statements:
+                        conn.execute(sql, params)
+                conn.execute('UPDATE write_behind_checkpoint SET last_seq = ? WHERE id = 1', (last_seq,))
+            self._stats['committed'] += len(batch)
+            self._stats['batches'] += 1
+            return
+        except sqlite3.Error as e:
+            if is_transient(e):
+                # Locked or I/O error: the whole batch is retried by _commit_with_retry
+                raise
+            print(f"⚠️ Write-behind batch of {len(batch)} failed ({e}), retrying row by row")
+
+        with self.pool.connection() as conn:
+            for write in batch:
+                try:
+                    conn.execute('SAVEPOINT write_behind_row')
+                    for sql, params in write.statements:
+                        conn.execute(sql, params)
+                    conn.execute('RELEASE write_behind_row')
+                    self._stats['committed'] += 1
+                except sqlite3.Error as e:
+                    if is_transient(e):
+                        raise
+                    conn.execute('ROLLBACK TO write_behind_row')
+                    conn.execute('RELEASE write_behind_row')
+                    self._stats['failed'] += 1
+                    print(f"❌ Dropped write-behind write to {write.table} (seq {write.seq}): {e}")
+            conn.execute('UPDATE write_behind_checkpoint SET last_seq = ? WHERE id = 1', (last_seq,))
+        self._stats['batches'] += 1
+
+    def _truncate_journal(self):
+        """Start a fresh journal once every journaled write is committed"""
+        # Never wait: a submitter may hold the lock while blocked on a full queue
+        if not self._lock.acquire(blocking=False):
+            return
+        try:
+            if self._committed_seq == self._seq and self._journal.tell() > 0:
+                self._journal.truncate(0)
+                self._journal.seek(0)
+        finally:
+            self._lock.release()
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """
+        Block until every write submitted so far is committed
+
+        Returns False when the timeout expires first; raises if the writer
+        thread is gone.
+        """
+        deadline = time.time() + timeout if timeout is not None else None
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks:
+                if not self._thread.is_alive():
+                    raise RuntimeError(f"Write-behind writer stopped with {self._queue.unfinished_tasks} writes pending")
+                wait = 0.1 if deadline is None else min(0.1, deadline - time.time())
+                if wait <= 0:
+                    return False
+                self._queue.all_tasks_done.wait(wait)
+        return True
+
+    def close(self):
+        """Drain the queue, stop the writer and clear the journal"""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        self._queue.put(None)
+        self._thread.join()
+        with self._lock:
+            if self._committed_seq == self._seq:
+                self._journal.truncate(0)
+            self._journal.close()
+
+    def stats(self) -> Dict[str, int]:
+        return {**self._stats, 'queued': self._queue.qsize(), 'pending': len(self._pending)}
+
+_queues: Dict[str, WriteBehindQueue] = {}
+_queues_lock = threading.Lock()
+
+def get_write_queue(db_path: str) -> WriteBehindQueue:
+    """Write-behind queue shared by every system writing to this database file"""
+    key = os.path.abspath(db_path)
+    with _queues_lock:
+        writes = _queues.get(key)
+        if writes is None or writes._closed:
+            writes = _queues[key] = WriteBehindQueue(get_pool(db_path))
+        return writes
+
+def close_write_queues():
+    """Flush and stop every write-behind queue (shutdown, tests)"""
+    with _queues_lock:
+        writes = list(_queues.values())
+        _queues.clear()
+    for queue_ in writes:
+        queue_.close()
+
+atexit.register(close_write_queues)